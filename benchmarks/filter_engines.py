@@ -0,0 +1,56 @@
+"""
+Compares the time taken by each Sound.filter engine across sound durations and filter orders.
+
+Usage: python benchmarks/filter_engines.py [--repeat N] [--nchannels N]
+"""
+from __future__ import print_function
+import argparse
+import timeit
+
+import numpy as np
+from brian import hertz
+
+from neosound.sound import Sound
+from neosound.sound_manager import SoundManager
+
+durations = [1, 10, 60]
+orders = [64, 512, 2048]
+sos_orders = [4, 8]
+samplerate = 44100 * hertz
+frequency_range = [500 * hertz, 4000 * hertz]
+
+
+def time_filter(sound, repeat, **kwargs):
+
+    # Design the filter first so only filtering is timed
+    sound.filter(frequency_range, read_only=True, **kwargs)
+
+    return min(timeit.repeat(lambda: sound.filter(frequency_range, read_only=True, **kwargs),
+                             number=1, repeat=repeat))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--nchannels", type=int, default=1)
+    args = parser.parse_args()
+
+    manager = SoundManager()
+    print("%10s %8s %12s %10s" % ("duration", "order", "engine", "seconds"))
+    for duration in durations:
+        data = np.random.normal(0, 1, (int(duration * float(samplerate)), args.nchannels))
+        sound = Sound(data, samplerate=samplerate, manager=manager)
+        for order in orders:
+            for engine in ["filtfilt", "fft"]:
+                seconds = time_filter(sound, args.repeat, filter_order=order, engine=engine)
+                print("%10d %8d %12s %10.4f" % (duration, order, engine, seconds))
+        for order in sos_orders:
+            for design in ["butter", "ellip"]:
+                seconds = time_filter(sound, args.repeat, filter_order=order, engine="sos", design=design)
+                print("%10d %8d %12s %10.4f" % (duration, order, "sos-" + design, seconds))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,46 @@
+"""
+Compares the time taken by each Sound.resample engine for common samplerate conversions.
+
+Usage: python benchmarks/resample_engines.py [--repeat N] [--duration SECONDS] [--nchannels N] [--extra-samples N]
+
+Sounds are a whole number of seconds long by default. Adding a few extra samples gives lengths with large prime
+factors, for which the fft engine can take minutes.
+"""
+from __future__ import print_function
+import argparse
+import timeit
+
+import numpy as np
+from brian import hertz
+
+from neosound.sound import Sound
+from neosound.sound_manager import SoundManager
+
+conversions = [(44100, 48000), (48000, 44100), (48000, 16000), (16000, 48000), (44100, 16000), (16000, 44100)]
+engines = ["fft", "polyphase", "stream"]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=10.)
+    parser.add_argument("--nchannels", type=int, default=1)
+    parser.add_argument("--extra-samples", type=int, default=0)
+    args = parser.parse_args()
+
+    manager = SoundManager()
+    print("%10s %10s %12s %10s" % ("from", "to", "engine", "seconds"))
+    for samplerate, new_samplerate in conversions:
+        data = np.random.normal(0, 1, (int(args.duration * samplerate) + args.extra_samples, args.nchannels))
+        sound = Sound(data, samplerate=samplerate * hertz, manager=manager)
+        for engine in engines:
+            seconds = min(timeit.repeat(lambda: sound.resample(new_samplerate * hertz, resample_type=engine,
+                                                               read_only=True),
+                                        number=1, repeat=args.repeat))
+            print("%10d %10d %12s %10.4f" % (samplerate, new_samplerate, engine, seconds))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures how many Sound objects can be created per second, directly and as the result of transforms.
+
+Usage: python benchmarks/sound_construction.py [--repeat N] [--number N] [--nsamples N] [--store dict|hdf5]
+
+Sounds created directly write their annotations immediately, unless they are created in the manager's
+deferred_mode. Transforms called with read_only=True create sounds that are never stored, so their annotations are
+never written.
+"""
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+import timeit
+
+import numpy as np
+from brian import hertz, second
+
+from neosound.sound import Sound
+from neosound.sound_manager import SoundManager
+from neosound.sound_store import DictStore, HDF5Store
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--number", type=int, default=1000)
+    parser.add_argument("--nsamples", type=int, default=4410)
+    parser.add_argument("--store", choices=["dict", "hdf5"], default="dict")
+    args = parser.parse_args()
+
+    if args.store == "hdf5":
+        manager = SoundManager(HDF5Store, os.path.join(tempfile.mkdtemp(), "construction.h5"))
+    else:
+        manager = SoundManager(DictStore)
+    data = np.random.normal(0, 1, (args.nsamples, 1))
+    sound = Sound(data, samplerate=44100 * hertz, manager=manager, initialize=True)
+
+    def create():
+        Sound(data, samplerate=44100 * hertz, manager=manager)
+
+    def create_deferred():
+        with manager.deferred_mode():
+            Sound(data, samplerate=44100 * hertz, manager=manager)
+
+    def transform():
+        sound.scale(2, read_only=True)
+
+    def slice_():
+        sound.slice(0 * second, 0.05 * second, read_only=True)
+
+    cases = [("Sound(...)", create),
+             ("Sound(...) deferred", create_deferred),
+             ("scale read_only", transform),
+             ("slice read_only", slice_)]
+
+    print("%24s %14s" % ("case", "sounds / s"))
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        print("%24s %14.0f" % (name, args.number / seconds))
+
+
+if __name__ == "__main__":
+
+    main()
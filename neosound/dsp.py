@@ -0,0 +1,390 @@
+import collections
+import threading
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import butter, ellip, fftconvolve, filtfilt, firwin, resample, sosfiltfilt, upfirdn
+
+
+class FilterDesignCache(object):
+    """
+    A bounded, least-recently-used cache of filter designs, shared by all sounds. Designing an order 512 filter
+    with firwin takes longer than applying it to a short sound, and most filters are designed over and over with the
+    same order, band and samplerate.
+    """
+
+    def __init__(self, maxsize=128):
+        """
+        :param maxsize: the maximum number of filter designs to keep (128)
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._designs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, design):
+        """
+        Gets the filter coefficients for key, calling design() to compute them if they aren't cached. The cached
+        arrays are shared, so they are made read-only.
+        :param key: a hashable description of the filter
+        :param design: a function of no arguments that returns the filter coefficients
+        :return: the filter coefficients
+        """
+
+        with self._lock:
+            if key in self._designs:
+                self.hits += 1
+                coefficients = self._designs.pop(key)
+                self._designs[key] = coefficients
+                return coefficients
+            self.misses += 1
+
+        coefficients = np.asarray(design())
+        coefficients.setflags(write=False)
+        with self._lock:
+            self._designs[key] = coefficients
+            while len(self._designs) > self.maxsize:
+                self._designs.popitem(last=False)
+
+        return coefficients
+
+    def info(self):
+        """
+        Describes the cache
+        :return: a dictionary with the number of hits and misses, the maximum size and current size of the cache,
+        and the keys of the cached designs from least to most recently used
+        """
+
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        maxsize=self.maxsize,
+                        currsize=len(self._designs),
+                        keys=self._designs.keys())
+
+    def discard(self, match):
+        """
+        Removes the designs whose keys match, e.g. those computed from a waveform that has since changed
+        :param match: a function of a key that returns True if its design should be removed
+        """
+
+        with self._lock:
+            for key in [key for key in self._designs if match(key)]:
+                del self._designs[key]
+
+    def clear(self):
+        """
+        Removes all designs from the cache and resets its statistics
+        """
+
+        with self._lock:
+            self._designs.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+filter_design_cache = FilterDesignCache()
+# The magnitude spectra of sounds, keyed by their store, id and FFT length, for generating spectrum-matched noise
+spectrum_cache = FilterDesignCache(maxsize=16)
+
+
+def design_fir(order, cutoff, nyquist, pass_zero=True, window="hamming"):
+    """
+    Designs a linear phase FIR filter with firwin, using filter_design_cache.
+    :param order: the number of taps of the filter
+    :param cutoff: the cutoff frequency, or a pair of them for a bandpass filter, in Hz
+    :param nyquist: the nyquist frequency in Hz
+    :param pass_zero: True for a lowpass filter, False for a highpass or bandpass filter (True)
+    :param window: the window used by firwin ("hamming")
+    :return: a read-only array of filter coefficients
+    """
+
+    cutoff = tuple(float(cc) for cc in np.atleast_1d(cutoff))
+    key = ("fir", int(order), cutoff, float(nyquist), bool(pass_zero), window)
+
+    return filter_design_cache.get(key, lambda: firwin(int(order), list(cutoff) if len(cutoff) > 1 else cutoff[0],
+                                                       nyq=float(nyquist), pass_zero=pass_zero, window=window,
+                                                       scale=False))
+
+
+def design_sos(order, cutoff, nyquist, btype, design="butter", ripple=0.1, attenuation=60.):
+    """
+    Designs an IIR filter as second-order sections, using filter_design_cache.
+    :param order: the order of the filter. Bandpass filters have twice this order.
+    :param cutoff: the cutoff frequency, or a pair of them for a bandpass filter, in Hz
+    :param nyquist: the nyquist frequency in Hz
+    :param btype: "lowpass", "highpass" or "bandpass"
+    :param design: "butter" for a Butterworth filter or "ellip" for an elliptic filter ("butter")
+    :param ripple: the maximum passband ripple of an elliptic filter in dB (0.1)
+    :param attenuation: the minimum stopband attenuation of an elliptic filter in dB (60)
+    :return: a read-only array of second-order sections
+    """
+
+    cutoff = tuple(float(cc) / float(nyquist) for cc in np.atleast_1d(cutoff))
+    wn = list(cutoff) if len(cutoff) > 1 else cutoff[0]
+    if design == "butter":
+        key = ("sos", design, int(order), cutoff, btype)
+        return filter_design_cache.get(key, lambda: butter(int(order), wn, btype=btype, output="sos"))
+    elif design == "ellip":
+        key = ("sos", design, int(order), cutoff, btype, float(ripple), float(attenuation))
+        return filter_design_cache.get(key, lambda: ellip(int(order), float(ripple), float(attenuation), wn,
+                                                          btype=btype, output="sos"))
+    else:
+        raise ValueError("Unknown filter design %s. Must be butter or ellip" % design)
+
+
+def fft_filtfilt(b, data, padlen=None):
+    """
+    Applies the FIR filter b forwards and backwards along the first axis of data, like filtfilt, but as a single
+    FFT convolution with the zero-phase kernel convolve(b, b[::-1]). This is O(N log N) rather than O(N * order).
+    The edges are extended the same way as in filtfilt. Because the extension is longer than the filter, filtfilt's
+    initial conditions have no effect and the result agrees with filtfilt to within rounding error.
+    :param b: FIR filter coefficients
+    :param data: an array of shape (nsamples, ...)
+    :param padlen: the number of samples to extend at each end (3 * len(b), as in filtfilt)
+    :return: the filtered array
+    """
+
+    data = np.asarray(data, dtype=float)
+    if padlen is None:
+        padlen = 3 * len(b)
+    padlen = min(padlen, data.shape[0] - 1)
+
+    # Odd extension at both ends
+    extended = np.concatenate([2 * data[:1] - data[padlen: 0: -1],
+                               data,
+                               2 * data[-1:] - data[-2: -padlen - 2: -1]])
+    kernel = np.convolve(b, b[::-1]).reshape((-1,) + (1,) * (data.ndim - 1))
+    filtered = fftconvolve(extended, kernel, mode="same")
+
+    return filtered[padlen: padlen + data.shape[0]]
+
+
+filter_engines = ("filtfilt", "fft", "sos")
+
+
+def zero_phase_filter(coefficients, data, engine="filtfilt"):
+    """
+    Filters data along its first axis without phase distortion.
+    :param coefficients: FIR filter coefficients for the "filtfilt" and "fft" engines, or second-order sections for
+    the "sos" engine
+    :param data: an array of shape (nsamples, ...)
+    :param engine: "filtfilt" applies an FIR filter forwards and backwards in direct form. "fft" does the same with an
+    FFT convolution (see fft_filtfilt). "sos" applies an IIR filter forwards and backwards with sosfiltfilt.
+    ("filtfilt")
+    :return: the filtered array
+    """
+
+    data = np.asarray(data)
+    if engine == "filtfilt":
+        a = np.zeros(coefficients.shape)
+        a[0] = 1
+        return filtfilt(coefficients, a, data, axis=0)
+    elif engine == "fft":
+        return fft_filtfilt(coefficients, data)
+    elif engine == "sos":
+        return sosfiltfilt(coefficients, data, axis=0)
+    else:
+        raise ValueError("Unknown filter engine %s. Must be one of %s" % (engine, ", ".join(filter_engines)))
+
+
+def resample_ratio(samplerate, new_samplerate, max_denominator=1000):
+    """
+    Approximates new_samplerate / samplerate as a ratio of small integers
+    :return: the upsampling and downsampling factors
+    """
+
+    ratio = Fraction(float(new_samplerate) / float(samplerate)).limit_denominator(max_denominator)
+
+    return ratio.numerator, ratio.denominator
+
+
+def design_resample_filter(up, down, window=("kaiser", 5.0)):
+    """
+    Designs the anti-aliasing filter used by scipy.signal.resample_poly, using filter_design_cache.
+    :param up: the upsampling factor
+    :param down: the downsampling factor
+    :param window: the window used by firwin (("kaiser", 5.0), as in resample_poly)
+    :return: the filter coefficients, zero-padded at the start so that output samples are centered, and the number
+    of output samples to discard at the start
+    """
+
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    n_pre_pad = down - half_len % down
+
+    def design():
+        h = firwin(2 * half_len + 1, 1. / max_rate, window=window) * up
+        return np.concatenate([np.zeros(n_pre_pad), h])
+
+    return filter_design_cache.get(("resample", up, down, window), design), (half_len + n_pre_pad) // down
+
+
+class StreamResampler(object):
+    """
+    Resamples a signal by a rational factor one block at a time, keeping only the input history needed by the
+    filter. The output is the same as resample_poly's for the whole signal, but the memory used depends on the block
+    size rather than the length of the signal.
+
+    Example:
+    resampler = StreamResampler(160, 147)
+    output = [resampler.process(block) for block in blocks]
+    output.append(resampler.flush())
+    """
+
+    def __init__(self, up, down):
+        """
+        :param up: the upsampling factor
+        :param down: the downsampling factor
+        """
+
+        self.up = up
+        self.down = down
+        self.h, self._discard = design_resample_filter(up, down)
+
+        self._buffer = None
+        # The index of the first input sample in the buffer. It is always a multiple of down, so that the buffer's
+        # polyphase outputs line up with those of the whole signal.
+        self._start = 0
+        self._ninput = 0
+        self._noutput = 0
+
+    def process(self, block):
+        """
+        Adds a block of input samples
+        :param block: an array of shape (nsamples, ...)
+        :return: the output samples that can be computed from the input so far
+        """
+
+        block = np.asarray(block, dtype=float)
+        if self._buffer is None:
+            self._buffer = block
+        else:
+            self._buffer = np.concatenate([self._buffer, block])
+        self._ninput += len(block)
+
+        # An output sample only depends on inputs up to index output * down / up
+        stop = ((self._ninput - 1) * self.up) // self.down + 1
+
+        return self._output(stop)
+
+    def flush(self):
+        """
+        Computes the remaining output samples once all of the input has been processed
+        :return: the last output samples
+        """
+
+        if self._buffer is None:
+            return np.zeros(0)
+
+        n_out = -(-self._ninput * self.up // self.down)
+        output = self._output(self._discard + n_out, pad=True)
+        self._buffer = None
+
+        return output
+
+    def _output(self, stop, pad=False):
+
+        if stop <= self._noutput:
+            return self._buffer[:0]
+
+        data = self._buffer
+        if pad:
+            # Inputs past the end of the signal are zero
+            nzeros = len(self.h) // self.up + 1
+            data = np.concatenate([data, np.zeros((nzeros,) + data.shape[1:])])
+
+        offset = self._start * self.up // self.down
+        output = upfirdn(self.h, data, self.up, self.down, axis=0)[self._noutput - offset: stop - offset]
+        start = max(self._discard - self._noutput, 0)
+        self._noutput = stop
+
+        # Drop the input that no later output depends on
+        first_input = (stop * self.down - len(self.h) + 1) // self.up
+        new_start = max(first_input // self.down * self.down, self._start)
+        self._buffer = self._buffer[new_start - self._start:]
+        self._start = new_start
+
+        return output[start:]
+
+
+resample_engines = ("fft", "polyphase", "stream")
+
+
+def resample_signal(data, samplerate, new_samplerate, engine="polyphase", block_size=2 ** 16):
+    """
+    Resamples data along its first axis
+    :param data: an array of shape (nsamples, ...)
+    :param samplerate: the samplerate of data in Hz
+    :param new_samplerate: the desired samplerate in Hz
+    :param engine: "fft" resamples the whole signal in the frequency domain with scipy.signal.resample. It is slow
+    for lengths with large prime factors. "polyphase" filters with a rational polyphase filter using
+    scipy.signal.resample_poly. "stream" gives the same result as "polyphase" but processes block_size samples at a
+    time. ("polyphase")
+    :param block_size: the number of input samples per block for the "stream" engine (65536)
+    :return: the resampled array, with int(new_samplerate * duration) samples
+    """
+
+    data = np.asarray(data)
+    nsamples = int(new_samplerate * (len(data) / float(samplerate)))
+    if engine == "fft":
+        return resample(data, nsamples, axis=0)
+    elif engine not in resample_engines:
+        raise ValueError("Unknown resample engine %s. Must be one of %s" % (engine, ", ".join(resample_engines)))
+
+    up, down = resample_ratio(samplerate, new_samplerate)
+    resampler = StreamResampler(up, down)
+    if engine == "polyphase":
+        blocks = [resampler.process(data), resampler.flush()]
+    else:
+        blocks = [resampler.process(data[ii: ii + block_size]) for ii in xrange(0, len(data), block_size)]
+        blocks.append(resampler.flush())
+    resampled = np.concatenate(blocks)
+
+    # Match the length of the fft engine
+    if len(resampled) < nsamples:
+        resampled = np.concatenate([resampled, np.zeros((nsamples - len(resampled),) + resampled.shape[1:])])
+
+    return resampled[:nsamples]
+
+
+def magnitude_spectrum(data, nfft):
+    """
+    Computes the magnitude of the one-sided spectrum of each channel
+    :param data: an array of shape (nsamples, nchannels)
+    :param nfft: the FFT length. data is padded with zeros to nfft samples.
+    :return: an array of shape (nfft // 2 + 1, nchannels)
+    """
+
+    return np.abs(np.fft.rfft(np.asarray(data), n=int(nfft), axis=0))
+
+
+def random_phase_noise(magnitude, nsamples, ntokens=1, seeds=None):
+    """
+    Generates noise with the given magnitude spectrum and uniformly random phases, with the DC and Nyquist
+    components set to 0. Each token is the inverse real FFT of the magnitudes with its own phases.
+    :param magnitude: an array of shape (nsamples // 2 + 1, nchannels), as returned by magnitude_spectrum
+    :param nsamples: the FFT length, i.e. the number of samples of each token
+    :param ntokens: the number of independent tokens to generate (1)
+    :param seeds: a random seed for each token, so that the same tokens can be generated again. Overrides ntokens.
+    (phases are drawn from numpy's global random state)
+    :return: an array of shape (ntokens, nsamples, nchannels)
+    """
+
+    magnitude = np.asarray(magnitude)
+    nbins = int(nsamples) // 2 + 1
+    if len(magnitude) != nbins:
+        raise ValueError("Magnitude spectrum must have %d bins for %d samples" % (nbins, nsamples))
+
+    if seeds is None:
+        phases = np.random.uniform(-np.pi, np.pi, (ntokens,) + magnitude.shape)
+    else:
+        phases = np.array([np.random.RandomState(seed).uniform(-np.pi, np.pi, magnitude.shape) for seed in seeds])
+    spectrum = magnitude * np.exp(1j * phases)
+    spectrum[:, 0] = 0
+    if nsamples % 2 == 0:
+        spectrum[:, -1] = 0
+
+    return np.fft.irfft(spectrum, n=int(nsamples), axis=1)
@@ -0,0 +1,214 @@
+"""
+Level metrics of multichannel waveforms: peak amplitude, mean, RMS, level in dB SPL and the power of the peaks in
+the nonsilent regions. Every metric is computed for all channels at once in a single pass over the data, one block
+at a time, so sounds whose waveforms are stored can be measured without loading them. Metrics are cached in the
+sound's annotations as one float per channel (e.g. metric_rms_0), so repeated calls to set_level or embed reuse them.
+
+Example:
+metrics = compute_metrics(np.asarray(sound))
+metrics["level"]
+metrics = stored_metrics(manager, id_, block_size=2 ** 20)
+"""
+from __future__ import division
+import numpy as np
+
+_prefix = "metric_"
+# Metrics with one value per channel that are cached. The level is computed from the rms.
+_cached = ["peak", "mean", "rms", "power_nonsilence"]
+# Only metrics computed with this silence threshold are cached, so that other thresholds never replace them
+cached_threshold = .1
+
+
+class MetricsAccumulator(object):
+    """
+    Accumulates the metrics of a waveform one block at a time. The mean and RMS are combined across blocks with
+    Chan's parallel algorithm, and peaks that straddle two blocks are found by keeping the last two samples of the
+    previous block. Only the peaks above the silence threshold seen so far are kept in memory.
+    """
+
+    def __init__(self, nchannels, silence_threshold=.1):
+        """
+        :param nchannels: the number of channels in the waveform
+        :param silence_threshold: fraction of the maximum absolute value (over all channels) below which the
+        waveform is considered silent (0.1)
+        """
+
+        self.nchannels = nchannels
+        self.silence_threshold = silence_threshold
+        self.nsamples = 0
+        self.peak = np.zeros(nchannels)
+        self.mean = np.zeros(nchannels)
+        self.m2 = np.zeros(nchannels)
+        self._peaks = [np.zeros(0) for ii in xrange(nchannels)]
+        self._tail = np.zeros((0, nchannels))
+
+    def update(self, block):
+        """
+        Adds the next block of samples
+        :param block: an array of shape (nsamples, nchannels)
+        """
+
+        block = np.asarray(block, dtype=float).reshape((-1, self.nchannels))
+        nsamples = len(block)
+        if not nsamples:
+            return
+
+        mean = block.mean(axis=0)
+        m2 = ((block - mean) ** 2).sum(axis=0)
+        total = self.nsamples + nsamples
+        delta = mean - self.mean
+        self.m2 += m2 + delta ** 2 * self.nsamples * nsamples / total
+        self.mean += delta * nsamples / total
+        self.nsamples = total
+
+        waveform = np.abs(block)
+        self.peak = np.maximum(self.peak, waveform.max(axis=0))
+
+        # Local maxima of the rectified waveform that are above the threshold
+        waveform = np.concatenate([self._tail, waveform])
+        self._tail = waveform[-2:]
+        d = np.diff(waveform, axis=0)
+        threshold = self.peak.max() * self.silence_threshold
+        values = waveform[1: -1]
+        is_peak = (values > threshold) & (d[:-1] > 0) & (d[1:] < 0)
+        for ii in xrange(self.nchannels):
+            peaks = self._peaks[ii]
+            self._peaks[ii] = np.concatenate([peaks[peaks > threshold], values[is_peak[:, ii], ii]])
+
+    def result(self):
+        """
+        :return: a dictionary of arrays with one value per channel: peak (the maximum absolute value), mean, rms (of
+        the waveform minus its mean), level (in dB SPL, assuming the waveform is in Pascals) and power_nonsilence (the
+        mean power of the peaks above the silence threshold, or nan if there are none). It also holds the
+        silence_threshold.
+        """
+
+        threshold = self.peak.max() * self.silence_threshold
+        power = list()
+        for peaks in self._peaks:
+            peaks = peaks[peaks > threshold]
+            power.append((peaks ** 2).mean() if len(peaks) else np.nan)
+
+        rms = np.sqrt(self.m2 / max(self.nsamples, 1))
+        with np.errstate(divide="ignore"):
+            level = 20.0 * np.log10(rms / 2e-5)
+
+        return dict(peak=self.peak.copy(),
+                    mean=self.mean.copy(),
+                    rms=rms,
+                    level=level,
+                    power_nonsilence=np.array(power),
+                    silence_threshold=float(self.silence_threshold))
+
+
+def compute_metrics(data, silence_threshold=.1):
+    """
+    Computes the metrics of a waveform. See MetricsAccumulator.result.
+    :param data: an array of shape (nsamples, nchannels), or (nsamples,) for a mono waveform
+    :param silence_threshold: see MetricsAccumulator (0.1)
+    :return: a dictionary of metrics
+    """
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data.reshape((-1, 1))
+
+    accumulator = MetricsAccumulator(data.shape[1], silence_threshold=silence_threshold)
+    accumulator.update(data)
+
+    return accumulator.result()
+
+
+def padded_level(metrics, nsamples, total):
+    """
+    Computes the level of each channel in dB SPL as if the waveform were padded with zeros, from its metrics
+    :param metrics: the metrics of the waveform
+    :param nsamples: the number of samples in the waveform
+    :param total: the number of samples after padding
+    :return: an array of levels
+    """
+
+    mean = metrics["mean"] * nsamples / total
+    sumsq = nsamples * (metrics["rms"] ** 2 + metrics["mean"] ** 2)
+    power = np.maximum(sumsq / total - mean ** 2, 0)
+    with np.errstate(divide="ignore"):
+        return 20.0 * np.log10(np.sqrt(power) / 2e-5)
+
+
+def metric_annotations(metrics):
+    """
+    Converts metrics to annotations, for caching. Each channel's value is a separate float annotation, so that
+    annotations can still be compared with ==.
+    """
+
+    annotations = dict()
+    for key in _cached:
+        for ii, value in enumerate(metrics[key]):
+            annotations["%s%s_%d" % (_prefix, key, ii)] = float(value)
+    annotations[_prefix + "silence_threshold"] = float(metrics["silence_threshold"])
+
+    return annotations
+
+
+def clear_metric_annotations(annotations):
+    """
+    Removes the cached metrics from a sound's annotations, e.g. after its waveform was modified in place
+    :param annotations: the annotations of the sound, which are modified
+    """
+
+    for key in [key for key in annotations if key.startswith(_prefix)]:
+        del annotations[key]
+
+
+def cached_metrics(annotations, silence_threshold=.1):
+    """
+    Gets the metrics cached in a sound's annotations
+    :param annotations: the annotations of the sound
+    :param silence_threshold: the threshold the metrics must have been computed with (0.1)
+    :return: a dictionary of metrics, or None if they aren't cached for this threshold
+    """
+
+    if float(annotations.get(_prefix + "silence_threshold", np.nan)) != float(silence_threshold):
+        return
+
+    metrics = dict(silence_threshold=float(silence_threshold))
+    nchannels = int(annotations["nchannels"])
+    for key in _cached:
+        names = ["%s%s_%d" % (_prefix, key, ii) for ii in xrange(nchannels)]
+        if any(name not in annotations for name in names):
+            return
+        metrics[key] = np.array([float(annotations[name]) for name in names])
+    with np.errstate(divide="ignore"):
+        metrics["level"] = 20.0 * np.log10(metrics["rms"] / 2e-5)
+
+    return metrics
+
+
+def stored_metrics(manager, id_, block_size=2 ** 16, silence_threshold=.1):
+    """
+    Computes the metrics of a sound in the database and caches them in its annotations, if they are computed with
+    cached_threshold. Stored waveforms are read one block at a time. Other sounds are reconstructed first.
+    :param manager: an instance of SoundManager
+    :param id_: the sound id
+    :param block_size: the number of samples read at a time (65536)
+    :param silence_threshold: see MetricsAccumulator (0.1)
+    :return: a dictionary of metrics
+    """
+
+    metrics = cached_metrics(manager.database.get_annotations(id_), silence_threshold)
+    if metrics is not None:
+        return metrics
+
+    shape = manager.database.get_data_shape(id_)
+    if shape is None:
+        return manager.reconstruct(id_).get_metrics(silence_threshold)
+
+    nchannels = shape[1] if len(shape) > 1 else 1
+    accumulator = MetricsAccumulator(nchannels, silence_threshold=silence_threshold)
+    for start in xrange(0, shape[0], block_size):
+        accumulator.update(manager.database.read_block(id_, start, start + block_size))
+    metrics = accumulator.result()
+    if (float(silence_threshold) == cached_threshold) and not manager.ephemeral:
+        manager.database.store_annotations(id_, **metric_annotations(metrics))
+
+    return metrics
@@ -0,0 +1,110 @@
+"""
+Shared memory buffers for sending waveforms between processes without copying them. A shared buffer is a file in
+/dev/shm (or the temporary directory where /dev/shm doesn't exist) that is memory-mapped by every process that uses
+it, so all of them see the same pages.
+
+Example:
+data = share(np.zeros((44100, 2)))
+reference = shared_reference(data)
+# In another process
+data = attach(reference)
+"""
+import atexit
+import os
+import tempfile
+
+import numpy as np
+
+shared_directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_prefix = "neosound-"
+# The buffers created by each process, so that forked children don't remove their parent's buffers
+_owned_files = dict()
+
+
+def share(array):
+    """
+    Copies an array into a new shared memory buffer. The buffer is removed when release is called on it or when this
+    process exits. Processes that have already attached it can keep using it after it is removed.
+    :param array: a numpy array
+    :return: an array with the same contents, backed by shared memory. Empty arrays are returned as a copy.
+    """
+
+    array = np.asarray(array)
+    if array.size == 0:
+        return array.copy()
+
+    fd, filename = tempfile.mkstemp(prefix=_prefix, dir=shared_directory)
+    os.close(fd)
+    _owned_files[filename] = os.getpid()
+    shared = np.memmap(filename, dtype=array.dtype, mode="w+", shape=array.shape)
+    shared[...] = array
+
+    return shared
+
+
+def _get_buffer(array):
+    """
+    Finds the shared memory buffer that array is a view of
+    :return: the np.memmap of the buffer, or None if array is not backed by shared memory
+    """
+
+    base = array
+    while base is not None:
+        if isinstance(base, np.memmap) and (base.filename is not None):
+            if os.path.basename(base.filename).startswith(_prefix) and \
+                    (os.path.dirname(base.filename) == os.path.abspath(shared_directory)):
+                return base
+        base = getattr(base, "base", None)
+
+
+def shared_reference(array):
+    """
+    Describes where an array lives in shared memory, so that another process can attach to it
+    :param array: a numpy array
+    :return: a tuple of the buffer's filename, the array's offset into it in bytes, its shape, dtype and strides,
+    or None if array is not backed by shared memory
+    """
+
+    buffer_ = _get_buffer(array)
+    if buffer_ is None:
+        return None
+
+    offset = buffer_.offset + (array.__array_interface__["data"][0] - buffer_.__array_interface__["data"][0])
+
+    return buffer_.filename, offset, array.shape, array.dtype.str, array.strides
+
+
+def attach(reference):
+    """
+    Maps an array from shared memory without copying it. Writes to the array are seen by every process.
+    :param reference: a tuple returned by shared_reference
+    :return: a numpy array
+    """
+
+    filename, offset, shape, dtype, strides = reference
+    buffer_ = np.memmap(filename, dtype=np.uint8, mode="r+")
+
+    return np.ndarray(shape, dtype=dtype, buffer=buffer_, offset=offset, strides=strides)
+
+
+def release(array):
+    """
+    Removes the shared memory buffer of an array created by share. The array itself remains usable.
+    :param array: an array returned by share, or a view of one
+    """
+
+    buffer_ = _get_buffer(array)
+    if (buffer_ is not None) and (_owned_files.get(buffer_.filename) == os.getpid()):
+        del _owned_files[buffer_.filename]
+        os.remove(buffer_.filename)
+
+
+@atexit.register
+def _remove_owned_files():
+
+    for filename, pid in _owned_files.items():
+        if pid == os.getpid():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -1,9 +1,11 @@
 from __future__ import division, print_function
+import collections
+import hashlib
+import inspect
 import random
 import warnings
 from functools import wraps
 from matplotlib import pyplot as plt
-from scipy.signal import firwin, filtfilt, resample
 import numpy as np
 
 with warnings.catch_warnings():
@@ -20,6 +22,12 @@ except ImportError:
 from neosound.sound_manager import *
 from neosound.sound_transforms import *
 from neosound.sound_store import *
+from neosound.metrics import cached_metrics, cached_threshold, clear_metric_annotations, compute_metrics, \
+    metric_annotations, padded_level
+from neosound.dsp import design_fir, design_sos, filter_engines, magnitude_spectrum, random_phase_noise, \
+    resample_signal, spectrum_cache, zero_phase_filter
+from neosound.shared_memory import attach, share, shared_reference
+from neosound.sparse import SparseWaveform, sparsify
 
 def store_transformation(func):
     '''
@@ -27,13 +35,27 @@ def store_transformation(func):
     (transformed object, other outputs, transform metadata). The transformed object and other outputs will be
     returned and the metadata will be stored. Adding a read_only=True keyword to the function call will prevent the
     metadata from being stored.
+
+    If the manager's memoize flag is set (or a memoize=True keyword is added to the function call), a call with the
+    same parent sounds, function and arguments as an earlier one returns the earlier result instead of computing and
+    storing a duplicate. See SoundManager.memoize_mode.
     '''
 
     @wraps(func)
     def funcwrap(obj, *args, **kwargs):
         read_only = kwargs.pop("read_only", False)
+        memoize = kwargs.pop("memoize", obj.manager.memoize)
+
+        key = _memo_key(func, obj, args, kwargs) if memoize else None
+        if key is not None:
+            memoized = obj.manager.get_memoized(obj.id, key)
+            if memoized is not None:
+                return memoized
+
         try:
-            result = func(obj, *args, **kwargs)
+            # Sounds created by the transform write their annotations only if they are stored
+            with obj.manager.deferred_mode():
+                result = func(obj, *args, **kwargs)
         except UnprocessedError as e:
             # print(e)
             return obj
@@ -41,17 +63,93 @@ def store_transformation(func):
         transformed = result[0]
         metadata = result[-1]
 
+        # Only the transformed sound can be memoized, not any other outputs
+        if (key is not None) and (len(result) == 2):
+            metadata["memo_key"] = key
+        else:
+            key = None
+
         # try to write
+        stored = False
         if not read_only:
-            obj.manager.store(transformed, metadata, obj)
+            stored = obj.manager.store(transformed, metadata, obj)
+
+        if key is not None:
+            obj.manager.memoize_result(key, transformed, stored)
 
         if len(result) > 2:
             transformed = (transformed, ) + result[1: -1]
 
         return transformed
 
+    funcwrap.__wrapped__ = func
+
     return funcwrap
 
+def nondeterministic(when=None):
+    """
+    Marks a transform method whose result is random, so that store_transformation never memoizes it.
+    :param when: a function of the method's call arguments (a dictionary from inspect.getcallargs) that returns True
+    if that call is random. If None, every call is random.
+    """
+
+    def decorator(func):
+        func.nondeterministic = when or (lambda callargs: True)
+        return func
+
+    return decorator
+
+def _memo_value(value):
+    """
+    Converts an argument of a transform method to a hashable representation for its memoization key, or raises a
+    TypeError if it can't be represented. Sounds are represented by their id, so a sound that was modified in place
+    can't be.
+    """
+
+    if hasattr(value, "manager") and hasattr(value, "id"):
+        if getattr(value, "data_version", lambda: 0)():
+            raise TypeError("Cannot memoize a sound that was modified in place")
+        return ("sound", value.id)
+    elif isinstance(value, Quantity):
+        return float(value), repr(value.dim)
+    elif isinstance(value, np.ndarray):
+        return "array", value.shape, str(value.dtype), hashlib.sha1(np.ascontiguousarray(value)).hexdigest()
+    elif isinstance(value, (list, tuple)):
+        return tuple(_memo_value(vv) for vv in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((kk, _memo_value(vv)) for kk, vv in value.iteritems()))
+    elif (value is None) or isinstance(value, (bool, int, long, float, basestring, np.number)):
+        return value
+    raise TypeError("Cannot memoize argument of type %s" % type(value))
+
+def _memo_key(func, obj, args, kwargs):
+    """
+    Computes the memoization key of a call to a transform method from the parent sound, the method name and its
+    arguments, with positional and keyword arguments normalized. Calls on a sound that was modified in place aren't
+    memoized, since its id no longer identifies its waveform (see Sound.data_version).
+    :return: a key string, or None if the call can't be memoized
+    """
+
+    if obj.data_version():
+        return None
+
+    inner = func
+    while hasattr(inner, "__wrapped__"):
+        inner = inner.__wrapped__
+    callargs = inspect.getcallargs(inner, obj, *args, **kwargs)
+    callargs.pop(inspect.getargspec(inner).args[0])
+
+    random_call = getattr(func, "nondeterministic", None)
+    if (random_call is not None) and random_call(callargs):
+        return None
+
+    try:
+        normalized = _memo_value(callargs)
+    except TypeError:
+        return None
+
+    return hashlib.sha1(repr((obj.id, func.__name__, normalized))).hexdigest()
+
 def create_sound(func):
     """
     Wraps all sound creation methods so that they inherit the documentation from upstream BHSound methods
@@ -88,18 +186,65 @@ def ensure_type(func):
         if isinstance(result, tuple):
             result = list(result) # tuples are immutable. Convert to list first.
             for ii, rr in enumerate(result):
-                if isinstance(rr, (BHSound, np.ndarray)): # Why ndarray? Wouldn't it fail since I'm not providing a samplerate?
-                    result[ii] = Sound(rr, manager=obj.manager)
+                if _needs_conversion(rr, obj): # Why ndarray? Wouldn't it fail since I'm not providing a samplerate?
+                    result[ii] = _convert(rr, obj)
             result = tuple(result)
         else:
-            if isinstance(result, (BHSound, np.ndarray)):
-                result = Sound(result, manager=obj.manager)
+            if _needs_conversion(result, obj):
+                result = _convert(result, obj)
 
         return result
 
+    funcwrap.__wrapped__ = func
+
     return funcwrap
 
 
+def _modifies_waveform(func):
+    """
+    Wraps a method that modifies the waveform in place. The metrics cached in the sound's annotations and the spectra
+    cached for its id are discarded, and its data version is incremented so that caches keyed by its id aren't used
+    for it any more. See Sound.get_metrics and Sound.data_version.
+    """
+
+    def modifying(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        annotations = getattr(self, "annotations", None)
+        if annotations is not None:
+            clear_metric_annotations(annotations)
+            self._modified = True
+            self._version = getattr(self, "_version", 0) + 1
+            self._discard_spectra()
+
+        return result
+
+    return modifying
+
+
+def _needs_conversion(result, obj):
+    """
+    Checks whether a method's result must be converted to a new Sound object. Sound objects that the method already
+    created (e.g. with Sound._wrap) have their own id, so they are returned as is rather than copied again.
+    """
+
+    if isinstance(result, Sound) and (getattr(result, "id", obj.id) != obj.id):
+        return False
+
+    return isinstance(result, (BHSound, np.ndarray))
+
+
+def _convert(result, obj):
+    """
+    Converts a method's result to a new Sound object. BHSound results are new arrays, so they are wrapped without
+    copying, unless they share memory with obj.
+    """
+
+    if isinstance(result, BHSound) and not np.may_share_memory(result, obj):
+        return Sound._wrap(np.asarray(result), result.samplerate, manager=obj.manager)
+
+    return Sound(result, manager=obj.manager)
+
+
 class Sound(BHSound):
     """
     A representation of sounds that inherits and extends the wonderful brian.hears simulator.
@@ -126,6 +271,9 @@ class Sound(BHSound):
         for kw in ["manager", "initialize", "save"]:
             kwargs.pop(kw, None)
 
+        if isinstance(sound, SparseWaveform):
+            sound = sound.to_dense()
+
         return BHSound.__new__(cls, sound, *args, **kwargs)
 
     def __init__(self, sound, samplerate=None, manager=None, save=True, initialize=False, **kwargs):
@@ -137,7 +285,9 @@ class Sound(BHSound):
         :param manager: an instance of SoundManager. If None, the default manager will be used.
         :param save: If sound is a filename, whether or not to save the waveform data to the database
         :param initialize: Stores the newly created Sound object as an InitTransform
-        :param kwargs: All additional keyword arguments will be added as annotations to the sound object
+        :param kwargs: All additional keyword arguments will be added as annotations to the sound object. In the
+        manager's deferred_mode, annotations are kept in memory until the sound is stored or flush_annotations is
+        called.
         :return: an instance of Sound
         """
 
@@ -154,12 +304,14 @@ class Sound(BHSound):
         if hasattr(sound, "samplerate"):
             self.samplerate = sound.samplerate
 
-        # Initialize annotations
-        self.annotations = dict()
-        self.annotate(samplerate=float(self.samplerate),
-                      duration=float(self.duration),
-                      nchannels=float(self.nchannels),
-                      **kwargs)
+        # Initialize annotations. They are written in a single call, or later if the manager defers them.
+        self.annotations = dict(samplerate=float(self.samplerate),
+                                duration=float(self.duration),
+                                nchannels=float(self.nchannels))
+        self._deferred = True
+        self.annotate(**kwargs)
+        if not self.manager.defer_annotations:
+            self.flush_annotations()
 
         if isinstance(sound, str):
             self.annotate(original_filename=sound)
@@ -173,6 +325,102 @@ class Sound(BHSound):
             self.manager.store(self, dict(type=InitTransform))
             self.store()
 
+    @classmethod
+    def _wrap(cls, data, samplerate, manager=None):
+        """
+        Creates a Sound object from a float array of shape (nsamples, nchannels) without copying it. Its annotations
+        are written as Sound(...) writes them, i.e. deferred in the manager's deferred_mode.
+        :param data: a float numpy array of shape (nsamples, nchannels)
+        :param samplerate: the samplerate of the sound in units of hertz
+        :param manager: an instance of SoundManager. If None, the default manager will be used.
+        :return: an instance of Sound that shares data's memory
+        """
+
+        sound = data.view(cls)
+        sound.samplerate = samplerate
+        sound.__init__(sound, manager=manager)
+
+        return sound
+
+    @classmethod
+    def _attach(cls, data, id_, annotations, manager):
+        """
+        Creates a Sound object for a sound that is already in the database, without copying data, allocating a new id
+        or writing its annotations again.
+        :param data: a float numpy array of shape (nsamples, nchannels)
+        :param id_: the sound id
+        :param annotations: the sound's annotations, including its samplerate
+        :param manager: an instance of SoundManager
+        :return: an instance of Sound that shares data's memory
+        """
+
+        sound = np.asarray(data).view(cls)
+        sound.samplerate = float(annotations["samplerate"]) * hertz
+        sound.manager = manager
+        sound.id = id_
+        sound.annotations = dict(annotations)
+        sound._deferred = False
+
+        return sound
+
+    @classmethod
+    def _view(cls, data, parent):
+        """
+        Creates a Sound object from a view of the parent's waveform (e.g. a slice or a channel) without copying it.
+        The new sound gets its own id, and its annotations are computed from the view's shape and written as
+        Sound(...) writes them. The view is read-only, so that modifying it can't silently modify the parent: in-place
+        operations raise a ValueError, and out-of-place operations (e.g. sound * 2, or any transform) copy as usual.
+        Writes to the parent do show through the view, so the view doesn't cache its metrics and its data version
+        includes the parent's.
+        :param data: a numpy array that is a view of parent's waveform
+        :param parent: the Sound object that data is a view of
+        :return: an instance of Sound that shares the parent's memory
+        """
+
+        sound = data.view(cls)
+        sound.setflags(write=False)
+        sound._view_parent = parent
+        sound.samplerate = parent.samplerate
+        sound.manager = parent.manager
+        sound.id = parent.manager.get_id()
+        sound.annotations = dict(samplerate=float(parent.samplerate),
+                                 duration=len(data) / float(parent.samplerate),
+                                 nchannels=float(sound.nchannels))
+        sound._deferred = True
+        if not sound.manager.defer_annotations:
+            sound.flush_annotations()
+
+        return sound
+
+    def __reduce__(self):
+        """
+        Pickles the sound as its id, annotations, manager and waveform. The manager's store is pickled as a reference,
+        so the unpickled sound is attached to the matching store in the receiving process (see reattach_store). The
+        waveform of a shared sound is sent as a reference to its shared memory buffer instead of being copied.
+        """
+
+        reference = shared_reference(self)
+        data = np.asarray(self) if reference is None else None
+        annotations = getattr(self, "annotations", dict(samplerate=float(self.samplerate)))
+
+        return _unpickle_sound, (data, reference, getattr(self, "id", None), annotations,
+                                 getattr(self, "manager", None))
+
+    def share(self):
+        """
+        Copies the waveform into shared memory, so that pickling the sound (e.g. to send it to worker processes) only
+        sends a reference to the waveform. The buffer is removed when this process exits.
+        :return: a Sound object with the same id and annotations whose waveform is in shared memory
+        """
+
+        if shared_reference(self) is not None:
+            return self
+
+        shared = Sound._attach(share(self), self.id, self.annotations, self.manager)
+        shared._deferred = getattr(self, "_deferred", False)
+
+        return shared
+
     def annotate(self, **annotations):
         """
         Add an annotation to the sound
@@ -187,7 +435,20 @@ class Sound(BHSound):
 
         _check_annotations(annotations)
         self.annotations.update(annotations)
-        self.manager.database.store_annotations(self.id, **annotations)
+        if getattr(self, "_deferred", False):
+            return
+        if not self.manager.ephemeral:
+            self.manager.database.store_annotations(self.id, **annotations)
+
+    def flush_annotations(self):
+        """
+        Writes annotations that were deferred (see SoundManager.deferred_mode) to the database. Nothing is written
+        in ephemeral mode, and the annotations stay deferred until they can be written.
+        """
+
+        if getattr(self, "_deferred", False) and not self.manager.ephemeral:
+            self.manager.database.store_annotations(self.id, **self.annotations)
+            self._deferred = False
 
     def update_annotations(self):
         """
@@ -239,7 +500,8 @@ class Sound(BHSound):
         """
 
         if self.duration != other.duration:
-            raise ValueError("Duration of the summed sounds must be identical: %3.2f != %3.2f" % (self.duration, other.duration))
+            raise ValueError("Duration of the summed sounds must be identical: %3.2f != %3.2f" % (self.duration,
+                                                                                                  other.duration))
 
         return super(Sound, self).__add__(other)
 
@@ -252,6 +514,31 @@ class Sound(BHSound):
     __isub__ = __sub__
     __rsub__ = __sub__
 
+    # Operations that modify the waveform in place
+    __setitem__ = _modifies_waveform(BHSound.__setitem__)
+    __imul__ = _modifies_waveform(BHSound.__imul__)
+    __idiv__ = _modifies_waveform(BHSound.__idiv__)
+    __itruediv__ = _modifies_waveform(BHSound.__itruediv__)
+    __ifloordiv__ = _modifies_waveform(BHSound.__ifloordiv__)
+    __imod__ = _modifies_waveform(BHSound.__imod__)
+    __ipow__ = _modifies_waveform(BHSound.__ipow__)
+
+    def data_version(self):
+        """
+        Counts the in-place modifications of the waveform. A sound whose data version isn't 0 no longer matches what
+        its id refers to in the database, so results cached by id (spectra, memoized transforms) aren't used for it.
+        :return: an int
+        """
+
+        parent = getattr(self, "_view_parent", None)
+
+        return getattr(self, "_version", 0) + (parent.data_version() if parent is not None else 0)
+
+    def _discard_spectra(self):
+
+        uid = getattr(self.manager.database, "uid", None)
+        spectrum_cache.discard(lambda key: key[:2] == (uid, self.id))
+
     def _round_time(self, time):
         """
         Rounds time to the nearest sample
@@ -301,78 +588,277 @@ class Sound(BHSound):
                         parents=[self.id, other.id])
         return summed, metadata
 
+    @staticmethod
+    def mix(sounds, offsets=None, gains=None, duration=None, read_only=False):
+        """
+        Mixes any number of sounds into a single sound, as a chain of pad, scale and combine calls would, but each
+        sound is added at its offset directly into one output buffer and the result is stored as a single
+        MixTransform with every sound as a parent.
+
+        Example:
+        scene = Sound.mix([talker1, talker2, noise], offsets=[0.5*second, 1*second, 0*second],
+                          gains=[1, 0.5, -10*dB])
+        :param sounds: a list of Sound objects with the same samplerate and number of channels
+        :param offsets: the start time of each sound in the mix (all 0 seconds)
+        :param gains: a scale factor or level change in dB for each sound, or a tuple with one for each channel (all 1)
+        :param duration: the duration of the mix. Sounds that extend past it are cut off. (the end of the last sound)
+        :param read_only: if True, the transformation is not stored (False)
+        :return: the mixed Sound object
+        """
+
+        if not len(sounds):
+            raise ValueError("Cannot mix an empty list of sounds")
+
+        template = sounds[0]
+        for sound in sounds[1:]:
+            if (sound.samplerate != template.samplerate) or (sound.nchannels != template.nchannels):
+                raise ValueError("All mixed sounds must have the same samplerate and number of channels")
+
+        if offsets is None:
+            offsets = [0 * second] * len(sounds)
+        if gains is None:
+            gains = [1.0] * len(sounds)
+        if (len(offsets) != len(sounds)) or (len(gains) != len(sounds)):
+            raise ValueError("Must provide one offset and one gain for each of the %d sounds" % len(sounds))
+
+        samplerate = float(template.samplerate)
+        starts = [int(np.rint(float(offset) * samplerate)) for offset in offsets]
+        if min(starts) < 0:
+            raise ValueError("Offsets must not be negative")
+        if duration is None:
+            nsamples = max(start + sound.nsamples for start, sound in zip(starts, sounds))
+        else:
+            nsamples = int(np.rint(float(duration) * samplerate))
+
+        gains = [gain.gain() if isinstance(gain, dB_type) else gain for gain in gains]
+        gains = np.array([np.broadcast_to(np.asarray(gain, dtype=float), (template.nchannels,)) for gain in gains])
+        if np.all(gains == gains[:, :1]):
+            gains = gains[:, 0]
+
+        metadata = dict(type=MixTransform,
+                        offsets=[start / samplerate for start in starts],
+                        gains=gains,
+                        duration=nsamples / samplerate,
+                        parents=[sound.id for sound in sounds])
+
+        mixed = MixTransform.accumulate([np.asarray(sound) for sound in sounds], metadata, samplerate)
+        mixed = Sound._wrap(mixed, template.samplerate, manager=template.manager)
+        if not read_only:
+            template.manager.store(mixed, metadata)
+
+        return mixed
+
+    @staticmethod
+    def concatenate(sounds, gaps=0*second, read_only=False):
+        """
+        Concatenates sounds one after another, with silent gaps between them, into one preallocated buffer. The
+        result is stored as a single ConcatenateTransform that records where each sound starts, so that any part of
+        it can later be reconstructed from just the sounds it overlaps (see SoundManager.reconstruct_segment).
+
+        Example:
+        session = Sound.concatenate(stimuli, gaps=2*second)
+        :param sounds: a list of Sound objects with the same samplerate and number of channels. The same sound can
+        appear more than once.
+        :param gaps: the silence between consecutive sounds, or a list with one for each pair of consecutive sounds
+        (0 seconds)
+        :param read_only: if True, the transformation is not stored (False)
+        :return: the concatenated Sound object
+        """
+
+        if not len(sounds):
+            raise ValueError("Cannot concatenate an empty list of sounds")
+
+        template = sounds[0]
+        for sound in sounds[1:]:
+            if (sound.samplerate != template.samplerate) or (sound.nchannels != template.nchannels):
+                raise ValueError("All concatenated sounds must have the same samplerate and number of channels")
+
+        if np.ndim(gaps) == 0:
+            gaps = [gaps] * (len(sounds) - 1)
+        if len(gaps) != len(sounds) - 1:
+            raise ValueError("Must provide one gap for each of the %d pairs of sounds" % (len(sounds) - 1))
+
+        samplerate = float(template.samplerate)
+        gaps = [int(np.rint(float(gap) * samplerate)) for gap in gaps]
+        if len(gaps) and (min(gaps) < 0):
+            raise ValueError("Gaps must not be negative")
+        lengths = [sound.nsamples for sound in sounds]
+        starts = np.cumsum([0] + [length + gap for length, gap in zip(lengths[:-1], gaps)])
+
+        metadata = dict(type=ConcatenateTransform,
+                        starts=starts.astype(np.int64),
+                        nsamples=int(starts[-1] + lengths[-1]),
+                        parents=[sound.id for sound in sounds])
+
+        concatenated = ConcatenateTransform.render([np.asarray(sound) for sound in sounds], metadata)
+        concatenated = Sound._wrap(concatenated, template.samplerate, manager=template.manager)
+        if not read_only:
+            template.manager.store(concatenated, metadata)
+
+        return concatenated
+
     @store_transformation
     @ensure_type
-    def filter(self, frequency_range, filter_order=None):
+    def filter(self, frequency_range, filter_order=None, engine="filtfilt", design="butter", ripple=0.1,
+               attenuation=60.):
         '''
         Filters the sound within a particular frequency range. Depending on the values supplied, a lowpass, highpass,
-        or bandpass filter will be supplied.
+        or bandpass filter will be supplied. The filter is applied forwards and backwards, so there is no phase
+        distortion.
         :param frequency_range: A two element list or tuple with the low and high end of the desired frequency range.
-        :param filter_order: The order of the filter. To be supplied to firwin. Defaults to 512 if nsamples > 3 *
-        512, 64 if nsamples > 3 * 64, else 16. Value cannot be greater than nsamples / 3.
+        :param filter_order: The order of the filter. For the FIR engines, the number of taps supplied to firwin.
+        Defaults to 512 if nsamples > 3 * 512, 64 if nsamples > 3 * 64, else 16. Value cannot be greater than
+        nsamples / 3. For the "sos" engine, the order of the IIR filter. Defaults to 4.
+        :param engine: "filtfilt" applies an FIR filter in direct form, which is exact but O(nsamples * order).
+        "fft" applies the same FIR filter by FFT convolution, which is much faster for long sounds and high orders
+        and agrees with "filtfilt" to within rounding error. "sos" applies an IIR filter as second-order sections.
+        ("filtfilt")
+        :param design: the IIR design for the "sos" engine: "butter" or "ellip" ("butter")
+        :param ripple: the maximum passband ripple in dB of an elliptic design (0.1)
+        :param attenuation: the minimum stopband attenuation in dB of an elliptic design (60)
         :return: The filtered Sound object
         '''
 
-        # TODO: Add additional filter types and documentation on how the filtering is done.
+        coefficients, metadata = self._design_filter(self.nsamples, self.nyquist_frequency, frequency_range,
+                                                     filter_order, engine=engine, design=design, ripple=ripple,
+                                                     attenuation=attenuation)
+
+        # Filter the sound
+        data = zero_phase_filter(coefficients, self, engine=engine)
+
+        return data, metadata
+
+    @staticmethod
+    def _design_filter(nsamples, nyquist_frequency, frequency_range, filter_order=None, engine="filtfilt",
+                       design="butter", ripple=0.1, attenuation=60.):
+        """
+        Designs the filter for Sound.filter for a sound with nsamples samples and the given nyquist frequency (in
+        hertz). Designs are cached and shared between sounds (see neosound.dsp.filter_design_cache).
+        :return: the filter coefficients and the transformation metadata
+        """
+
+        if engine not in filter_engines:
+            raise ValueError("Unknown filter engine %s. Must be one of %s" % (engine, ", ".join(filter_engines)))
 
         if filter_order is None:
-            if self.nsamples > 3 * 512:
+            if engine == "sos":
+                filter_order = 4
+            elif nsamples > 3 * 512:
                 filter_order = 512
-            elif self.nsamples > 3 * 64:
+            elif nsamples > 3 * 64:
                 filter_order = 64
             else:
                 filter_order = 16
 
-        if filter_order * 3 >= self.nsamples:
+        if (engine != "sos") and (filter_order * 3 >= nsamples):
             raise ValueError("filter_order cannot be greater than nsamples / 3: 3 * %d > %d" % (filter_order,
-                                                                                                self.nsamples))
+                                                                                                nsamples))
 
         if len(frequency_range) == 2:
-           if frequency_range[1] > self.nyquist_frequency:
-               raise ValueError("frequency_range[1] cannot be greater than the nyquist frequency: %d" % self.nyquist_frequency)
+           if frequency_range[1] > nyquist_frequency:
+               raise ValueError("frequency_range[1] cannot be greater than the nyquist frequency: %d" %
+                                nyquist_frequency)
         else:
             raise ValueError("frequency_range must have two elements")
 
         if frequency_range[0] == 0: # This is a lowpass filter
-            if frequency_range[1] < self.nyquist_frequency:
-                lowpass = True
-                frequency_range = frequency_range[1]
+            if frequency_range[1] < nyquist_frequency:
+                btype = "lowpass"
+                cutoff = frequency_range[1]
             else: # No filtering should be done
                 raise UnprocessedError("No filtering is necessary")
-        elif frequency_range[1] == self.nyquist_frequency: # This is a highpass filter
-            lowpass = False
-            frequency_range = frequency_range[0]
+        elif frequency_range[1] == nyquist_frequency: # This is a highpass filter
+            btype = "highpass"
+            cutoff = frequency_range[0]
         else: # This is a bandpass filter
-            lowpass = False
-
-        # Compute the filter
-        b = firwin(filter_order, frequency_range, nyq=self.nyquist_frequency,
-                   pass_zero=lowpass, window="hamming", scale=False)
-        a = np.zeros(b.shape)
-        a[0] = 1
-
-        # Filter the sound
-        data = filtfilt(b, a, self, axis=0)
+            btype = "bandpass"
+            cutoff = frequency_range
 
         metadata = dict(type=FilterTransform,
                         min_frequency=float(frequency_range[0]),
                         max_frequency=float(frequency_range[1]),
-                        order=filter_order)
-        return data, metadata
+                        order=filter_order,
+                        engine=engine)
+
+        # Compute the filter
+        if engine == "sos":
+            metadata["design"] = design
+            if design == "ellip":
+                metadata["ripple"] = float(ripple)
+                metadata["attenuation"] = float(attenuation)
+            coefficients = design_sos(filter_order, cutoff, nyquist_frequency, btype, design=design,
+                                      ripple=ripple, attenuation=attenuation)
+        else:
+            # A highpass filter passes the nyquist frequency, so firwin requires an odd number of taps
+            numtaps = filter_order
+            if (btype == "highpass") and (numtaps % 2 == 0):
+                numtaps += 1
+            coefficients = design_fir(numtaps, cutoff, nyquist_frequency, pass_zero=(btype == "lowpass"),
+                                      window="hamming")
+
+        return coefficients, metadata
+
+    @staticmethod
+    def filter_many(sounds, frequency_range, filter_order=None, read_only=False, **kwargs):
+        """
+        Filters many sounds at once, as Sound.filter would filter each of them. Sounds with the same samplerate and
+        number of samples share a single filter design and are filtered together in one pass.
+        :param sounds: a list of Sound objects
+        :param frequency_range: A two element list or tuple with the low and high end of the desired frequency range.
+        :param filter_order: The order of the filter. See Sound.filter.
+        :param read_only: if True, the transformations are not stored (False)
+        :param kwargs: the engine and design arguments of Sound.filter
+        :return: a list of the filtered Sound objects, in the same order as sounds
+        """
+
+        groups = collections.OrderedDict()
+        for ii, sound in enumerate(sounds):
+            groups.setdefault((float(sound.samplerate), sound.nsamples), list()).append(ii)
+
+        filtered = list(sounds)
+        for indices in groups.itervalues():
+            template = sounds[indices[0]]
+            try:
+                coefficients, metadata = Sound._design_filter(template.nsamples, template.nyquist_frequency,
+                                                              frequency_range, filter_order, **kwargs)
+            except UnprocessedError:
+                continue
+
+            # Filter every channel of every sound in the group in a single pass
+            data = zero_phase_filter(coefficients, np.hstack([np.asarray(sounds[ii]) for ii in indices]),
+                                     engine=metadata["engine"])
+            offset = 0
+            for ii in indices:
+                sound = sounds[ii]
+                result = Sound(data[:, offset: offset + sound.nchannels], samplerate=sound.samplerate,
+                               manager=sound.manager)
+                offset += sound.nchannels
+                if not read_only:
+                    sound.manager.store(result, dict(metadata), sound)
+                filtered[ii] = result
+
+        return filtered
 
     @store_transformation
     @ensure_type
     def get_channel(self, n):
         """
-        Returns the specified channel of the sound
+        Returns the specified channel of the sound. The channel is a read-only view that shares the sound's waveform
+        (see Sound._view), so writing to it raises a ValueError. Any transform of the channel, e.g. .scale(1), gives
+        a copy that can be modified.
         """
 
+        if not -self.nchannels <= n < self.nchannels:
+            raise IndexError("Sound has %d channels, cannot get channel %d" % (self.nchannels, n))
+        n %= self.nchannels
+
         metadata = dict(type=ChannelTransform,
                         channel=n)
-        return self.channel(n), metadata
+        return Sound._view(np.asarray(self)[:, n: n + 1], self), metadata
 
     @store_transformation
     @ensure_type
+    @nondeterministic(when=lambda callargs: callargs["start"] is None)
     def pad(self, duration, start=None, max_start=None, min_start=0*second):
         '''
         Pads the sound with silence. All units are in seconds.
@@ -396,15 +882,16 @@ class Sound(BHSound):
         duration = self._round_time(duration)
         start = self._round_time(start)
 
-        # Pad the end of the sound
-        stop = start + self.duration
-        padded = self.extended(duration - stop)
-
         metadata = dict(type=PadTransform,
                         start_time=float(start),
                         duration=float(duration))
-        # Pad the start of the sound and return
-        return padded.shifted(start), metadata
+
+        # Copy the sound into the padded sound in one pass, rather than extending its end and then shifting its start
+        nsamples, first, last, offset = PadTransform.layout(metadata, float(self.samplerate), self.nsamples)
+        padded = np.zeros((nsamples, self.nchannels))
+        padded[first: last] = np.asarray(self)[first + offset: last + offset]
+
+        return Sound._wrap(padded, self.samplerate, manager=self.manager), metadata
 
     @store_transformation
     @ensure_type
@@ -452,12 +939,10 @@ class Sound(BHSound):
         stop = self._round_time(stop)
 
         if (stop - start) != other.duration:
-            raise ValueError("stop - start should be the same as the other sounds' duration. %3.2f != %3.2f" % (stop
-                                                                                                                -
-                                                                                                                start,
-                                                                                                                other.duration))
+            raise ValueError("stop - start should be the same as the other sounds' duration. %3.2f != %3.2f" %
+                             (stop - start, other.duration))
 
-        new = Sound(self)
+        new = Sound._wrap(np.array(self), self.samplerate, manager=self.manager)
         new[start: stop] = other
 
         metadata = dict(type=SetTransform,
@@ -470,16 +955,21 @@ class Sound(BHSound):
     @ensure_type
     def resample(self, samplerate=None, resample_type="sinc_best"):
         """
-        Returns a resampled version of the sound using scipy.signal.resample.
+        Returns a resampled version of the sound.
         :param samplerate: desired output samplerate in hertz
-        :param resample_type: the type of resampling. See scipy.signal.resample documentation ("sinc_best")
+        :param resample_type: the resampling engine. "polyphase" uses a rational polyphase filter
+        (scipy.signal.resample_poly) and is the fastest for common samplerate conversions. "stream" gives the same
+        result as "polyphase" while only filtering a block of the sound at a time. "fft" uses scipy.signal.resample
+        on the whole sound, which is slow for lengths with large prime factors. "sinc_best" is the same as "fft", for
+        compatibility with previously stored sounds. ("sinc_best")
         :return: A resampled Sound object
         """
 
         if (samplerate == self.samplerate) or (samplerate is None):
             raise UnprocessedError("Samplerate is already %.1f" % samplerate)
 
-        resampled = resample(self, int(samplerate * self.duration))
+        engine = "fft" if resample_type == "sinc_best" else resample_type
+        resampled = resample_signal(self, float(self.samplerate), float(samplerate), engine=engine)
         resampled = Sound(resampled, samplerate=samplerate, manager=self.manager)
 
         metadata = dict(type=ResampleTransform,
@@ -508,7 +998,9 @@ class Sound(BHSound):
     @ensure_type
     def slice(self, start, stop=None):
         """
-        Returns a section of the sound from start to stop
+        Returns a section of the sound from start to stop. Sections within the sound are read-only views that share
+        the sound's waveform (see Sound._view), so writing to them raises a ValueError. Any transform of the section,
+        e.g. .scale(1), gives a copy that can be modified. Sections that extend past either end are padded with zeros.
         :param start: starting time in seconds
         :param stop: stopping time in seconds (sound duration)
         :return: Sound object of the sliced segment
@@ -519,7 +1011,14 @@ class Sound(BHSound):
 
         start = self._round_time(start)
         stop = self._round_time(stop)
-        sliced = self[start: stop]
+
+        # Same sample indices as the time-based indexing of self[start: stop], which treats a stop of 0 as unspecified
+        first = int(np.rint(start * self.samplerate))
+        last = int(np.rint((stop or self.duration) * self.samplerate))
+        if (first >= 0) and (last <= self.nsamples):
+            sliced = Sound._view(np.asarray(self)[first: max(last, first)], self)
+        else:
+            sliced = self[start: stop]
 
         metadata = dict(type=SliceTransform,
                         start_time=float(start),
@@ -553,17 +1052,28 @@ class Sound(BHSound):
     @property
     def components(self):
 
-        components = list()
-        for root_id in self.roots:
-            component_id = self.manager.database.filter_ids(transform_id=self.id,
-                                                           transform_root_id=root_id)
-            components.extend(component_id)
+        metadata = self.manager.database.get_metadata(self.id)
+        index = dict(zip(metadata.get("component_roots", list()), metadata.get("component_ids", list())))
+
+        return [index[root_id] for root_id in self.roots if root_id in index]
+
+    def get_components(self, store=True):
+        """
+        Reconstructs all of the components of the sound in a single pass through its lineage.
+        :param store: if True, store the transformation metadata of each component (True)
+        :return: a list of Sound objects, one for each root of the sound
+        """
 
-        return components
+        return self.manager.reconstruct_components(self.id, store=store)
 
+    @store_transformation
+    @ensure_type
+    @nondeterministic(when=lambda callargs: callargs["start"] is None)
     def embed(self, other, start=None, max_start=None, min_start=0*second, ratio=None):
         '''
-        Embeds the current Sound object in other at a prespecified or random time.
+        Embeds the current Sound object in other at a prespecified or random time. This is the same as padding both
+        sounds to the same duration, setting the level of other and combining them, but the result is computed in a
+        single buffer and stored as a single EmbedTransform.
         :param other: A Sound object into which the current Sound object will be embedded
         :param start: Prespecified start time for the Sound object in embedded Sound object
         :param min_start, max_start: Start time will be chosen from a uniform distribution between these two values
@@ -579,18 +1089,87 @@ class Sound(BHSound):
 
         stop = start + self.duration
         duration = max(stop, other.duration)
-        padded = self.pad(duration, start=start)
-        other = other.pad(duration, start=0*second)
+        metadata = dict(type=EmbedTransform,
+                        start_time=float(self._round_time(start)),
+                        duration=float(self._round_time(duration)),
+                        parents=[self.id, other.id])
+
+        nsamples, spans = EmbedTransform.layout(metadata, float(self.samplerate), self.nsamples, other.nsamples)
+        (first, last, offset), (other_first, other_last, other_offset) = spans
+        data = np.asarray(self)[first + offset: last + offset]
+        other_data = np.asarray(other)[other_first + other_offset: other_last + other_offset]
 
+        gain = 1.0
+        # Match the levels of the padded sounds, as other.set_level would, unless other is silent
         if ratio is not None:
-            other = other.set_level(padded.level - ratio)
+            other_metrics = other._embedded_metrics(other_data)
+            if np.any(other_metrics["peak"] > 0):
+                level = padded_level(self._embedded_metrics(data), len(data), nsamples) - float(ratio)
+                gain = 10 ** ((level - padded_level(other_metrics, len(other_data), nsamples)) / 20.)
+                gain = float(gain) if self.nchannels == 1 else gain.reshape((1, self.nchannels))
+        metadata["gain"] = gain
+
+        embedded = np.zeros((nsamples, self.nchannels))
+        embedded[first: last] = data
+        embedded[other_first: other_last] += gain * other_data
+
+        return Sound._wrap(embedded, self.samplerate, manager=self.manager), metadata
+
+    def _embedded_metrics(self, data):
+        """
+        Gets the metrics of the part of the sound in data. The cached metrics are used when it is the whole sound.
+        """
 
-        return padded.combine(other)
+        if len(data) == self.nsamples:
+            return self.get_metrics()
+
+        return compute_metrics(data)
 
     # def envelope(self, min_power=0*dB):
     #
     #     env = np.abs(np.asarray(self))
 
+    def get_metrics(self, silence_threshold=.1):
+        """
+        Gets the peak, mean, RMS, level and nonsilent power of each channel, computed in a single pass and cached
+        in the sound's annotations for the default silence threshold. See neosound.metrics. In-place operators and
+        item assignment discard the cache, and the metrics of a waveform that was modified in place are only cached in
+        memory until the sound is stored. Views (see Sound._view) never cache their metrics, since their parent can
+        be modified. Writes through other arrays that share the waveform's memory (e.g. np.asarray(sound)) aren't
+        detected.
+        :param silence_threshold: fraction of max value below which the sound should be considered silent (0.1)
+        :return: a dictionary of arrays with one value per channel
+        """
+
+        annotations = getattr(self, "annotations", None)
+        if (annotations is None) or (getattr(self, "_view_parent", None) is not None):
+            # e.g. the result of arithmetic on a sound, or a view
+            return compute_metrics(self, silence_threshold=silence_threshold)
+
+        metrics = cached_metrics(annotations, silence_threshold)
+        if metrics is None:
+            metrics = compute_metrics(self, silence_threshold=silence_threshold)
+            if float(silence_threshold) != cached_threshold:
+                return metrics
+            if getattr(self, "_modified", False):
+                annotations.update(metric_annotations(metrics))
+            else:
+                self.annotate(**metric_annotations(metrics))
+
+        return metrics
+
+    def get_level(self):
+        """
+        Returns level in dB SPL (RMS) assuming array is in Pascals. In the case of multi-channel sounds, returns an
+        array of levels for each channel, otherwise returns a float.
+        """
+
+        level = self.get_metrics()["level"]
+        if self.nchannels == 1:
+            return float(level[0]) * dB
+
+        return level
+
     def get_power_nonsilence(self, silence_threshold=.1):
         """
         Gets the total amount of power in the nonsilent regions of the sound.
@@ -598,19 +1177,7 @@ class Sound(BHSound):
         :return: power
         """
 
-        waveform = np.abs(np.asarray(self))
-        range = waveform.max() * silence_threshold
-        power = list()
-        for ii in xrange(self.nchannels):
-            arr = waveform[:, ii].squeeze()
-            d = np.diff(arr)
-            inds = np.where(np.all(np.vstack([arr[1:-1] > range,
-                                              d[:-1] > 0,
-                                              d[1:] < 0]),
-                                   axis=0))[0]
-            power.append((arr[1:-1][inds] ** 2).mean())
-
-        return power
+        return list(self.get_metrics(silence_threshold)["power_nonsilence"])
 
     def play(self):
         """
@@ -665,7 +1232,7 @@ class Sound(BHSound):
         """
 
         # Sound is silent. Scaling it would result in breakage.
-        if not np.any(self.asarray() != 0):
+        if not np.any(self.get_metrics()["peak"] > 0):
             raise UnprocessedError("Sound is silent")
 
         rms_dB = self.get_level()
@@ -687,8 +1254,38 @@ class Sound(BHSound):
 
     def store(self):
 
-        self.manager.database.store_data(self.id, np.asarray(self))
+        if self.manager.ephemeral:
+            return
+
+        # The metrics and spectra that were cached for the stored waveform are replaced if it was modified in place
+        if getattr(self, "_modified", False):
+            self.get_metrics()
+            self._discard_spectra()
+        # Waveforms that are mostly silence are stored as a SparseWaveform
+        self.manager.database.store_data(self.id, sparsify(np.asarray(self)))
         self.manager.database.store_annotations(self.id, **self.annotations)
+        self._deferred = False
+        self._modified = False
+
+    def to_sparse(self, min_gap=256):
+        """
+        Gets the waveform as a SparseWaveform, which only keeps the segments that are not silent.
+        :param min_gap: the shortest run of zeros that splits a segment. See SparseWaveform.from_dense. (256)
+        :return: a SparseWaveform
+        """
+
+        return SparseWaveform.from_dense(np.asarray(self), min_gap=min_gap)
+
+    def commit(self, **annotations):
+        """
+        Writes the sound to the database as a new root, even if its manager is in ephemeral mode.
+        :param annotations: additional annotations to add to the sound before it is written
+        :return: True if the sound was stored, else False
+        """
+
+        self.annotate(**annotations)
+
+        return self.manager.commit(self)
 
     def trim(self, duration, trim_from="end", max_start=None, min_start=0*second):
         '''
@@ -760,38 +1357,82 @@ class Sound(BHSound):
     @staticmethod
     @create_sound
     def spectrum_matched_noise(spectrum, samplerate=44100*hertz, manager=SoundManager(), save=True):
+        """
+        Generates noise with the magnitude spectrum of a real waveform and random phases.
+        :param spectrum: the full FFT of a waveform, of shape (n, nchannels) or (n,). Only the first n // 2 + 1 bins
+        are used, since the rest mirror them.
+        :param samplerate: the samplerate of the noise in units of hertz (44100 Hz)
+        :return: a Sound object with n samples
+        """
 
         if len(spectrum.shape) == 1:
             spectrum = np.reshape(spectrum, (-1, 1))
 
-        mag = np.abs(spectrum)
-        mag[0] = 0  #Set the DC component to 0
-        n = len(mag)
-        n2 = int(n / 2)
-        phase = np.zeros(mag.shape, dtype=complex)
-        if n % 2 == 1:
-            phase[1: n2 + 1, :] = np.exp(1j * np.random.uniform(-np.pi, np.pi, (n2, phase.shape[1])))
-            phase[n2 + 1:, :] = np.flipud(np.conj(phase[1: n2 + 1, :]))
-        else:
-            phase[1: n2, :] = np.exp(1j * np.random.uniform(-np.pi, np.pi, (n2 - 1, phase.shape[1])))
-            phase[n2 + 1:, :] = np.flipud(np.conj(phase[1: n2, :]))
+        nsamples = len(spectrum)
+        noise = random_phase_noise(np.abs(spectrum[:nsamples // 2 + 1]), nsamples)[0]
 
-        z = mag * phase
-        noise = Sound(np.fft.ifft(z, axis=0).real, samplerate=samplerate, manager=manager)
+        return Sound(noise, samplerate=samplerate, manager=manager)
 
-        return noise
+    def to_spectrum_matched_noise(self, duration=None, ntokens=None):
+        """
+        Generates noise with the same magnitude spectrum and level as the sound. The spectrum is computed once per
+        sound and FFT length and kept in dsp.spectrum_cache, so each further token only costs an inverse FFT. Each
+        token is stored as a SpectrumMatchedNoiseTransform of the sound with its random seed, so it can be
+        reconstructed without storing its data.
+        :param duration: the duration of the noise (the sound's duration)
+        :param ntokens: the number of independent tokens to generate at once. If None, a single Sound is returned.
+        :return: a Sound object, or a SoundBatch of ntokens sounds
+        """
+        from neosound.sound_batch import SoundBatch
 
-    def to_spectrum_matched_noise(self, duration=None):
+        if (ntokens is not None) and (ntokens < 1):
+            raise ValueError("ntokens must be at least 1, not %s" % ntokens)
 
         if duration is None:
             duration = self.duration
+        duration = self._round_time(duration)
+        nsamples = int(round(float(duration) * float(self.samplerate)))
+
+        seeds = [int(seed) for seed in np.random.randint(0, 2 ** 31 - 1, ntokens or 1)]
+        batch = SoundBatch(self._spectrum_matched_tokens(nsamples, seeds),
+                           self.samplerate,
+                           manager=self.manager,
+                           ids=[self.manager.get_id() for seed in seeds])
+        self.manager.store_many([(id_, dict(type=SpectrumMatchedNoiseTransform,
+                                            parents=[self.id],
+                                            duration=float(duration),
+                                            seed=seed), batch._annotations())
+                                 for id_, seed in zip(batch.ids, seeds)])
+
+        return batch if ntokens is not None else batch[0]
+
+    def _spectrum_matched_tokens(self, nsamples, seeds):
+        """
+        Generates tokens of noise with the magnitude spectrum and level of the sound, one for each random seed
+        :param nsamples: the number of samples in each token
+        :param seeds: a list of random seeds
+        :return: an array of shape (len(seeds), nsamples, nchannels)
+        """
+
+        # The whole sound, padded with zeros to a power of 2 at least as long as the noise. The spectrum of a
+        # waveform that was modified in place isn't cached, since the cache is keyed by id.
+        nfft = int(2 ** np.ceil(np.log2(max(nsamples, self.nsamples, 1))))
+        if self.data_version():
+            magnitude = magnitude_spectrum(self, nfft)
+        else:
+            key = (getattr(self.manager.database, "uid", None), self.id, nfft)
+            magnitude = spectrum_cache.get(key, lambda: magnitude_spectrum(self, nfft))
 
-        next2 = lambda x: 2 ** (np.ceil(np.log2(x)))
-        pad_duration = next2(int(duration * self.samplerate)) * self.sampleperiod
-        spectrum = np.fft.fft(self.pad(pad_duration, start=0*second), axis=0)
+        noise = np.ascontiguousarray(random_phase_noise(magnitude, nfft, seeds=seeds)[:, :nsamples])
 
-        return Sound.spectrum_matched_noise(spectrum, samplerate=self.samplerate, manager=self.manager).slice(
-            0*second, duration).set_level(self.level)
+        # Match the level of each channel, as set_level would
+        rms = np.sqrt(np.mean((noise - np.mean(noise, axis=1, keepdims=True)) ** 2, axis=1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = 10 ** ((self.get_metrics()["level"] - 20.0 * np.log10(rms / 2e-5)) / 20.)
+        gain[~np.isfinite(gain)] = 1
+        noise *= gain[:, np.newaxis, :]
+
+        return noise
 
     @classmethod
     @create_sound
@@ -870,6 +1511,120 @@ class Sound(BHSound):
         return super(Sound, cls).irns(*args, **kwargs)
 
 
+def _unpickle_sound(data, reference, id_, annotations, manager):
+
+    if reference is not None:
+        data = attach(reference)
+    if manager is None:
+        manager = SoundManager()
+
+    return Sound._attach(data, id_, annotations, manager)
+
+
+class LazySound(object):
+    """
+    A handle to a sound in the database that carries its id, annotations and transformation metadata, but only
+    reconstructs the waveform when the data is first accessed. Any attribute that is not available from the database
+    is looked up on the reconstructed Sound object, so a LazySound can be used wherever a Sound is read.
+    """
+
+    # Custom properties
+    samplerate = property(fget=lambda self: float(self.annotations["samplerate"]) * hertz,
+                          doc="The samplerate of the sound in hertz.")
+    duration = property(fget=lambda self: float(self.annotations["duration"]) * second,
+                        doc="The duration of the sound in seconds.")
+    nchannels = property(fget=lambda self: int(self.annotations["nchannels"]),
+                         doc="The number of channels in the sound.")
+    nsamples = property(fget=lambda self: int(np.rint(self.duration * self.samplerate)),
+                        doc="The number of samples in the sound.")
+    ncomponents = property(fget=lambda self: len(self.roots),
+                           doc="Number of components of this sound.")
+    roots = property(fget=lambda self: self.manager.get_roots(self.id),
+                     doc="The ids for each root component of this sound.")
+    loaded = property(fget=lambda self: self._sound is not None,
+                      doc="True if the waveform has already been reconstructed.")
+
+    def __init__(self, id_, manager=None):
+        """
+        Creates a LazySound object for a sound that is already in the database.
+        :param id_: the sound id
+        :param manager: an instance of SoundManager. If None, the default manager will be used.
+        """
+
+        if manager is None:
+            manager = SoundManager()
+
+        self.id = id_
+        self.manager = manager
+        self._annotations = None
+        self._metadata = None
+        self._sound = None
+
+    @property
+    def annotations(self):
+        """
+        The annotations of the sound, read from the database the first time they are requested.
+        """
+
+        if self._annotations is None:
+            self._annotations = self.manager.database.get_annotations(self.id)
+
+        return self._annotations
+
+    def detail(self):
+        """
+        Returns the transformation metadata that led to this sound object without reconstructing it.
+        :return: dictionary of transformation metadata
+        """
+
+        if self._metadata is None:
+            self._metadata = self.manager.get_transformation_metadata(self.id)
+
+        return self._metadata
+
+    def load(self):
+        """
+        Reconstructs the waveform if it has not been already.
+        :return: the reconstructed Sound object
+        """
+
+        if self._sound is None:
+            self._sound = self.manager.reconstruct(self.id)
+
+        return self._sound
+
+    def asarray(self):
+        """
+        Get the waveform data for the sound as a numpy array.
+        """
+
+        return self.load().asarray()
+
+    def __array__(self, dtype=None):
+
+        return np.asarray(self.load(), dtype=dtype)
+
+    def __len__(self):
+
+        return self.nsamples
+
+    def __getitem__(self, key):
+
+        return self.load()[key]
+
+    def __getattr__(self, name):
+
+        # Only called for attributes that aren't found on the LazySound
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+
+        return "LazySound(id=%s, duration=%s, loaded=%s)" % (self.id, self.duration, self.loaded)
+
+
 class UnprocessedError(Exception):
     pass
 
@@ -0,0 +1,247 @@
+from __future__ import division
+import numpy as np
+from brian import hertz, msecond
+from brian.hears import dB_type, dB_error
+
+from neosound.sound import Sound
+from neosound.sound_manager import SoundManager
+from neosound.sound_transforms import ClipTransform, InitTransform, MultiplyTransform, RampTransform
+from neosound.sparse import sparsify
+
+
+class SoundBatch(object):
+    """
+    A stack of sounds with the same samplerate, length and number of channels, held in a single array of shape
+    (nsounds, nsamples, nchannels). Transforms are applied to every member at once with vectorized numpy operations,
+    while each member is still recorded in the database as its own sound, exactly as the corresponding Sound method
+    would record it. The records for all members are written together.
+
+    Example:
+    batch = SoundBatch.from_sounds(sounds)
+    batch = batch.ramp(duration=20 * msecond).set_level(60 * dB).clip(0.5)
+    sounds = batch.to_sounds()
+    """
+
+    def __init__(self, data, samplerate, manager=None, ids=None, initialize=False):
+        """
+        Creates a batch of sounds. If no ids are given, each member is a new sound, annotated as Sound(...) would
+        annotate it.
+        :param data: an array of shape (nsounds, nsamples, nchannels), or (nsounds, nsamples) for mono sounds
+        :param samplerate: the samplerate of the sounds in units of hertz
+        :param manager: an instance of SoundManager. If None, the default manager will be used.
+        :param ids: the id of each member, if they are already sounds in the database
+        :param initialize: Stores each new member as an InitTransform, with its data (False)
+        """
+
+        data = np.asarray(data, dtype=float)
+        if data.ndim == 2:
+            data = data[:, :, np.newaxis]
+        if data.ndim != 3:
+            raise ValueError("data must have shape (nsounds, nsamples, nchannels)")
+
+        self.data = data
+        self.samplerate = samplerate
+        self.manager = manager if manager is not None else SoundManager()
+
+        if ids is not None:
+            self.ids = list(ids)
+            return
+
+        self.ids = [self.manager.get_id() for ii in xrange(len(data))]
+        if not self.manager.ephemeral:
+            with self.manager.database.batch():
+                for id_ in self.ids:
+                    self.manager.database.store_annotations(id_, **self._annotations())
+            if initialize:
+                self.manager.store_many([(id_, dict(type=InitTransform, parents=list()), self._annotations())
+                                         for id_ in self.ids])
+                self.store()
+
+    nsounds = property(fget=lambda self: self.data.shape[0],
+                       doc="The number of sounds in the batch.")
+    nsamples = property(fget=lambda self: self.data.shape[1],
+                        doc="The number of samples in each sound.")
+    nchannels = property(fget=lambda self: self.data.shape[2],
+                         doc="The number of channels in each sound.")
+    duration = property(fget=lambda self: self.nsamples / self.samplerate,
+                        doc="The duration of each sound.")
+
+    @classmethod
+    def from_sounds(cls, sounds):
+        """
+        Stacks Sound objects into a batch. The members keep the ids of the sounds, so transforming the batch records
+        each result as a child of the corresponding sound.
+        :param sounds: a list of Sound objects with the same samplerate, length and number of channels
+        :return: a SoundBatch
+        """
+
+        if not len(sounds):
+            raise ValueError("Cannot create an empty SoundBatch")
+
+        template = sounds[0]
+        for sound in sounds[1:]:
+            if (sound.samplerate != template.samplerate) or (sound.shape != template.shape):
+                raise ValueError("All sounds in a SoundBatch must have the same samplerate, length and channels")
+
+        data = np.empty((len(sounds), template.nsamples, template.nchannels))
+        for ii, sound in enumerate(sounds):
+            data[ii] = np.asarray(sound).reshape(data.shape[1:])
+
+        return cls(data, template.samplerate, manager=template.manager, ids=[sound.id for sound in sounds])
+
+    def __len__(self):
+
+        return self.nsounds
+
+    def __getitem__(self, ii):
+        """
+        Gets a member of the batch as a Sound object that shares the batch's data.
+        """
+
+        return Sound._attach(self.data[ii], self.ids[ii], self._annotations(), self.manager)
+
+    def __iter__(self):
+
+        for ii in xrange(self.nsounds):
+            yield self[ii]
+
+    def to_sounds(self):
+        """
+        :return: a list of Sound objects, one for each member
+        """
+
+        return list(self)
+
+    def store(self):
+        """
+        Writes the data and annotations of every member to the database.
+        """
+
+        if self.manager.ephemeral:
+            return
+
+        with self.manager.database.batch():
+            for id_, data in zip(self.ids, self.data):
+                self.manager.database.store_data(id_, sparsify(data))
+                self.manager.database.store_annotations(id_, **self._annotations())
+
+    def _annotations(self):
+
+        return dict(samplerate=float(self.samplerate),
+                    duration=float(self.duration),
+                    nchannels=float(self.nchannels))
+
+    def _derive(self, data, metadata, changed=None, read_only=False):
+        """
+        Creates the batch that results from a transform and records a transform for each member
+        :param data: the transformed data
+        :param metadata: a transform metadata dictionary for all members, or a list with one for each member
+        :param changed: a boolean array of the members that were transformed. Unchanged members keep their ids.
+        :param read_only: if True, the transforms are not stored
+        """
+
+        if isinstance(metadata, dict):
+            metadata = [metadata] * self.nsounds
+        if changed is None:
+            changed = np.ones(self.nsounds, dtype=bool)
+
+        ids = list(self.ids)
+        records = list()
+        for ii in np.flatnonzero(changed):
+            ids[ii] = self.manager.get_id()
+            records.append((ids[ii], dict(metadata[ii], parents=[self.ids[ii]]), self._annotations()))
+
+        derived = SoundBatch(data, self.samplerate, manager=self.manager, ids=ids)
+        if not read_only:
+            self.manager.store_many(records)
+
+        return derived
+
+    def clip(self, max_val, min_val=None, read_only=False):
+        """
+        Clips the peaks of every sound. See Sound.clip.
+        """
+
+        if min_val is None:
+            min_val = -max_val
+
+        metadata = dict(type=ClipTransform,
+                        min_value=float(min_val),
+                        max_value=float(max_val))
+
+        return self._derive(np.clip(self.data, min_val, max_val), metadata, read_only=read_only)
+
+    def scale(self, c, read_only=False):
+        """
+        Scales every sound by a factor of c. See Sound.scale.
+        :param c: a coefficient, or an array with one coefficient for each member
+        """
+
+        if isinstance(c, dB_type):
+            c = c.gain()
+
+        if np.ndim(c) == 0:
+            return self._derive(self.data * c, dict(type=MultiplyTransform, coefficients=c), read_only=read_only)
+
+        c = np.asarray(c, dtype=float)
+        if len(c) != self.nsounds:
+            raise ValueError("Must provide one coefficient for each of the %d sounds" % self.nsounds)
+        metadata = [dict(type=MultiplyTransform, coefficients=float(cc)) for cc in c]
+
+        return self._derive(self.data * c[:, np.newaxis, np.newaxis], metadata, read_only=read_only)
+
+    def get_level(self):
+        """
+        Computes the level of every sound in dB SPL (RMS), as Sound.get_level does.
+        :return: an array of shape (nsounds, nchannels)
+        """
+
+        rms = np.sqrt(np.mean((self.data - np.mean(self.data, axis=1, keepdims=True)) ** 2, axis=1))
+        with np.errstate(divide="ignore"):
+            return 20.0 * np.log10(rms / 2e-5)
+
+    def set_level(self, level, read_only=False):
+        """
+        Sets the level of every sound in dB SPL (RMS). See Sound.set_level. Silent sounds are left unchanged.
+        :param level: a value in dB, a tuple of levels with one for each channel, or an array of shape
+        (nsounds, nchannels) with one for each channel of each member
+        """
+
+        if (self.nchannels == 1) and (np.ndim(level) == 0) and not isinstance(level, dB_type):
+            raise dB_error("Must specify level in dB")
+
+        level = np.broadcast_to(np.asarray(level, dtype=float), (self.nsounds, self.nchannels))
+        silent = ~np.any(self.data != 0, axis=(1, 2))
+        gain = 10 ** ((level - self.get_level()) / 20.)
+        gain[silent] = 1
+
+        # Record the gain as Sound.set_level does: a float for mono sounds and one per channel otherwise
+        if self.nchannels == 1:
+            metadata = [dict(type=MultiplyTransform, coefficients=float(gg)) for gg in gain[:, 0]]
+        else:
+            metadata = [dict(type=MultiplyTransform, coefficients=gg.reshape((1, -1))) for gg in gain]
+
+        return self._derive(self.data * gain[:, np.newaxis, :], metadata, changed=~silent, read_only=read_only)
+
+    def ramp(self, when="both", duration=10*msecond, read_only=False):
+        """
+        Adds a ramp on/off to every sound, using the default envelope ``sin(pi*t/2)**2``. See Sound.ramp.
+        :param when: can take values 'onset', 'offset' or 'both' ('both')
+        :param duration: the time over which the ramping happens (10 ms)
+        """
+
+        when = when.lower().strip()
+        nramp = int(np.rint(float(duration) * float(self.samplerate)))
+        multiplier = np.sin(np.pi * np.linspace(0.0, 1.0, nramp).reshape((nramp, 1)) / 2) ** 2
+
+        ramped = self.data.copy()
+        if when in ["onset", "both"]:
+            ramped[:, :nramp, :] *= multiplier
+        if when in ["offset", "both"]:
+            ramped[:, self.nsamples - nramp:, :] *= multiplier[::-1]
+
+        metadata = dict(type=RampTransform,
+                        when=when,
+                        duration=float(duration))
+
+        return self._derive(ramped, metadata, read_only=read_only)
@@ -1,10 +1,17 @@
+import collections
+import contextlib
+import json
 import logging
+import multiprocessing
 import os
 import copy
+import threading
+import time
 
 import numpy as np
 
-from neosound.sound_store import DictStore
+from neosound.sound_store import DictStore, WriteBehindStore
+from neosound.sparse import sparsify
 from neosound.sound_transforms import *
 
 this_dir, this_filename = os.path.split(__file__)
@@ -12,13 +19,28 @@ data_dir = os.path.join(this_dir, "..", "data")
 
 # TODO: need to fix the circular import problem...
 
+
+def _thread_flag(name, doc):
+    """
+    A manager-wide flag that a context manager can override in the current thread only, by setting it on the
+    manager's threading.local. Assigning to the flag changes the manager-wide value.
+    """
+
+    return property(fget=lambda self: getattr(self._local, name, self.__dict__["_" + name]),
+                    fset=lambda self, value: self.__dict__.__setitem__("_" + name, value),
+                    doc=doc)
+
 class SoundManager(object):
-    _default_database = DictStore()
+    # Created on first use. It is shared by every manager created without a database, so that sounds made with
+    # different default managers (e.g. Sound(...) and Sound.whitenoise(...)) can be combined and reconstructed.
+    _default_database = None
+    _default_lock = threading.Lock()
     logging.basicConfig()
     logger = logging.getLogger()
     logger.setLevel(logging.WARN)
 
-    def __init__(self, database=None, filename=None, read_only=False, **db_args):
+    def __init__(self, database=None, filename=None, read_only=False, ephemeral=False, write_behind=False,
+                 write_behind_args=None, memoize=False, memo_size=32, **db_args):
         """
         Initialize a SoundManager object. If no database is provided, the default one will be chosen. If one has
         been recently used (i.e. since the class was defined), then that one will be chosen. Otherwise,
@@ -27,15 +49,68 @@ class SoundManager(object):
         :param database: A subclass of SoundStore responsible for persisting sounds to a file.
         :param filename: The name of the persistent sound store file.
         :param read_only: prevents writing to the database if True
+        :param ephemeral: if True, sounds and transformations are not written to the database unless they are
+        explicitly committed. See ephemeral_mode. (False)
+        :param write_behind: if True, writes to the database are queued and applied by a background thread. See
+        WriteBehindStore. (False)
+        :param write_behind_args: a dictionary of arguments passed to WriteBehindStore (e.g. max_pending, max_bytes)
+        :param memoize: if True, repeating a transform with the same parents and arguments returns the existing
+        result instead of computing and storing a new one. See memoize_mode. (False)
+        :param memo_size: the number of memoized results kept in memory. Older results are reconstructed from the
+        database when they are requested again. (32)
         :param db_args: A dictionary of arguments that will be passed to the constructor of database.
         """
 
+        self._local = threading.local()
+        self.ephemeral = ephemeral
+        self.memoize = memoize
+        self.memo_size = memo_size
+        self._memo_index = dict()
+        self._memo_results = collections.OrderedDict()
+        self._memo_lock = threading.RLock()
         if database is None:
-            self.database = self._default_database
+            self.database = self.default_database()
         else:
             self.database = database(filename, read_only=read_only, **db_args)
+            if write_behind:
+                self.database = WriteBehindStore(self.database, **(write_behind_args or dict()))
             self._default_database = self.database
 
+    @classmethod
+    def default_database(cls):
+        """
+        Gets the store shared by managers created without a database, creating a DictStore the first time it is
+        needed. Safe to call from many threads.
+        """
+
+        with cls._default_lock:
+            if SoundManager._default_database is None:
+                SoundManager._default_database = DictStore()
+
+            return SoundManager._default_database
+
+    def __getstate__(self):
+
+        # Memoized results are local to this process. The database is pickled as a reference to its store.
+        state = self.__dict__.copy()
+        state["_memo_index"] = dict()
+        state["_memo_results"] = collections.OrderedDict()
+        del state["_local"]
+        del state["_memo_lock"]
+
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._memo_lock = threading.RLock()
+
+    ephemeral = _thread_flag("ephemeral", "True if nothing is written to the database. See ephemeral_mode.")
+    memoize = _thread_flag("memoize", "True if transforms reuse earlier results. See memoize_mode.")
+    defer_annotations = property(fget=lambda self: getattr(self._local, "depth", 0) > 0,
+                                 doc="True if Sound objects created in this thread defer their annotation writes.")
+
     def get_id(self):
         """
         Get a unique id from the database.
@@ -43,6 +118,22 @@ class SoundManager(object):
 
         return self.database.get_id()
 
+    def flush(self):
+        """
+        Waits until all queued writes have been applied to the database. Only needed with write_behind=True.
+        """
+
+        if isinstance(self.database, WriteBehindStore):
+            self.database.flush()
+
+    def close(self):
+        """
+        Applies all queued writes and stops the background writer. Only needed with write_behind=True.
+        """
+
+        if isinstance(self.database, WriteBehindStore):
+            self.database.close()
+
     def import_ids(self, manager, ids, recursive=False, reconstruct_necessary=True, **kwargs):
         """
         Imports ids from manager and adds them to the current database.
@@ -54,59 +145,204 @@ class SoundManager(object):
         :returns a list of ids in the new manager corresponding to the input ids
         """
 
+        if recursive:
+            to_import = self._collect_ancestors(manager, ids)
+        else:
+            to_import = ids
+
         processed_ids = dict()
-        for id_ in ids:
+        for id_ in to_import:
             if id_ not in processed_ids: # Don't import the same ID twice
-                new_id = self.get_id()
-                self.logger.debug("Importing id %s with new id %s" % (id_, new_id))
+                processed_ids[id_] = self.get_id()
+                self.logger.debug("Importing id %s with new id %s" % (id_, processed_ids[id_]))
+
+        # Copy all records in bulk, converting parents and children as they are written
+        orphans = self.database.copy_ids(manager.database, processed_ids, **kwargs)
+
+        if reconstruct_necessary:
+            for id_ in orphans:
+                new_id = processed_ids[id_]
+                if self.database.get_data(new_id) is None:
+                    self.logger.debug("Parents of %s not in database. Attempting to reconstruct and store data" %
+                                      new_id)
+                    data = np.asarray(manager.reconstruct(id_))
+                    self.database.store_data(new_id, data)
 
-                # import annotations
-                annotations = manager.database.get_annotations(id_)
-                self.database.store_annotations(new_id, **annotations)
-                self.database.store_annotations(new_id, **kwargs)
+        return [processed_ids[id_] for id_ in ids]
 
-                # import transformation metadata
-                metadata = manager.database.get_metadata(id_)
-                self.database.store_metadata(new_id, **metadata)
+    @staticmethod
+    def _collect_ancestors(manager, ids):
+        """
+        Collects ids and all of their ancestors in manager's database.
+        :param manager: the sound manager that stores ids
+        :param ids: list of ids
+        :return: a list of ids, followed by all of their ancestors
+        """
 
-                # import data
-                data = manager.database.get_data(id_)
-                if data is not None:
-                    self.database.store_data(new_id, data)
+        collected = list()
+        seen = set()
+        worklist = collections.deque(ids)
+        while worklist:
+            id_ = worklist.popleft()
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            collected.append(id_)
+            metadata = manager.database.get_metadata(id_)
+            worklist.extend(metadata.get("parents", list()))
+
+        return collected
+
+    @contextlib.contextmanager
+    def ephemeral_mode(self):
+        """
+        Context manager in which nothing is written to the database: sounds created or transformed with this
+        manager keep their annotations in memory and their transformation metadata and data are discarded. Use
+        commit to persist a result. Only the current thread is affected, so other threads sharing the manager keep
+        writing.
+
+        Example:
+        with manager.ephemeral_mode():
+            augmented = sound.pad(2 * second).set_level(60 * dB).clip(0.5)
+            manager.commit(augmented)
+        """
 
-                processed_ids[id_] = new_id
-
-                if recursive:
-                    if "parents" in metadata:
-                        ids.extend(metadata["parents"])
-
-        # Fix parents and children
-        for id_, new_id in processed_ids.iteritems():
-            self.logger.debug("Converting parents and children attributes for id %s" % new_id)
-            metadata = self.database.get_metadata(new_id)
-            if "parents" in metadata:
-                parents = metadata.pop("parents")
-                try:
-                    metadata["parents"] = list()
-                    for pid in parents:
-                        metadata["parents"].append(processed_ids[pid])
-                except KeyError: #
-                    data = self.database.get_data(new_id)
-                    if (data is None) and reconstruct_necessary:
-                        self.logger.debug("Parents of %s not in database. Attempting to reconstruct and store data" % new_id)
-                        data = np.asarray(manager.reconstruct(id_))
-                        self.database.store_data(new_id, data)
-
-            if "children" in metadata:
-                children = metadata.pop("children")
-                metadata["children"] = list()
-                for cid in children:
-                    if cid in processed_ids:
-                        metadata["children"].append(processed_ids[cid])
-
-            self.database.store_metadata(new_id, **metadata)
+        ephemeral = getattr(self._local, "ephemeral", None)
+        self._local.ephemeral = True
+        try:
+            yield self
+        finally:
+            if ephemeral is None:
+                del self._local.ephemeral
+            else:
+                self._local.ephemeral = ephemeral
 
-        return [processed_ids[id_] for id_ in ids]
+    @contextlib.contextmanager
+    def deferred_mode(self):
+        """
+        Context manager in which Sound objects created with this manager in the current thread keep their
+        annotations in memory instead of writing them to the database. They are written when the sound is stored
+        (as the result of a transform, with Sound.store or with commit) or when Sound.flush_annotations is called,
+        so intermediate sounds that are never stored cost no writes. Transform methods and reconstruct create their
+        sounds in this mode.
+
+        Example:
+        with manager.deferred_mode():
+            sounds = [Sound(data, samplerate=44100 * hertz, manager=manager) for data in waveforms]
+        sounds[0].flush_annotations()
+        """
+
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+
+    @contextlib.contextmanager
+    def memoize_mode(self):
+        """
+        Context manager in which transforms are memoized: a transform called on the same parents with the same
+        arguments as an earlier call returns the earlier result, from memory or reconstructed from the database,
+        instead of computing it again and storing a duplicate. Transforms that make random choices (e.g. pad without
+        a start time) are never memoized. Only the current thread is affected.
+
+        Example:
+        with manager.memoize_mode():
+            filtered = sound.filter([0 * hertz, 8000 * hertz])
+            assert sound.filter([0 * hertz, 8000 * hertz]).id == filtered.id
+        """
+
+        memoize = getattr(self._local, "memoize", None)
+        self._local.memoize = True
+        try:
+            yield self
+        finally:
+            if memoize is None:
+                del self._local.memoize
+            else:
+                self._local.memoize = memoize
+
+    def get_memoized(self, parent_id, key):
+        """
+        Gets the result of an earlier transform call with the given memoization key. Results are looked up in memory
+        first, then among the children of the parent sound in the database. Each call returns its own copy, so
+        modifying one result in place doesn't change the others.
+        :param parent_id: the id of the sound that was transformed
+        :param key: the memoization key of the call
+        :return: a Sound object, or None if the call hasn't been made before
+        """
+
+        with self._memo_lock:
+            sound = self._memo_results.pop(key, None)
+            if sound is not None:
+                self._memo_results[key] = sound
+            id_ = self._memo_index.get(key)
+        if sound is not None:
+            return self._copy_result(sound)
+
+        if id_ is None:
+            try:
+                children = self.database.get_metadata(parent_id).get("children", list())
+            except KeyError:
+                return
+            for child in children:
+                if self.database.get_metadata(child).get("memo_key") == key:
+                    id_ = child
+                    break
+            else:
+                return
+
+        self.logger.debug("Reusing memoized result %s" % id_)
+        sound = self.reconstruct(id_)
+        self.memoize_result(key, sound, True)
+
+        return sound
+
+    def memoize_result(self, key, sound, stored):
+        """
+        Remembers the result of a transform call for get_memoized
+        :param key: the memoization key of the call
+        :param sound: the resulting Sound object
+        :param stored: whether the transform was stored in the database, so it can be reconstructed later
+        """
+
+        # Keep a read-only copy, so that in-place changes to the returned sound can't change later results
+        cached = self._copy_result(sound, writeable=False)
+        with self._memo_lock:
+            if stored:
+                self._memo_index[key] = sound.id
+            self._memo_results.pop(key, None)
+            self._memo_results[key] = cached
+            while len(self._memo_results) > self.memo_size:
+                self._memo_results.popitem(last=False)
+
+    @staticmethod
+    def _copy_result(sound, writeable=True):
+        """
+        Copies a memoized Sound object, keeping its id and annotations
+        """
+        from neosound.sound import Sound
+
+        copied = Sound._attach(np.array(sound), sound.id, sound.annotations, sound.manager)
+        copied._deferred = getattr(sound, "_deferred", False)
+        copied.setflags(write=writeable)
+
+        return copied
+
+    def commit(self, sound):
+        """
+        Writes a sound's data and annotations to the database, even in ephemeral mode. The lineage of the sound is
+        collapsed: it is stored as a new root rather than as the result of its transformations.
+        :param sound: a Sound object created with this manager
+        :return: True if sound was stored, else False
+        """
+
+        stored = self.database.store_annotations(sound.id, **sound.annotations)
+        sound._deferred = False
+        stored = InitTransform(self, sound, dict(type=InitTransform)).store() and stored
+        stored = self.database.store_data(sound.id, sparsify(np.asarray(sound))) and stored
+
+        return stored
 
     def store(self, derived, metadata, original=None):
         """
@@ -117,6 +353,13 @@ class SoundManager(object):
         :return: True if sound was stored, else False
         """
 
+        if self.ephemeral:
+            return False
+
+        # Sounds created in deferred_mode write their annotations once they are stored
+        if hasattr(derived, "flush_annotations"):
+            derived.flush_annotations()
+
         if "type" in metadata:
             transform = metadata["type"](self, derived, metadata, original)
         else:
@@ -124,25 +367,52 @@ class SoundManager(object):
 
         return transform.store()
 
+    def store_many(self, records):
+        """
+        Stores the annotations and transformation metadata of many derived sounds at once, holding the database's
+        batch open so the writes are applied together. Nothing is stored in ephemeral mode.
+        :param records: a list of (id, metadata, annotations) tuples. Each metadata dictionary must contain the type
+        and parents of the transform.
+        :return: True if everything was stored, else False
+        """
+
+        if self.ephemeral:
+            return False
+
+        stored = True
+        with self.database.batch():
+            for id_, metadata, annotations in records:
+                stored = self.database.store_annotations(id_, **annotations) and stored
+                stored = self.database.store_metadata(id_, **metadata) and stored
+                for parent in metadata["parents"]:
+                    stored = self.database.add_child(parent, id_) and stored
+
+        return stored
+
     def get_transformation_metadata(self, id_):
 
         return self.database.get_metadata(id_)
 
     # I think these recursive methods can be done better, but that's low priority
     def get_roots(self, id_):
+        """
+        Gets the roots of a sound's lineage. A root that a sound descends from more than once (e.g. a source that is
+        repeated in Sound.concatenate) is only listed once, so that the sound's components sum to the sound.
+        :param id_: sound id
+        :return: a list of root ids, in the order they are first found
+        """
 
         roots = list()
         metadata = self.database.get_metadata(id_)
         if ("parents" in metadata) and len(metadata["parents"]):
             for pid in metadata["parents"]:
-                roots.extend(self.get_roots(pid))
+                roots.extend(root for root in self.get_roots(pid) if root not in roots)
         else:
             roots.append(id_)
 
         return roots
 
     def reconstruct_individual(self, id_, root_id):
-        from neosound.sound import Sound
 
         def get_waveform_ind(id_):
             self.logger.debug("Attempting to get waveform for id %s" % id_)
@@ -170,72 +440,526 @@ class SoundManager(object):
             self.logger.debug("Requested root_id not roots for id %s" % id_)
             return None
 
-        component_id = self.database.filter_ids(transform_id=id_,
-                                                transform_root_id=root_id)
-        if len(component_id):
+        component_id = self._get_component_id(id_, root_id)
+        if component_id is not None:
+            sound = self._get_stored(component_id)
+            if sound is not None:
+                return sound
 
-            component_id = component_id[0]
-            data = self.database.get_data(component_id)
-            if data is not None:
-                samplerate = self.database.get_annotations(component_id)["samplerate"]
-                sound = Sound(data, samplerate=samplerate*hertz, manager=self)
-                sound.id = component_id
-                sound.annotations.update(self.database.get_annotations(component_id))
+        with self.deferred_mode():
+            sound = get_waveform_ind(id_)
+        self._add_component(id_, root_id, sound)
 
-                return sound
+        return sound
+
+    def reconstruct_components(self, id_, store=True):
+        """
+        Reconstructs every component of a sound in a single traversal of its lineage. A component is the sound that
+        would result if all of its roots but one were replaced with silence. Each node in the lineage is computed
+        once per root that it descends from, and silent inputs to linear transforms are skipped entirely.
+        :param id_: sound id
+        :param store: if True, store the transformation metadata of each component (True)
+        :return: a list of Sound objects, one for each root in get_roots(id_)
+        """
+        from neosound.sound import Sound
+
+        roots = self.get_roots(id_)
+
+        # Use the stored components if they are all available
+        cached = dict()
+        for root_id in roots:
+            component_id = self._get_component_id(id_, root_id)
+            if component_id is not None:
+                sound = self._get_stored(component_id)
+                if sound is not None:
+                    cached[root_id] = sound
+        if len(cached) == len(set(roots)):
+            return [cached[root_id] for root_id in roots]
+
+        computed = dict()
+
+        def get_components(id_):
+            """
+            Returns a dictionary of the components of id_ for each of its roots and the waveform that results when
+            all of its roots are silent, or None if that is just silence.
+            """
+
+            if id_ in computed:
+                return computed[id_]
+
+            self.logger.debug("Attempting to get components for id %s" % id_)
+            metadata = self.database.get_metadata(id_)
+            transform = metadata["type"]
+            if not len(metadata.get("parents", list())):
+                waveform = self.database.get_data(id_)
+                computed[id_] = ({id_: transform.reconstruct(waveform, metadata, manager=self)}, None)
+                return computed[id_]
+
+            parents = [get_components(pid) for pid in metadata["parents"]]
+            silences = dict()
+
+            def get_silence(ii):
+
+                if ii not in silences:
+                    components, silence = parents[ii]
+                    if silence is None:
+                        template = components.values()[0]
+                        silence = Sound(np.zeros(template.shape), samplerate=template.samplerate, manager=self)
+                    silences[ii] = silence
+
+                return silences[ii]
+
+            root_ids = list()
+            for components, silence in parents:
+                root_ids.extend(root_id for root_id in components if root_id not in root_ids)
+
+            components = dict()
+            for root_id in root_ids:
+                waveforms = [parent[0][root_id] if root_id in parent[0] else get_silence(ii)
+                             for ii, parent in enumerate(parents)]
+                components[root_id] = transform.reconstruct(waveforms, dict(metadata), manager=self)
+
+            if transform.linear and all(silence is None for components, silence in parents):
+                silence = None
             else:
-                store = True
-                metadata = dict(type=ComponentTransform,
-                                id=id_,
-                                root_id=root_id,
-                                parents=[id_, root_id])
+                silence = transform.reconstruct([get_silence(ii) for ii in xrange(len(parents))],
+                                                dict(metadata),
+                                                manager=self)
 
-        else:
-            store = True
-            metadata = dict(type=ComponentTransform,
-                            id=id_,
-                            root_id=root_id,
-                            parents=[id_, root_id])
+            computed[id_] = (components, silence)
+            return computed[id_]
 
-        sound = get_waveform_ind(id_)
+        with self.deferred_mode():
+            components = get_components(id_)[0]
+        components.update(cached)
         if store:
+            for root_id in set(roots) - set(cached):
+                self._add_component(id_, root_id, components[root_id])
+
+        return [components[root_id] for root_id in roots]
+
+    def _get_component_id(self, id_, root_id):
+        """
+        Looks up the id of the stored component of id_ for root_id in the component index of id_
+        :return: the component id or None if it hasn't been stored
+        """
+
+        metadata = self.database.get_metadata(id_)
+        component_roots = metadata.get("component_roots", list())
+        if root_id in component_roots:
+            return metadata["component_ids"][component_roots.index(root_id)]
+
+    def _add_component(self, id_, root_id, sound):
+        """
+        Stores a component of id_ and adds it to the component index of id_. If the component is already stored,
+        sound takes on its id instead.
+        """
+
+        metadata = dict(type=ComponentTransform,
+                        id=id_,
+                        root_id=root_id,
+                        parents=[id_, root_id])
+        # Hold the lock so that concurrent calls cannot store the same component twice
+        with self.database.lock:
+            component_id = self._get_component_id(id_, root_id)
+            if component_id is not None:
+                sound.id = component_id
+                sound.annotations.update(self.database.get_annotations(component_id))
+                sound._deferred = False
+                return
+
             self.store(sound, metadata)
+            index = self.database.get_metadata(id_)
+            self.database.store_metadata(id_,
+                                         component_roots=index.get("component_roots", list()) + [root_id],
+                                         component_ids=index.get("component_ids", list()) + [sound.id])
+
+    def _get_stored(self, id_):
+        """
+        Gets the stored waveform for id_ as a Sound object, or None if the waveform isn't stored
+        """
+        from neosound.sound import Sound
+
+        data = self.database.get_data(id_)
+        if data is not None:
+            annotations = self.database.get_annotations(id_)
+
+            return Sound._attach(np.array(data, dtype=float), id_, annotations, self)
+
+    def reconstruct(self, id_, lazy=False, optimize=True, profile=False):
+        """
+        Reconstructs the sound with the specified id, either from its stored data or by replaying the
+        transformations that created it.
+        :param id_: sound id
+        :param lazy: if True, return a LazySound that only carries the id, annotations and metadata and
+        reconstructs the waveform when its data is first accessed. (False)
+        :param optimize: if True, chains of slice, pad, multiply and clip transforms are fused and applied in a
+        single pass. The result is identical either way. (True)
+        :param profile: if True, also return a ReconstructionProfile with the wall time, bytes read and peak array
+        size of each node in the reconstruction. (False)
+        :return: a Sound object, or a LazySound object if lazy is True. If profile is True, a tuple of the Sound
+        and its ReconstructionProfile.
+        """
+        from neosound.sound import LazySound
+
+        if lazy:
+            return LazySound(id_, manager=self)
+
+        reconstruction_profile = ReconstructionProfile(id_) if profile else None
+        # The intermediate sounds are never stored, so their annotations are never written
+        with self.deferred_mode():
+            sound = self._execute(self._plan(id_, optimize=optimize), profile=reconstruction_profile)
+        sound.id = id_
+        sound.annotations.update(self.database.get_annotations(id_))
+        sound._deferred = False
+
+        if profile:
+            return sound, reconstruction_profile
 
         return sound
 
-    def reconstruct(self, id_):
+    def reconstruct_segment(self, id_, start, stop):
+        """
+        Reconstructs part of a sound, as sound.slice(start, stop) would. A sound made with Sound.concatenate only
+        reconstructs the sounds that overlap the part, so any part of a long session is quick to get. Other sounds
+        are reconstructed in full and then sliced. The part is stored as a slice of id_.
+        :param id_: sound id
+        :param start: start time of the part in seconds
+        :param stop: stop time of the part in seconds
+        :return: a Sound object
+        """
         from neosound.sound import Sound
 
-        def get_waveform(id_):
+        metadata = self.database.get_metadata(id_)
+        if (metadata["type"] is not ConcatenateTransform) or self.database.has_data(id_):
+            return self.reconstruct(id_).slice(start, stop)
+
+        samplerate = float(self.database.get_annotations(id_)["samplerate"])
+        sampleperiod = 1 / samplerate
+        slice_metadata = dict(type=SliceTransform,
+                              start_time=float(int(float(start) * samplerate) * sampleperiod),
+                              stop_time=float(int(float(stop) * samplerate) * sampleperiod),
+                              parents=[id_])
+        (first, nsamples), = SliceTransform.window(slice_metadata, samplerate, metadata["nsamples"])
+
+        # Only reconstruct each overlapping parent once, even if it appears in the sound more than once
+        lengths = list()
+        for pid in metadata["parents"]:
+            annotations = self.database.get_annotations(pid)
+            lengths.append(int(np.rint(float(annotations["duration"]) * float(annotations["samplerate"]))))
+        overlapping = ConcatenateTransform.overlapping(metadata, lengths, first, first + nsamples)
+        parents = dict((metadata["parents"][ii], None) for ii in overlapping)
+        for pid in parents:
+            parents[pid] = np.asarray(self.reconstruct(pid))
+        waveforms = [parents[pid] if ii in overlapping else None for ii, pid in enumerate(metadata["parents"])]
+        if not overlapping:
+            waveforms[0] = np.zeros((0, int(self.database.get_annotations(id_)["nchannels"])))
+
+        data = ConcatenateTransform.render(waveforms, metadata, start=first, stop=first + nsamples)
+        segment = Sound._wrap(data, samplerate * hertz, manager=self)
+        self.store(segment, slice_metadata)
+
+        return segment
+
+    def stream(self, id_):
+        """
+        Starts a chain of transforms that is applied to the stored waveform of id_ one block at a time, for sounds
+        that are too long to load into memory. See SoundStream.
 
-            self.logger.debug("Attempting to get waveform for id %s" % id_)
-            data = self.database.get_data(id_)
-            if data is not None:
-                samplerate = self.database.get_annotations(id_)["samplerate"]
-                return Sound(data, samplerate=samplerate * hertz, manager=self)
+        Example:
+        result = manager.stream(id_).filter([500 * hertz, 8000 * hertz]).clip(0.5).compute(block_size=2 ** 20)
+        :param id_: the id of a sound whose waveform is stored
+        :return: a SoundStream
+        """
+        from neosound.streaming import SoundStream
+
+        return SoundStream(self, id_)
+
+    def map(self, func, ids, workers=None, chunksize=1):
+        """
+        Applies func to the sound for each id in a pool of worker processes. Each worker stores the sounds it creates
+        in its own DictStore shard, which is sent back and merged into this database as results arrive, so the
+        database itself is only written by this process. The merged sounds keep their lineage: a result is recorded
+        as a descendant of the sound it was computed from.
+
+        Example:
+        new_ids = manager.map(lambda sound: sound.filter([500 * hertz, 8000 * hertz]).set_level(60 * dB), ids)
+
+        :param func: a function that takes a Sound and returns a transformed Sound, or None. Sounds it creates
+        should use the manager of the sound it is given.
+        :param ids: a list of sound ids
+        :param workers: the number of worker processes (the number of CPUs)
+        :param chunksize: the number of ids sent to a worker at a time (1)
+        :return: a list with the id of the result for each id, or None where func returned None
+        """
+
+        if self.ephemeral:
+            raise ValueError("Results of map are written to the database, so it cannot be used in ephemeral mode")
+
+        # Workers are forked from this process, so any queued writes must be in the database first
+        self.flush()
+        pool = multiprocessing.Pool(workers, initializer=_init_map_worker, initargs=(self, func))
+        try:
+            result_ids = [self._merge_shard(id_, *result) if result is not None else None
+                          for id_, result in zip(ids, pool.imap(_map_worker, ids, chunksize))]
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        return result_ids
+
+    def _merge_shard(self, id_, shard_id, result_id, records):
+        """
+        Copies the records a map worker stored in its shard into this database
+        :param id_: the id of the sound the worker was given
+        :param shard_id: the id of that sound's copy in the shard
+        :param result_id: the id of the worker's result in the shard
+        :param records: the shard's DictStore data
+        :return: the id of the result in this database
+        """
+
+        shard = DictStore()
+        shard.data = records
+        id_map = dict((sid, self.get_id()) for sid in records if sid != shard_id)
+        lineage = dict(id_map)
+        lineage[shard_id] = id_
+
+        with self.database.batch():
+            self.database.copy_ids(shard, id_map)
+
+            # copy_ids clears the parents of sounds derived from ids outside of id_map, so those are restored here.
+            # The only such ids are the copy of id_ and any sounds func read from this database directly.
+            for sid, new_id in id_map.iteritems():
+                parents = shard.get_metadata(sid).get("parents", list())
+                if all(pid in id_map for pid in parents):
+                    continue
+                self.database.store_metadata(new_id, parents=[lineage.get(pid, pid) for pid in parents])
+                for pid in parents:
+                    if pid not in id_map:
+                        self.database.add_child(lineage.get(pid, pid), new_id)
+
+        return lineage[result_id]
+
+    def explain(self, id_, optimize=True):
+        """
+        Describes how the sound with the specified id would be reconstructed, without reconstructing it.
+        :param id_: sound id
+        :param optimize: whether to plan with fused transforms, as in reconstruct (True)
+        :return: a nested dictionary with the id, transform type, whether the node is stored or recomputed, the
+        estimated number of samples and channels, and the same description for each parent. Fused nodes also list
+        the transform types of each of their steps. The result can be serialized with json.
+        """
+
+        def describe(node):
+
+            annotations = self.database.get_annotations(node["id"])
+            if ("duration" in annotations) and ("samplerate" in annotations):
+                nsamples = int(round(float(annotations["duration"]) * float(annotations["samplerate"])))
             else:
-                self.logger.debug("Attempting to get waveform from parents instead")
-                metadata = self.database.get_metadata(id_)
-                transform = metadata["type"]
-
-                if ("parents" in metadata) and len(metadata["parents"]):
-                    pids = metadata["parents"]
-                    self.logger.debug("Attempting to reconstruct from %s parents" % len(pids))
-                    return transform.reconstruct([get_waveform(pid) for pid in pids],
-                                                 metadata,
-                                                 manager=self)
-                else:
-                    self.logger.debug("parents not found in database for id %s. Attempting to reconstruct!" % id_)
-                    waveform = self.database.get_data(id_)
-                    return transform.reconstruct(waveform,
-                                                 metadata,
-                                                 manager=self)
-
-        sound = get_waveform(id_)
-        sound.id = id_
-        sound.annotations.update(self.database.get_annotations(id_))
+                nsamples = None
+            description = dict(id=node["id"],
+                               type=node["type"].__name__,
+                               stored=bool(node["stored"]),
+                               recomputed=not node["stored"],
+                               nsamples=nsamples,
+                               nchannels=int(annotations["nchannels"]) if "nchannels" in annotations else None,
+                               parents=[describe(parent) for parent in node["parents"]])
+            if node["type"] is FusedTransform:
+                description["steps"] = [step["type"].__name__ for step in node["metadata"]["steps"]]
+
+            return description
+
+        return describe(self._plan(id_, optimize=optimize))
+
+    def _plan(self, id_, optimize=True):
+        """
+        Plans the reconstruction of a sound as a tree of nodes. Each node is a dictionary with the id, transform type
+        and metadata of a sound, whether its data is stored, and the nodes for each of its parents.
+        :param id_: sound id
+        :param optimize: if True, chains of transforms that can be applied in a single pass are replaced by a single
+        FusedTransform node. (True)
+        :return: the node for id_
+        """
+
+        stored = self.database.has_data(id_)
+        metadata = self.database.get_metadata(id_)
+        node = dict(id=id_,
+                    type=metadata["type"],
+                    metadata=metadata,
+                    stored=stored,
+                    parents=list())
+        if stored:
+            return node
+
+        if optimize and FusedTransform.can_fuse(metadata):
+            steps = [metadata]
+            pid = metadata["parents"][0]
+            while not self.database.has_data(pid):
+                parent_metadata = self.database.get_metadata(pid)
+                if not FusedTransform.can_fuse(parent_metadata):
+                    break
+                steps.insert(0, parent_metadata)
+                pid = parent_metadata["parents"][0]
+
+            self.logger.debug("Fusing %d transforms for id %s" % (len(steps), id_))
+            node["type"] = FusedTransform
+            node["metadata"] = dict(type=FusedTransform,
+                                    steps=steps)
+            node["parents"] = [self._plan(pid, optimize=optimize)]
+        else:
+            node["parents"] = [self._plan(pid, optimize=optimize) for pid in metadata.get("parents", list())]
+
+        return node
+
+    def _execute(self, node, profile=None):
+        """
+        Computes the waveform for a node of a reconstruction plan.
+        :param node: a node from _plan
+        :param profile: a ReconstructionProfile to add statistics for this node and its parents to (None)
+        :return: a Sound object
+        """
+        from neosound.sound import Sound
+
+        self.logger.debug("Attempting to get waveform for id %s" % node["id"])
+        started = time.time()
+        bytes_read = 0
+        inputs = list()
+        if node["stored"]:
+            data = self.database.get_data(node["id"])
+            bytes_read = data.nbytes
+            samplerate = self.database.get_annotations(node["id"])["samplerate"]
+            sound = Sound(data, samplerate=samplerate * hertz, manager=self)
+        elif len(node["parents"]):
+            self.logger.debug("Attempting to reconstruct from %s parents" % len(node["parents"]))
+            inputs = [self._execute(parent, profile=profile) for parent in node["parents"]]
+            parents_finished = time.time()
+            sound = node["type"].reconstruct(inputs,
+                                             node["metadata"],
+                                             manager=self)
+        else:
+            self.logger.debug("parents not found in database for id %s. Attempting to reconstruct!" % node["id"])
+            sound = node["type"].reconstruct(None,
+                                             node["metadata"],
+                                             manager=self)
+
+        if profile is not None:
+            finished = time.time()
+            profile.add(node,
+                        wall_time=finished - started,
+                        self_time=finished - (parents_finished if len(inputs) else started),
+                        bytes_read=bytes_read,
+                        peak_bytes=max([np.asarray(waveform).nbytes for waveform in inputs + [sound]]))
 
         return sound
 
 
+_map_state = dict()
+
+
+def _init_map_worker(manager, func):
+    """
+    Sets up a worker process for SoundManager.map
+    """
+
+    # The background writer thread isn't copied into a forked process, and everything was flushed before forking
+    if isinstance(manager.database, WriteBehindStore):
+        manager = copy.copy(manager)
+        manager.database = manager.database.store
+    _map_state.update(manager=manager, func=func)
+
+
+def _map_worker(id_):
+    """
+    Applies the mapped function to the sound for id_, storing everything it creates in a new DictStore shard
+    :return: the id of the sound's copy in the shard, the id of the result and the shard's data, or None if the
+    function returned None
+    """
+
+    shard = SoundManager(DictStore)
+    shard_id = shard.import_ids(_map_state["manager"], [id_])[0]
+    result = _map_state["func"](shard.reconstruct(shard_id))
+    if result is None:
+        return None
+
+    return shard_id, result.id, shard.database.data
+
+
+class ReconstructionProfile(object):
+    """
+    Collects the wall time, bytes read from the database and peak array size for each node of a reconstruction, in
+    the order the nodes were computed.
+    """
+
+    total_time = property(fget=lambda self: sum(node["self_time"] for node in self.nodes),
+                          doc="Total wall time of the reconstruction in seconds.")
+    bytes_read = property(fget=lambda self: sum(node["bytes_read"] for node in self.nodes),
+                          doc="Total number of bytes read from the database.")
+    peak_bytes = property(fget=lambda self: max([node["peak_bytes"] for node in self.nodes] + [0]),
+                          doc="The size in bytes of the largest array used in the reconstruction.")
+
+    def __init__(self, id_):
+
+        self.id = id_
+        self.nodes = list()
+
+    def add(self, node, wall_time, self_time, bytes_read, peak_bytes):
+        """
+        Adds the statistics for a node of a reconstruction plan
+        :param node: a node from SoundManager._plan
+        :param wall_time: seconds spent computing the node, including its parents
+        :param self_time: seconds spent computing the node, excluding its parents
+        :param bytes_read: number of bytes read from the database for the node
+        :param peak_bytes: the size in bytes of the largest input or output array of the node
+        """
+
+        self.nodes.append(dict(id=node["id"],
+                               type=node["type"].__name__,
+                               stored=bool(node["stored"]),
+                               wall_time=wall_time,
+                               self_time=self_time,
+                               bytes_read=int(bytes_read),
+                               peak_bytes=int(peak_bytes)))
+
+    def to_dict(self):
+
+        return dict(id=self.id,
+                    total_time=self.total_time,
+                    bytes_read=self.bytes_read,
+                    peak_bytes=self.peak_bytes,
+                    nodes=self.nodes)
+
+    def to_json(self, filename=None, **kwargs):
+        """
+        Exports the profile as JSON
+        :param filename: if provided, the JSON is also written to this file
+        :param kwargs: additional keyword arguments for json.dumps
+        :return: the JSON string
+        """
 
+        profile = json.dumps(self.to_dict(), **kwargs)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(profile)
+
+        return profile
+
+    def __str__(self):
+
+        lines = ["Reconstruction of %s: %.4f s, %d bytes read, %d peak bytes" % (self.id,
+                                                                                self.total_time,
+                                                                                self.bytes_read,
+                                                                                self.peak_bytes)]
+        for node in self.nodes:
+            status = "stored    " if node["stored"] else "recomputed"
+            lines.append("  %-20s %-36s %s %.4f s %10d bytes read %10d peak bytes" % (node["type"],
+                                                                                      node["id"],
+                                                                                      status,
+                                                                                      node["self_time"],
+                                                                                      node["bytes_read"],
+                                                                                      node["peak_bytes"]))
+
+        return "\n".join(lines)
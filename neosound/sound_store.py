@@ -1,12 +1,18 @@
+import atexit
+import collections
+import contextlib
 import copy
 import os
+import threading
 import uuid
+import weakref
 from functools import wraps
 
 import h5py
-import os
+import numpy as np
 
 from neosound import sound_transforms
+from neosound.sparse import SparseWaveform
 
 
 # TODO: abstract SoundStore class to bring more to the parent class
@@ -33,20 +39,330 @@ def writes(func):
     return writeok
 
 
+def locked(func):
+    """
+    All methods that read or write the underlying storage should be wrapped with this function, so that a store can
+    be shared between threads. The store's lock is held for the duration of the call.
+    :param func: function to wrap
+    :return: wrapped function
+    """
+
+    @wraps(func)
+    def lockedfunc(obj, *args, **kwargs):
+
+        with obj.lock:
+            return func(obj, *args, **kwargs)
+
+    return lockedfunc
+
+
+def _lock_order(store):
+
+    filename = getattr(store, "filename", None)
+
+    return os.path.abspath(filename) if filename else "", str(getattr(store, "uid", id(store)))
+
+
+def locked_with_source(func):
+    """
+    Like locked, for methods that copy from another store, which is their first argument. The locks of both stores
+    are held for the duration of the call, and they are always taken in the same order (by filename, then uid), so
+    that two threads copying between the same stores in opposite directions can't deadlock.
+    :param func: function to wrap
+    :return: wrapped function
+    """
+
+    @wraps(func)
+    def lockedfunc(obj, store, *args, **kwargs):
+
+        locks = list()
+        for each in sorted([obj, store], key=_lock_order):
+            if not any(each.lock is lock for lock in locks):
+                locks.append(each.lock)
+        with contextlib.nested(*locks):
+            return func(obj, store, *args, **kwargs)
+
+    return lockedfunc
+
+
+_file_locks = dict()
+_file_locks_lock = threading.Lock()
+
+
+def get_file_lock(filename):
+    """
+    Gets the lock shared by all stores that use the specified file
+    :param filename: the name of the file
+    :return: a reentrant lock
+    """
+
+    with _file_locks_lock:
+        return _file_locks.setdefault(os.path.abspath(filename), threading.RLock())
+
+
+def remap_lineage(metadata, id_map):
+    """
+    Converts the parents and children in a dictionary of transformation metadata to the ids given in id_map. Children
+    that are not in id_map are dropped. If any parent is not in id_map, the lineage is broken and the parents are
+    cleared. The index of stored components (component_roots and component_ids) is remapped the same way, and a
+    component is dropped unless both its root and its id are in id_map. The id and root_id of a component's own record
+    are remapped, or removed if they are not in id_map.
+    :param metadata: a dictionary of transformation metadata
+    :param id_map: a dictionary mapping old ids to new ids
+    :return: the remapped metadata and a flag that is False if the parents could not all be remapped
+    """
+
+    complete = True
+    if "parents" in metadata:
+        parents = metadata["parents"]
+        complete = all(pid in id_map for pid in parents)
+        metadata["parents"] = [id_map[pid] for pid in parents] if complete else list()
+
+    if "children" in metadata:
+        metadata["children"] = [id_map[cid] for cid in metadata["children"] if cid in id_map]
+
+    if ("component_roots" in metadata) or ("component_ids" in metadata):
+        components = [(id_map[root], id_map[cid]) for root, cid in zip(metadata.get("component_roots", list()),
+                                                                        metadata.get("component_ids", list()))
+                      if (root in id_map) and (cid in id_map)]
+        metadata["component_roots"] = [root for root, cid in components]
+        metadata["component_ids"] = [cid for root, cid in components]
+
+    for key in ["id", "root_id"]:
+        if key in metadata:
+            if metadata[key] in id_map:
+                metadata[key] = id_map[metadata[key]]
+            else:
+                del metadata[key]
+
+    return metadata, complete
+
+
+# The transformation metadata that hold lists of sound ids
+lineage_keys = ["parents", "children", "component_roots", "component_ids"]
+# All transformation metadata that hold sound ids, which are remapped by remap_lineage
+remapped_keys = lineage_keys + ["id", "root_id"]
+
+
+class UUIDAllocator(object):
+    """
+    Allocates random uuid4 strings as sound ids. These are unique across all stores, so they are already their own
+    export ids.
+    """
+
+    name = "uuid"
+
+    def allocate(self, store):
+
+        return str(uuid.uuid4())
+
+    def parse(self, name):
+        """
+        Converts a key read back from the storage (e.g. an HDF5 group name) to an id
+        """
+
+        return name
+
+    def to_uuid(self, store, id_):
+
+        return str(id_)
+
+
+class CounterAllocator(object):
+    """
+    Allocates store-local, monotonically increasing 64-bit integers as sound ids. Integer ids are much smaller than
+    uuids in lineage attributes and faster to compare, but are only unique within their store: use
+    SoundStore.to_uuid to get a globally unique id when exporting them.
+    """
+
+    name = "counter"
+
+    def __init__(self, block_size=1024):
+        """
+        :param block_size: the number of ids reserved from the store at a time. Persistent stores only write their
+        counter once per block. (1024)
+        """
+
+        self.block_size = block_size
+        self._next = 0
+        self._stop = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, store):
+
+        with self._lock:
+            if self._next >= self._stop:
+                self._next, self._stop = store.reserve_ids(self.block_size)
+            id_ = self._next
+            self._next += 1
+
+        return id_
+
+    def parse(self, name):
+
+        return int(name)
+
+    def to_uuid(self, store, id_):
+
+        return str(uuid.uuid5(uuid.UUID(store.uid), str(id_)))
+
+
+id_allocators = dict(uuid=UUIDAllocator,
+                     counter=CounterAllocator)
+
+
+def get_allocator(id_allocator):
+    """
+    Gets an id allocator instance
+    :param id_allocator: an allocator instance, or the name of one of id_allocators ("uuid" or "counter")
+    :return: an id allocator
+    """
+
+    if isinstance(id_allocator, basestring):
+        if id_allocator not in id_allocators:
+            raise ValueError("Unknown id allocator %s. Must be one of %s" % (id_allocator,
+                                                                             ", ".join(id_allocators.keys())))
+        id_allocator = id_allocators[id_allocator]()
+
+    return id_allocator
+
+
+_live_stores = weakref.WeakValueDictionary()
+
+
+def reattach_store(uid, store_class, filename=None, read_only=False):
+    """
+    Finds the store that a pickled store refers to. Stores are pickled as a reference rather than by value, so that
+    sounds sent to another process are attached to the same storage there. If a store with the same uid is open in
+    this process (e.g. one inherited by a forked worker, or one configured before unpickling), that store is used.
+    Otherwise, a store with a filename is opened again. Stores without a filename (e.g. a DictStore) can't be
+    reopened, since their contents only exist in the process that created them.
+    :param uid: the uid of the pickled store
+    :param store_class: the SoundStore subclass of the pickled store
+    :param filename: the filename of the pickled store
+    :param read_only: the read-only flag of the pickled store
+    :return: a store
+    """
+
+    store = _live_stores.get(uid)
+    if store is not None:
+        return store
+
+    if filename is None:
+        raise IOError("%s %s is not open in this process, and its sounds only exist in the process that created it. "
+                      "Open the store before unpickling (e.g. in a forked worker), or use an HDF5Store to share sounds "
+                      "between processes." % (store_class.__name__, uid))
+
+    return store_class(filename, read_only=read_only)
+
+
 class SoundStore(object):
     """
     Base sound storage class.
     """
 
-    def __init__(self, filename=None, read_only=False):
+    def __init__(self, filename=None, read_only=False, id_allocator="uuid"):
 
         self.filename = filename
         self.read_only = read_only
+        self.lock = threading.RLock()
+        self.id_allocator = get_allocator(id_allocator)
+        self.uid = str(uuid.uuid4())
+        self._next_id = 1
+        _live_stores[self.uid] = self
 
-    @staticmethod
-    def get_id():
+    def __reduce__(self):
 
-        return str(uuid.uuid4())
+        return reattach_store, (self.uid, type(self), self.filename, self.read_only)
+
+    def get_id(self):
+        """
+        Gets a new sound id from the store's id allocator
+        """
+
+        return self.id_allocator.allocate(self)
+
+    @locked
+    def reserve_ids(self, count):
+        """
+        Reserves a block of integer ids for a CounterAllocator
+        :param count: the number of ids to reserve
+        :return: the first reserved id and one past the last reserved id
+        """
+
+        start = self._next_id
+        self._next_id += count
+
+        return start, self._next_id
+
+    def to_uuid(self, id_):
+        """
+        Converts a sound id to a globally unique uuid string, for exporting ids outside of the store. uuid ids are
+        returned as is and integer ids are mapped deterministically using the store's uid.
+        :param id_: sound id
+        :return: a uuid string
+        """
+
+        return self.id_allocator.to_uuid(self, id_)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager that holds the store's lock for a batch of reads and writes, so that the batch is applied
+        without interruption from other threads.
+        """
+
+        with self.lock:
+            yield self
+
+    @locked
+    def add_child(self, id_, child):
+        """
+        Appends child to the children of id_ in the transformation metadata, unless it is already a child (e.g. when a
+        parent is used more than once by the same transform). The metadata is read and written while holding the
+        store's lock, so children added concurrently are not lost.
+        :param id_: sound id of the parent
+        :param child: sound id of the child
+        :return: True if the metadata was stored, else False
+        """
+
+        children = list(self.get_metadata(id_).get("children", list()))
+        if child in children:
+            return True
+
+        return self.store_metadata(id_, children=children + [child])
+
+    @locked_with_source
+    def copy_ids(self, store, id_map, **kwargs):
+        """
+        Copies the annotations, metadata and data of each id in id_map from store into this store. Parent and child
+        ids are remapped to their new ids as each record is written, so every record is only written once.
+        :param store: the SoundStore to copy from
+        :param id_map: a dictionary mapping ids in store to new ids in this store
+        :param kwargs: all other kwargs are added as annotations to each copied id
+        :return: a list of ids (in store) whose parents were not all copied. Nothing is copied into a read-only
+        store, so the list is empty.
+        """
+
+        if self.read_only:
+            return list()
+
+        orphans = list()
+        for id_, new_id in id_map.iteritems():
+            annotations = store.get_annotations(id_)
+            annotations.update(kwargs)
+            self.store_annotations(new_id, **annotations)
+
+            metadata, complete = remap_lineage(store.get_metadata(id_), id_map)
+            self.store_metadata(new_id, **metadata)
+            if not complete:
+                orphans.append(id_)
+
+            data = store.get_data(id_)
+            if data is not None:
+                self.store_data(new_id, data)
+
+        return orphans
 
 
 class DictStore(SoundStore):
@@ -55,12 +371,14 @@ class DictStore(SoundStore):
         """
         Provides a dictionary-backed sound storage. This is a non-persistent form of storage, as the dictionary is never written out to disk.
         :param read_only: flag to prevent writing to the database. (False)
+        :param id_allocator: "uuid", "counter" or an id allocator instance. ("uuid")
         """
 
         read_only = kwargs.get("read_only", False)
-        super(DictStore, self).__init__(read_only=read_only)
+        super(DictStore, self).__init__(read_only=read_only, id_allocator=kwargs.get("id_allocator", "uuid"))
         self.data = dict()
 
+    @locked
     def get_annotations(self, id_):
         """
         Get the annotations for the specified sound
@@ -72,6 +390,7 @@ class DictStore(SoundStore):
 
         return annotations
 
+    @locked
     def get_metadata(self, id_):
         """
         Get the transformation metadata for the specified sound
@@ -89,6 +408,7 @@ class DictStore(SoundStore):
 
         return metadata
 
+    @locked
     def get_data(self, id_):
         """
         Get the waveform data for the specified sound if stored
@@ -97,9 +417,37 @@ class DictStore(SoundStore):
         """
 
         if "waveform" in self.data[id_]:
-            return self.data[id_]["waveform"]
+            waveform = self.data[id_]["waveform"]
+            if isinstance(waveform, SparseWaveform):
+                return waveform.to_dense()
+            return waveform
+
+    @locked
+    def get_sparse_data(self, id_):
+        """
+        Get the waveform data for the specified sound as a SparseWaveform, without densifying it
+        :param id_: sound id
+        :return: a SparseWaveform or None if it doesn't exist
+        """
+
+        if "waveform" in self.data[id_]:
+            waveform = self.data[id_]["waveform"]
+            if not isinstance(waveform, SparseWaveform):
+                waveform = SparseWaveform.from_dense(waveform)
+            return waveform
+
+    @locked
+    def has_data(self, id_):
+        """
+        Check whether waveform data is stored for the specified sound, without reading it
+        :param id_: sound id
+        :return: True if the waveform is stored, else False
+        """
+
+        return "waveform" in self.data[id_]
 
     @writes
+    @locked
     def store_annotations(self, id_, **kwargs):
 
         self.data.setdefault(id_, dict()).update(kwargs)
@@ -107,6 +455,7 @@ class DictStore(SoundStore):
         return True
 
     @writes
+    @locked
     def store_metadata(self, id_, **kwargs):
 
         if "type" in kwargs:
@@ -117,12 +466,107 @@ class DictStore(SoundStore):
         return True
 
     @writes
+    @locked
     def store_data(self, id_, data):
 
         self.data.setdefault(id_, dict())["waveform"] = data
 
         return True
 
+    @locked
+    def get_data_shape(self, id_):
+        """
+        Get the shape of the waveform data for the specified sound, without reading it
+        :param id_: sound id
+        :return: a tuple, or None if the waveform isn't stored
+        """
+
+        if "waveform" in self.data[id_]:
+            return self.data[id_]["waveform"].shape
+
+    @locked
+    def read_block(self, id_, start, stop):
+        """
+        Read a block of samples of the waveform data for the specified sound
+        :param id_: sound id
+        :param start: the first sample
+        :param stop: one past the last sample
+        :return: a numpy array
+        """
+
+        waveform = self.data[id_]["waveform"]
+        if isinstance(waveform, SparseWaveform):
+            return waveform.slice(start, min(stop, len(waveform))).to_dense()
+
+        return waveform[start: stop]
+
+    @writes
+    @locked
+    def create_data(self, id_, shape, dtype=float):
+        """
+        Creates empty waveform data for the specified sound, to be filled in with write_block
+        :param id_: sound id
+        :param shape: the shape of the waveform
+        :param dtype: the dtype of the waveform (float)
+        :return: True if the data was created, else False
+        """
+
+        return self.store_data(id_, np.zeros(shape, dtype=dtype))
+
+    @writes
+    @locked
+    def write_block(self, id_, start, data):
+        """
+        Writes a block of samples into waveform data created with create_data
+        :param id_: sound id
+        :param start: the sample at which to write data
+        :param data: a numpy array of samples
+        :return: True if the data was written, else False
+        """
+
+        self.data[id_]["waveform"][start: start + len(data)] = data
+
+        return True
+
+    @locked_with_source
+    def copy_ids(self, store, id_map, **kwargs):
+        """
+        Copies the records for each id in id_map from store into this store. If store is also a DictStore, each
+        record is copied directly without going through the individual get and store methods.
+        :param store: the SoundStore to copy from
+        :param id_map: a dictionary mapping ids in store to new ids in this store
+        :param kwargs: all other kwargs are added as annotations to each copied id
+        :return: a list of ids (in store) whose parents were not all copied
+        """
+
+        if not isinstance(store, DictStore):
+            return super(DictStore, self).copy_ids(store, id_map, **kwargs)
+
+        if self.read_only:
+            return list()
+
+        orphans = list()
+        for id_, new_id in id_map.iteritems():
+            record = store.data[id_]
+            # Waveforms are shared rather than copied, as they are when imported through get_data
+            waveform = record.get("waveform")
+            record = copy.deepcopy(dict((key, value) for key, value in record.iteritems() if key != "waveform"))
+            if waveform is not None:
+                record["waveform"] = waveform
+            record.update(kwargs)
+
+            metadata = dict((key.split("transform_")[1], record.pop(key)) for key in record.keys()
+                            if key.startswith("transform_") and (key.split("transform_")[1] in remapped_keys))
+            metadata, complete = remap_lineage(metadata, id_map)
+            record.update(("transform_" + key, value) for key, value in metadata.iteritems())
+            if not complete:
+                orphans.append(id_)
+
+            self.data.setdefault(new_id, dict()).update(record)
+
+        return orphans
+
+    @locked
     def filter_ids(self, ids=None, num_matches=None, **kwargs):
 
         result_ids = list()
@@ -147,6 +591,7 @@ class DictStore(SoundStore):
 
         return result_ids
 
+    @locked
     def filter_by_func(self, ids=None, num_matches=None, **kwarg_funcs):
 
         result_ids = list()
@@ -171,6 +616,7 @@ class DictStore(SoundStore):
 
         return result_ids
 
+    @locked
     def list_ids(self):
 
         return self.data.keys()
@@ -190,36 +636,123 @@ class HDF5Store(SoundStore):
         Provides HDF5 file backed sound storage.
         :param filename: filename for HDF5 file. If it does not exist, it will be created.
         :param read_only: flag to prevent writing to the database. (False)
+        :param id_allocator: "uuid", "counter" or an id allocator instance. The allocator is recorded in the file
+        when it is created and is used by default when the file is reopened. Existing files can't change allocator.
+        (None, meaning the file's allocator, or "uuid" for a new file)
         """
 
         read_only = kwargs.get("read_only", False)
+        id_allocator = kwargs.get("id_allocator", None)
         super(HDF5Store, self).__init__(filename, read_only)
+        # Stores that share a file share a lock
+        self.lock = get_file_lock(self.filename)
+        self._file = None
 
         # Initialize the file if it doesn't exist
         # If the file is read_only, should I even create it?
         if not os.path.exists(self.filename):
-            if not self.read_only:
-                with h5py.File(self.filename, "a") as f:
-                    pass
-            else:
+            if self.read_only:
                 raise IOError("File %s cannot be opened read-only. It does not exist!" % self.filename)
+            with self._open("a") as f:
+                pass
+
+        with self.lock, self._open("r" if self.read_only else "a") as f:
+            # Files written before ids were configurable have no allocator recorded and use uuids
+            if "id_allocator" in f.attrs:
+                file_allocator = f.attrs["id_allocator"]
+            elif len(f) > 0:
+                file_allocator = UUIDAllocator.name
+            else:
+                file_allocator = get_allocator(id_allocator or UUIDAllocator.name).name
+            if id_allocator is None:
+                id_allocator = file_allocator
+            self.id_allocator = get_allocator(id_allocator)
+            if self.id_allocator.name != file_allocator:
+                raise ValueError("File %s uses %s ids. Cannot use a %s id allocator!" % (self.filename,
+                                                                                       file_allocator,
+                                                                                       self.id_allocator.name))
+
+            if "uid" in f.attrs:
+                self.uid = str(f.attrs["uid"])
+            elif self.read_only:
+                self.uid = str(uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(self.filename)))
+            if not self.read_only:
+                f.attrs["id_allocator"] = file_allocator
+                f.attrs["uid"] = self.uid
+        _live_stores[self.uid] = self
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager that keeps the file open (and the store locked) so that a batch of reads and writes only
+        opens the file once.
+
+        Example:
+        with store.batch():
+            for id_, data in waveforms.iteritems():
+                store.store_data(id_, data)
+        """
 
+        with self.lock:
+            if self._file is not None:
+                yield self
+                return
+
+            with h5py.File(self.filename, "r" if self.read_only else "a") as f:
+                self._file = f
+                try:
+                    yield self
+                finally:
+                    self._file = None
+
+    @contextlib.contextmanager
+    def _open(self, mode="r"):
+        """
+        Opens the file, or reuses the file that is open for the current batch.
+        """
+
+        if self._file is not None:
+            yield self._file
+        else:
+            with h5py.File(self.filename, mode) as f:
+                yield f
+
+    @locked
+    def reserve_ids(self, count):
+        """
+        Reserves a block of integer ids for a CounterAllocator. The counter is kept in the file so ids are never
+        reused when it is reopened.
+        :param count: the number of ids to reserve
+        :return: the first reserved id and one past the last reserved id
+        """
+
+        with self._open("r" if self.read_only else "a") as f:
+            # A read-only store can't write its counter, but the ids it allocates are never stored anyway
+            start = max(int(f.attrs.get("next_id", 1)), self._next_id)
+            self._next_id = start + count
+            if not self.read_only:
+                f.attrs["next_id"] = self._next_id
+
+        return start, self._next_id
 
     def _get_group(self, f, group_name):
 
         if group_name in f:
             g = f[group_name]
         else:
-            if self.read_only:
+            # Reads of unknown ids (e.g. sounds whose annotations are deferred) can't create their group
+            if self.read_only or (f.file.mode == "r"):
                 g = False
             else:
                 g = f.create_group(group_name)
         return g
 
+    @locked
     def get_annotations(self, id_, ds=None):
 
         id_ = unicode(id_)
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             g = self._get_group(f, id_)
             if g:
                 if ds is not None:
@@ -232,10 +765,11 @@ class HDF5Store(SoundStore):
             else:
                 raise KeyError("Requested data for id %s doesn't exist!" % id_)
 
+    @locked
     def get_metadata(self, id_):
 
         id_ = unicode(id_)
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             g = self._get_group(f, id_)
             if g:
                 metadata = dict()
@@ -244,24 +778,67 @@ class HDF5Store(SoundStore):
                         key = key.split("transform_")[1]
                         if key == "type":
                             val = getattr(sound_transforms, val)
-                        elif key in ["children", "parents"]:
+                        elif key in lineage_keys:
                             val = val.tolist()
                         metadata[key] = val
                 return metadata
             else:
                 raise KeyError("Requested data for id %s doesn't exist!" % id_)
 
+    @locked
     def get_data(self, id_, name="waveform"):
 
         id_ = unicode(id_)
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             g = self._get_group(f, id_)
             if g:
                 if name in g:
+                    if isinstance(g[name], h5py.Group):
+                        return self._read_sparse(g[name]).to_dense()
                     return g[name][:]
             else:
                 raise KeyError("Requested data for id %s doesn't exist!" % id_)
 
+    @locked
+    def get_sparse_data(self, id_, name="waveform"):
+        """
+        Get the waveform data for the specified sound as a SparseWaveform, without densifying it
+        :param id_: Unique sound id
+        :param name: the name of the dataset ("waveform")
+        :return: a SparseWaveform or None if it doesn't exist
+        """
+
+        id_ = unicode(id_)
+        with self._open("r") as f:
+            g = self._get_group(f, id_)
+            if g:
+                if name in g:
+                    if isinstance(g[name], h5py.Group):
+                        return self._read_sparse(g[name])
+                    return SparseWaveform.from_dense(g[name][:])
+            else:
+                raise KeyError("Requested data for id %s doesn't exist!" % id_)
+
+    @staticmethod
+    def _read_sparse(g):
+        """
+        Reads a SparseWaveform from the group that stores it
+        """
+
+        return SparseWaveform.from_arrays(g.attrs["nsamples"], g["offsets"][:], g["lengths"][:], g["values"][:])
+
+    @locked
+    def has_data(self, id_, name="waveform"):
+
+        id_ = unicode(id_)
+        with self._open("r") as f:
+            g = self._get_group(f, id_)
+            if g:
+                return name in g
+            else:
+                raise KeyError("Requested data for id %s doesn't exist!" % id_)
+
+    @locked
     def list_data(self, id_):
         """
         Lists the datasets stored for the specified id
@@ -270,16 +847,17 @@ class HDF5Store(SoundStore):
         """
 
         id_ = unicode(id_)
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             g = self._get_group(f, id_)
 
             return g.keys()
 
     @writes
+    @locked
     def store_annotations(self, id_, ds=None, **kwargs):
 
         id_ = unicode(id_)
-        with h5py.File(self.filename, "a") as f:
+        with self._open("a") as f:
             g = self._get_group(f, id_)
             if ds is not None:
                 if ds in g:
@@ -292,13 +870,14 @@ class HDF5Store(SoundStore):
         return True
 
     @writes
+    @locked
     def store_metadata(self, id_, **kwargs):
 
         id_ = unicode(id_)
         if "type" in kwargs:
             kwargs["type"] = kwargs["type"].__name__
 
-        with h5py.File(self.filename, "a") as f:
+        with self._open("a") as f:
             g = self._get_group(f, id_)
             for key, value in kwargs.iteritems():
                 key = "transform_" + key
@@ -309,14 +888,25 @@ class HDF5Store(SoundStore):
         return True
 
     @writes
+    @locked
     def store_data(self, id_, data, name="waveform", overwrite=True):
 
         id_ = unicode(id_)
-        with h5py.File(self.filename, "a") as f:
+        with self._open("a") as f:
             g = self._get_group(f, id_)
 
+            # Sparse waveforms are stored as a group of the arrays from SparseWaveform.to_arrays
+            if (name in g) and overwrite and (isinstance(data, SparseWaveform) or isinstance(g[name], h5py.Group)):
+                del g[name]
+
             if name not in g:
-                g.create_dataset(name, data=data)
+                if isinstance(data, SparseWaveform):
+                    sparse = g.create_group(name)
+                    for key, value in zip(["offsets", "lengths", "values"], data.to_arrays()):
+                        sparse.create_dataset(key, data=value)
+                    sparse.attrs["nsamples"] = data.nsamples
+                else:
+                    g.create_dataset(name, data=data)
             else:
                 # Will this work if data is not the same size as the current dataset?
                 if overwrite:
@@ -324,14 +914,114 @@ class HDF5Store(SoundStore):
 
         return True
 
+    @locked
+    def get_data_shape(self, id_, name="waveform"):
+
+        id_ = unicode(id_)
+        with self._open("r") as f:
+            g = self._get_group(f, id_)
+            if g:
+                if name in g:
+                    if isinstance(g[name], h5py.Group):
+                        return int(g[name].attrs["nsamples"]), g[name]["values"].shape[1]
+                    return g[name].shape
+            else:
+                raise KeyError("Requested data for id %s doesn't exist!" % id_)
+
+    @locked
+    def read_block(self, id_, start, stop, name="waveform"):
+
+        id_ = unicode(id_)
+        with self._open("r") as f:
+            if isinstance(f[id_][name], h5py.Group):
+                sparse = self._read_sparse(f[id_][name])
+                return sparse.slice(start, min(stop, len(sparse))).to_dense()
+            return f[id_][name][start: stop]
+
+    @writes
+    @locked
+    def create_data(self, id_, shape, dtype=float, name="waveform"):
+
+        id_ = unicode(id_)
+        with self._open("a") as f:
+            g = self._get_group(f, id_)
+            if name in g:
+                del g[name]
+            g.create_dataset(name, shape=shape, dtype=dtype, chunks=True)
+
+        return True
+
+    @writes
+    @locked
+    def write_block(self, id_, start, data, name="waveform"):
+
+        id_ = unicode(id_)
+        with self._open("a") as f:
+            f[id_][name][start: start + len(data)] = data
+
+        return True
+
+    @locked_with_source
+    def copy_ids(self, store, id_map, **kwargs):
+        """
+        Copies the records for each id in id_map from store into this store. If store is also an HDF5Store, the
+        groups are copied directly between the two files with h5py's copy, opening each file only once.
+        :param store: the SoundStore to copy from
+        :param id_map: a dictionary mapping ids in store to new ids in this store
+        :param kwargs: all other kwargs are added as annotations to each copied id
+        :return: a list of ids (in store) whose parents were not all copied
+        """
+
+        if not isinstance(store, HDF5Store):
+            return super(HDF5Store, self).copy_ids(store, id_map, **kwargs)
+
+        if self.read_only:
+            return list()
+
+        with self._open("a") as f:
+            if os.path.abspath(store.filename) == os.path.abspath(self.filename):
+                return self._copy_groups(f, f, id_map, **kwargs)
+            with store._open("r") as src:
+                return self._copy_groups(src, f, id_map, **kwargs)
+
+    @staticmethod
+    def _copy_groups(src, f, id_map, **kwargs):
+        """
+        Copies the groups for each id in id_map from the open file src to the open file f, remapping their lineage
+        :return: a list of ids (in src) whose parents were not all copied
+        """
+
+        orphans = list()
+        for id_, new_id in id_map.iteritems():
+            src.copy(src[unicode(id_)], f, name=unicode(new_id))
+            g = f[unicode(new_id)]
+
+            metadata = dict()
+            for key in remapped_keys:
+                if ("transform_" + key) in g.attrs:
+                    value = g.attrs["transform_" + key]
+                    metadata[key] = value.tolist() if key in lineage_keys else value
+                    del g.attrs["transform_" + key]
+            metadata, complete = remap_lineage(metadata, id_map)
+            for key, value in metadata.iteritems():
+                g.attrs["transform_" + key] = value
+            if not complete:
+                orphans.append(id_)
+
+            for key, value in kwargs.iteritems():
+                g.attrs[key] = value
+
+        return orphans
+
+    @locked
     def filter_ids(self, ids=None, num_matches=None, **kwargs):
 
         result_ids = list()
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             if ids is None:
-                ids = f.iterkeys()
+                ids = (self.id_allocator.parse(name) for name in f.iterkeys())
             for name in ids:
-                group = f[name]
+                group = f[unicode(name)]
                 match = True
                 for key, value in kwargs.iteritems():
                     if key in group.attrs:
@@ -349,14 +1039,15 @@ class HDF5Store(SoundStore):
 
         return result_ids
 
+    @locked
     def filter_by_func(self, ids=None, num_matches=None, **kwarg_funcs):
 
         result_ids = list()
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             if ids is None:
-                ids = f.iterkeys()
+                ids = (self.id_allocator.parse(name) for name in f.iterkeys())
             for name in ids:
-                group = f[name]
+                group = f[unicode(name)]
                 match = True
                 for key, func in kwarg_funcs.iteritems():
                     try:
@@ -374,19 +1065,200 @@ class HDF5Store(SoundStore):
 
         return result_ids
 
+    @locked
     def list_ids(self):
 
-        with h5py.File(self.filename, "r") as f:
-            return f.keys()
+        with self._open("r") as f:
+            return [self.id_allocator.parse(name) for name in f.iterkeys()]
 
+    @locked
     def list_annotation_values(self, key):
 
         values = list()
-        with h5py.File(self.filename, "r") as f:
+        with self._open("r") as f:
             for name, group in f.iteritems():
                 if key in group.attrs:
                     value = group.attrs[key]
                     if value not in values:
                         values.append(value)
 
-        return values
\ No newline at end of file
+        return values
+
+class WriteBehindStore(object):
+    """
+    Wraps another store so that writes are queued and applied by a background thread, in batches, instead of making
+    the caller wait on them. Reads wait for all queued writes to be applied first, so they always see every write
+    made before them. Errors raised while writing are re-raised by the next write, flush or close.
+
+    Waveform arrays are queued without being copied, so they must not be modified after they are stored.
+    """
+
+    def __init__(self, store, max_pending=1000, max_bytes=256 * 1024 ** 2, batch_size=100):
+        """
+        :param store: the SoundStore to write to
+        :param max_pending: the maximum number of queued writes. Writers block while the queue is full. (1000)
+        :param max_bytes: the maximum number of bytes of waveform data in the queue. Writers block while the queue
+        holds more than this, unless it is empty. (256 MB)
+        :param batch_size: the maximum number of writes applied in a single batch (100)
+        """
+
+        self.store = store
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._writing = 0
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write, name="WriteBehindStore")
+        self._thread.daemon = True
+        self._thread.start()
+        _write_behind_stores.add(self)
+        # Sounds unpickled in this process should write through the queue too
+        _live_stores[store.uid] = self
+
+    read_only = property(fget=lambda self: self.store.read_only,
+                         doc="The read-only flag of the wrapped store.")
+    filename = property(fget=lambda self: self.store.filename,
+                        doc="The filename of the wrapped store.")
+
+    def __reduce__(self):
+
+        return reattach_store, (self.store.uid, type(self.store), self.store.filename, self.store.read_only)
+
+    def get_id(self):
+
+        return self.store.get_id()
+
+    @writes
+    def store_annotations(self, id_, **kwargs):
+
+        return self._enqueue("store_annotations", (id_,), kwargs)
+
+    @writes
+    def store_metadata(self, id_, **kwargs):
+
+        return self._enqueue("store_metadata", (id_,), kwargs)
+
+    @writes
+    def store_data(self, id_, data, **kwargs):
+
+        return self._enqueue("store_data", (id_, data), kwargs, nbytes=getattr(data, "nbytes", 0))
+
+    @writes
+    def add_child(self, id_, child):
+
+        return self._enqueue("add_child", (id_, child), dict())
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Writes are already batched by the background thread, so this only holds the lock.
+        """
+
+        with self.lock:
+            yield self
+
+    def flush(self):
+        """
+        Waits until every queued write has been applied to the wrapped store.
+        """
+
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self):
+        """
+        Applies all queued writes and stops the background thread. Writing after closing raises an IOError.
+        """
+
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        _write_behind_stores.discard(self)
+        with self._condition:
+            self._raise_error()
+
+    def __getattr__(self, name):
+
+        # Only called for attributes that aren't defined here. Everything else reads the wrapped store, so any
+        # queued writes are applied first.
+        attr = getattr(self.store, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def flushed(*args, **kwargs):
+            self.flush()
+            return attr(*args, **kwargs)
+
+        return flushed
+
+    def _enqueue(self, method, args, kwargs, nbytes=0):
+
+        with self._condition:
+            self._raise_error()
+            if self._closed:
+                raise IOError("WriteBehindStore has been closed. Cannot write!")
+            while self._pending and ((len(self._pending) >= self.max_pending) or
+                                     (self._pending_bytes + nbytes > self.max_bytes)):
+                self._condition.wait()
+                self._raise_error()
+            self._pending.append((method, args, kwargs, nbytes))
+            self._pending_bytes += nbytes
+            self._condition.notify_all()
+
+        return True
+
+    def _raise_error(self):
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self):
+
+        while True:
+            with self._condition:
+                while not (self._pending or self._closed):
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                batch = [self._pending.popleft() for _ in xrange(min(self.batch_size, len(self._pending)))]
+                self._writing = len(batch)
+
+            try:
+                with self.store.batch():
+                    for method, args, kwargs, nbytes in batch:
+                        getattr(self.store, method)(*args, **kwargs)
+            except Exception as e:
+                with self._condition:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                with self._condition:
+                    self._pending_bytes -= sum(record[-1] for record in batch)
+                    self._writing = 0
+                    self._condition.notify_all()
+
+
+_write_behind_stores = weakref.WeakSet()
+
+
+@atexit.register
+def _close_write_behind_stores():
+
+    for store in list(_write_behind_stores):
+        try:
+            store.close()
+        except Exception:
+            pass
@@ -3,6 +3,7 @@ import re
 from brian import second, Quantity, units, hertz
 from brian.hears import dB, dB_type
 from numpy import asarray
+import numpy as np
 
 
 class SoundTransform(object):
@@ -10,6 +11,9 @@ class SoundTransform(object):
     Generic sound transform. Sound transform classes are designed to enable storing and reconstructing of sound objects from transformation metadata. Basically, by storing how each sound is generated by intializing (e.g. loading or creating a sound) or transforming a parent sound object, we can reconstruct the resulting sound exactly without needing to store it.
     """
 
+    # True if the transform is linear in its parents' waveforms, so that silent inputs give a silent output
+    linear = False
+
     def __init__(self, manager, derived, metadata, original=None):
 
         self.manager = manager
@@ -37,11 +41,7 @@ class SoundTransform(object):
 
         stored = True
         for parent in parents:
-            metadata = self.manager.database.get_metadata(parent)
-            children = metadata.get("children", list())
-            children.append(child)
-            stored = stored and self.manager.database.store_metadata(parent,
-                                                                     children=children)
+            stored = self.manager.database.add_child(parent, child) and stored
 
         return stored
 
@@ -144,6 +144,8 @@ class MonoTransform(SoundTransform):
     """
     Stores data corresponding to converting a multi-channel sound to mono.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -163,6 +165,8 @@ class ChannelTransform(SoundTransform):
     """
     Stores data corresponding to extracting a channel from a multi-channel sound.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -182,6 +186,8 @@ class FilterTransform(SoundTransform):
     """
     Stores data corresponding to applying a filter to a sound.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -196,15 +202,21 @@ class FilterTransform(SoundTransform):
         frequency_range = [metadata["min_frequency"]*hertz,
                            metadata["max_frequency"]*hertz]
 
+        # Filters stored before there were multiple engines used filtfilt
+        kwargs = dict((key, metadata[key]) for key in ["engine", "design", "ripple", "attenuation"] if key in metadata)
+
         return sound.filter(frequency_range,
                             filter_order=metadata["order"],
-                            read_only=True)
+                            read_only=True,
+                            **kwargs)
 
 
 class RampTransform(SoundTransform):
     """
     Stores data corresponding to applying a ramp to a sound.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -226,6 +238,8 @@ class ResampleTransform(SoundTransform):
     """
     Stores data related to resampling a sound.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -247,6 +261,8 @@ class PadTransform(SoundTransform):
     """
     Stores data related to padding a sound with zeros.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -258,11 +274,64 @@ class PadTransform(SoundTransform):
         else:
             samplerate = metadata["samplerate"]*hertz
 
-        sound = Sound(waveforms[0], samplerate=samplerate, manager=manager)
-        start = metadata["start_time"]*second
-        duration = metadata["duration"]*second
+        # Sound.pad rounds its times before storing them, so the stored times are laid out directly rather than
+        # being rounded again by Sound.pad
+        data = asarray(waveforms[0])
+        nsamples, start, stop, offset = PadTransform.layout(metadata, float(samplerate), len(data))
+        padded = np.zeros((nsamples, data.shape[1]))
+        padded[start: stop] = data[start + offset: stop + offset]
+
+        return Sound._wrap(padded, samplerate, manager=manager)
 
-        return sound.pad(duration, start=start, read_only=True)
+    @staticmethod
+    def window(metadata, samplerate, nsamples):
+        """
+        Computes the samples of the padded sound with the same rounding as Sound.pad.
+        :param metadata: the pad transformation metadata
+        :param samplerate: samplerate of the sound in hertz, as a float
+        :param nsamples: number of samples in the sound
+        :return: a list of (shift, nsamples) windows, where sample j of each window is sample j + shift of the
+        previous one
+        """
+
+        duration = metadata["duration"]
+        if duration < nsamples / samplerate: # Sound.pad leaves the sound unchanged
+            return list()
+
+        sampleperiod = 1 / samplerate
+        start = int(metadata["start_time"] * samplerate) * sampleperiod
+        duration = int(duration * samplerate) * sampleperiod
+        stop = start + nsamples / samplerate
+
+        # Extend the end, then shift the start. Extending slices the sound up to the new length, so a negative
+        # length is wrapped as a negative index: once by __getslice__ and then again by numpy.
+        extended = nsamples + int(np.rint((duration - stop) * samplerate))
+        if extended < 0:
+            extended += nsamples
+        if extended < 0:
+            extended = max(extended + nsamples, 0)
+        shift = int(np.rint(start * samplerate))
+
+        return [(0, extended), (-shift, max(extended + shift, 0))]
+
+    @staticmethod
+    def layout(metadata, samplerate, nsamples):
+        """
+        Computes where the samples of the sound end up in the padded sound, with the same rounding as Sound.pad.
+        :param metadata: the pad transformation metadata
+        :param samplerate: samplerate of the sound in hertz, as a float
+        :param nsamples: number of samples in the sound
+        :return: the number of samples in the padded sound, and the start, stop and offset of the span that holds the
+        sound's samples, such that padded[start: stop] == sound[start + offset: stop + offset]
+        """
+
+        start, stop, offset = 0, nsamples, 0
+        for shift, nsamples in PadTransform.window(metadata, samplerate, nsamples):
+            start = max(start - shift, 0)
+            stop = max(min(stop - shift, nsamples), start)
+            offset += shift
+
+        return nsamples, start, stop, offset
 
 
 class ClipTransform(SoundTransform):
@@ -285,11 +354,21 @@ class ClipTransform(SoundTransform):
         return sound.clip(metadata["max_value"], metadata["min_value"],
                           read_only=True)
 
+    @staticmethod
+    def apply(data, metadata):
+        """
+        Clips an array in place, as Sound.clip does.
+        """
+
+        np.clip(data, metadata["min_value"], metadata["max_value"], out=data)
+
 
 class SliceTransform(SoundTransform):
     """
     Stores data about slicing a segment out of a sound.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -307,11 +386,38 @@ class SliceTransform(SoundTransform):
 
         return sound.slice(start, stop, read_only=True)
 
+    @staticmethod
+    def window(metadata, samplerate, nsamples):
+        """
+        Computes the samples of the sliced sound with the same rounding as Sound.slice.
+        :param metadata: the slice transformation metadata
+        :param samplerate: samplerate of the sound in hertz, as a float
+        :param nsamples: number of samples in the sound
+        :return: a list of (shift, nsamples) windows, where sample j of each window is sample j + shift of the
+        previous one
+        """
+
+        sampleperiod = 1 / samplerate
+        start = int(metadata["start_time"] * samplerate) * sampleperiod
+        stop = int(metadata["stop_time"] * samplerate) * sampleperiod
+        # Time-based indexing treats a stop time of 0 as unspecified
+        if not stop:
+            stop = nsamples / samplerate
+        start = int(np.rint(start * samplerate))
+        stop = int(np.rint(stop * samplerate))
+
+        if (start >= 0) and (stop <= nsamples):
+            return [(start, max(stop - start, 0))]
+        else: # Slices outside of the sound are padded with zeros
+            return [(start, max(-start, 0) + max(min(stop, nsamples) - max(start, 0), 0) + max(stop - nsamples, 0))]
+
 
 class MultiplyTransform(SoundTransform):
     """
     Stores data about scaling a sound
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -327,10 +433,24 @@ class MultiplyTransform(SoundTransform):
 
         return sound.scale(metadata["coefficients"], read_only=True)
 
+    @staticmethod
+    def apply(data, metadata):
+        """
+        Scales an array in place, as Sound.scale does.
+        """
+
+        coefficients = metadata["coefficients"]
+        if isinstance(coefficients, dB_type):
+            coefficients = coefficients.gain()
+
+        data *= coefficients
+
 class AddTransform(SoundTransform):
     """
     Stores data about adding two sounds together.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -348,10 +468,121 @@ class AddTransform(SoundTransform):
         return sound0.combine(sound1, read_only=True)
 
 
+class MixTransform(SoundTransform):
+    """
+    Stores data about mixing any number of sounds, each at its own offset and gain.
+    """
+
+    linear = True
+    @staticmethod
+    def reconstruct(waveforms, metadata, manager=None):
+        from neosound.sound import Sound
+
+        manager.logger.debug("Reconstructing mix transform")
+
+        if hasattr(waveforms[0], "samplerate"):
+            samplerate = waveforms[0].samplerate
+        else:
+            samplerate = metadata["samplerate"]*hertz
+
+        mixed = MixTransform.accumulate([asarray(waveform) for waveform in waveforms], metadata, float(samplerate))
+
+        return Sound._wrap(mixed, samplerate, manager=manager)
+
+    @staticmethod
+    def accumulate(waveforms, metadata, samplerate):
+        """
+        Adds each waveform into a single output array at its offset, scaled by its gain
+        :param waveforms: a list of arrays of shape (nsamples, nchannels)
+        :param metadata: the mix transformation metadata
+        :param samplerate: samplerate of the sounds in hertz, as a float
+        :return: the mixed array
+        """
+
+        nsamples = int(np.rint(metadata["duration"] * samplerate))
+        mixed = np.zeros((nsamples, waveforms[0].shape[1]))
+        for waveform, offset, gain in zip(waveforms, metadata["offsets"], np.asarray(metadata["gains"], dtype=float)):
+            start = int(np.rint(offset * samplerate))
+            stop = min(start + len(waveform), nsamples)
+            if stop <= start:
+                continue
+            if np.all(gain == 1):
+                mixed[start: stop] += waveform[:stop - start]
+            else:
+                mixed[start: stop] += gain * waveform[:stop - start]
+
+        return mixed
+
+
+class ConcatenateTransform(SoundTransform):
+    """
+    Stores data about concatenating sounds with gaps between them. The start of each sound is stored as a sample
+    index.
+    """
+
+    linear = True
+    @staticmethod
+    def reconstruct(waveforms, metadata, manager=None):
+        from neosound.sound import Sound
+
+        manager.logger.debug("Reconstructing concatenate transform")
+
+        if hasattr(waveforms[0], "samplerate"):
+            samplerate = waveforms[0].samplerate
+        else:
+            samplerate = metadata["samplerate"]*hertz
+
+        concatenated = ConcatenateTransform.render([asarray(waveform) for waveform in waveforms], metadata)
+
+        return Sound._wrap(concatenated, samplerate, manager=manager)
+
+    @staticmethod
+    def render(waveforms, metadata, start=0, stop=None):
+        """
+        Copies the waveforms into a single array at their starts, or just the part of it from start to stop
+        :param waveforms: a list of arrays of shape (nsamples, nchannels), one for each parent. Waveforms of parents
+        that don't overlap start to stop can be None.
+        :param metadata: the concatenate transformation metadata
+        :param start: the first sample to render (0)
+        :param stop: one past the last sample to render (the end of the concatenated sound)
+        :return: the concatenated array
+        """
+
+        if stop is None:
+            stop = metadata["nsamples"]
+        nchannels = [waveform.shape[1] for waveform in waveforms if waveform is not None][0]
+        concatenated = np.zeros((stop - start, nchannels))
+        for waveform, offset in zip(waveforms, metadata["starts"]):
+            if waveform is None:
+                continue
+            first = max(offset, start)
+            last = min(offset + len(waveform), stop)
+            if last > first:
+                concatenated[first - start: last - start] = waveform[first - offset: last - offset]
+
+        return concatenated
+
+    @staticmethod
+    def overlapping(metadata, lengths, start, stop):
+        """
+        Finds the parents that overlap part of the concatenated sound
+        :param metadata: the concatenate transformation metadata
+        :param lengths: the number of samples in each parent
+        :param start: the first sample of the part
+        :param stop: one past the last sample of the part
+        :return: a list of the indices of the overlapping parents
+        """
+
+        return [ii for ii, (offset, length) in enumerate(zip(metadata["starts"], lengths))
+                if (offset < stop) and (offset + length > start)]
+
+
 class SetTransform(SoundTransform):
     """
     Stores data about replacing a segment of sound with another.
     """
+
+    linear = True
     @staticmethod
     def reconstruct(waveforms, metadata, manager=None):
         from neosound.sound import Sound
@@ -373,6 +604,81 @@ class SetTransform(SoundTransform):
                              read_only=True)
 
 
+class EmbedTransform(SoundTransform):
+    """
+    Stores data about embedding a sound in another: both sounds are padded to the same duration, the other sound is
+    scaled by a gain and they are added together. The gain that was applied is stored, so the transform is linear in
+    each sound and can be decomposed into components.
+    """
+
+    linear = True
+    @staticmethod
+    def reconstruct(waveforms, metadata, manager=None):
+        from neosound.sound import Sound
+
+        manager.logger.debug("Reconstructing embed transform")
+
+        if hasattr(waveforms[0], "samplerate"):
+            samplerate = waveforms[0].samplerate
+        else:
+            samplerate = metadata["samplerate"]*hertz
+
+        data = asarray(waveforms[0])
+        other = asarray(waveforms[1])
+        nsamples, spans = EmbedTransform.layout(metadata, float(samplerate), len(data), len(other))
+        (first, last, offset), (other_first, other_last, other_offset) = spans
+
+        embedded = np.zeros((nsamples, data.shape[1]))
+        embedded[first: last] = data[first + offset: last + offset]
+        embedded[other_first: other_last] += metadata["gain"] * other[other_first + other_offset:
+                                                                      other_last + other_offset]
+
+        return Sound._wrap(embedded, samplerate, manager=manager)
+
+    @staticmethod
+    def layout(metadata, samplerate, nsamples, other_nsamples):
+        """
+        Computes where the samples of both sounds end up in the embedded sound. Each is padded as Sound.pad would
+        pad it: the sound at the embedding start time and the other sound at the beginning.
+        :param metadata: the embed transformation metadata
+        :param samplerate: samplerate of the sounds in hertz, as a float
+        :param nsamples: number of samples in the sound
+        :param other_nsamples: number of samples in the other sound
+        :return: the number of samples in the embedded sound, and the (start, stop, offset) span of each sound as
+        returned by PadTransform.layout
+        """
+
+        nsound, first, last, offset = PadTransform.layout(metadata, samplerate, nsamples)
+        nother, other_first, other_last, other_offset = PadTransform.layout(dict(metadata, start_time=0.0),
+                                                                            samplerate,
+                                                                            other_nsamples)
+
+        return max(nsound, nother), ((first, last, offset), (other_first, other_last, other_offset))
+
+
+class SpectrumMatchedNoiseTransform(SoundTransform):
+    """
+    Stores data about generating noise with the magnitude spectrum and level of a sound. The random seed of the
+    phases is stored, so the noise is reconstructed from its parent rather than stored with its data.
+    """
+
+    @staticmethod
+    def reconstruct(waveforms, metadata, manager=None):
+        from neosound.sound import Sound
+
+        if hasattr(waveforms[0], "samplerate"):
+            samplerate = waveforms[0].samplerate
+        else:
+            samplerate = metadata["samplerate"]*hertz
+
+        manager.logger.debug("Reconstructing spectrum matched noise")
+        sound = Sound(waveforms[0], samplerate=samplerate, manager=manager)
+        nsamples = int(round(metadata["duration"] * float(samplerate)))
+        noise = sound._spectrum_matched_tokens(nsamples, [metadata["seed"]])[0]
+
+        return Sound._wrap(noise, samplerate, manager=manager)
+
+
 class ComponentTransform(SoundTransform):
 
     @staticmethod
@@ -381,3 +687,54 @@ class ComponentTransform(SoundTransform):
         manager.logger.debug("Reconstructing component")
 
         return manager.reconstruct_individual(metadata["id"], metadata["root_id"])
+
+
+class FusedTransform(SoundTransform):
+    """
+    Applies a chain of slice, pad, multiply and clip transforms to a sound in a single pass. The slices and pads are
+    composed into a single window that is copied out of the parent sound once, and the multiplies and clips are then
+    applied in place, each over the span of samples it covered in the original chain, so the result is identical to
+    reconstructing each transform separately. These are only created when planning a reconstruction and are never
+    stored.
+    """
+
+    fusable = (SliceTransform, PadTransform, MultiplyTransform, ClipTransform)
+
+    @classmethod
+    def can_fuse(cls, metadata):
+
+        return (metadata["type"] in cls.fusable) and (len(metadata.get("parents", list())) == 1)
+
+    @staticmethod
+    def reconstruct(waveforms, metadata, manager=None):
+        from neosound.sound import Sound
+
+        manager.logger.debug("Reconstructing %d fused transforms" % len(metadata["steps"]))
+
+        samplerate = float(waveforms[0].samplerate)
+        data = asarray(waveforms[0])
+
+        # The span of the current sound that holds the parent's data and its offset into the parent's data
+        nsamples = data.shape[0]
+        start, stop, offset = 0, nsamples, 0
+        # The pointwise operations and the span of the current sound they are applied to
+        operations = list()
+        for step in metadata["steps"]:
+            if hasattr(step["type"], "apply"):
+                operations.append([step, 0, nsamples])
+                continue
+
+            for shift, nsamples in step["type"].window(step, samplerate, nsamples):
+                start = max(start - shift, 0)
+                stop = max(min(stop - shift, nsamples), start)
+                offset += shift
+                for operation in operations:
+                    operation[1] = max(operation[1] - shift, 0)
+                    operation[2] = max(min(operation[2] - shift, nsamples), operation[1])
+
+        fused = np.zeros((nsamples, data.shape[1]))
+        fused[start: stop] = data[start + offset: stop + offset]
+        for step, op_start, op_stop in operations:
+            step["type"].apply(fused[op_start: op_stop], step)
+
+        return Sound._wrap(fused, samplerate * hertz, manager=manager)
@@ -0,0 +1,244 @@
+import numpy as np
+
+
+def _as_2d(data):
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data.reshape((-1, 1))
+
+    return data
+
+
+def _segment_bounds(nonzero, min_gap):
+    """
+    Finds the [start, stop) bounds of the segments of a waveform
+    :param nonzero: a boolean array that is True for each sample that is not zero in any channel
+    :param min_gap: see SparseWaveform.from_dense
+    :return: a list of [start, stop] pairs
+    """
+
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], nonzero, [False]]).astype(np.int8)))
+
+    bounds = list()
+    for start, stop in zip(edges[::2], edges[1::2]):
+        if bounds and (start - bounds[-1][1] < min_gap):
+            bounds[-1][1] = stop
+        else:
+            bounds.append([start, stop])
+
+    return bounds
+
+
+class SparseWaveform(object):
+    """
+    A waveform that is mostly silence, stored as a list of (offset, chunk) segments of samples that are not all zero.
+    Padded and embedded sounds, silences and sparse click trains take a small fraction of the memory and storage of
+    the dense waveform. Slicing, scaling and adding work on the segments directly, and the waveform is densified
+    whenever it is used as an array (e.g. np.asarray or Sound(sparse, samplerate=...)).
+
+    Example:
+    sparse = SparseWaveform.from_dense(np.asarray(sound))
+    louder = sparse.scale(2).slice(0, 44100)
+    data = louder.to_dense()
+    """
+
+    dtype = np.dtype(float)
+
+    def __init__(self, nsamples, nchannels, segments=None):
+        """
+        :param nsamples: the number of samples in the waveform
+        :param nchannels: the number of channels in the waveform
+        :param segments: a list of (offset, chunk) tuples, sorted by offset and not overlapping, where each chunk is
+        an array of shape (length, nchannels). Samples outside of every segment are zero. (no segments)
+        """
+
+        self.nsamples = int(nsamples)
+        self.nchannels = int(nchannels)
+        self.segments = [(int(offset), np.asarray(chunk, dtype=float).reshape((-1, self.nchannels)))
+                         for offset, chunk in (segments or list())]
+
+    shape = property(fget=lambda self: (self.nsamples, self.nchannels),
+                     doc="The shape of the dense waveform.")
+    nbytes = property(fget=lambda self: sum(chunk.nbytes for offset, chunk in self.segments) + 16 * len(self.segments),
+                      doc="The number of bytes used by the segments and their offsets.")
+    density = property(fget=lambda self: (sum(len(chunk) for offset, chunk in self.segments) /
+                                          float(max(self.nsamples, 1))),
+                       doc="The fraction of the samples that are stored in segments.")
+
+    @classmethod
+    def from_dense(cls, data, min_gap=256):
+        """
+        Finds the segments of a dense waveform
+        :param data: an array of shape (nsamples, nchannels), or (nsamples,) for a mono waveform
+        :param min_gap: runs of fewer than this many zero samples are kept inside a segment rather than splitting it,
+        so that quiet passages with the odd zero sample don't fragment into many segments (256)
+        :return: a SparseWaveform
+        """
+
+        data = _as_2d(data)
+        bounds = _segment_bounds(np.any(data != 0, axis=1), min_gap)
+
+        return cls._from_bounds(data, bounds)
+
+    @classmethod
+    def _from_bounds(cls, data, bounds):
+
+        return cls(data.shape[0], data.shape[1], [(start, data[start: stop].copy()) for start, stop in bounds])
+
+    @classmethod
+    def from_arrays(cls, nsamples, offsets, lengths, values):
+        """
+        Creates a SparseWaveform from the arrays returned by to_arrays
+        """
+
+        values = np.asarray(values, dtype=float)
+        chunks = np.split(values, np.cumsum(lengths)[:-1]) if len(lengths) else list()
+
+        return cls(nsamples, values.shape[1], zip(offsets, chunks))
+
+    def to_arrays(self):
+        """
+        Converts the segments into flat arrays, for storage
+        :return: an int64 array of the offset of each segment, an int64 array of the length of each segment and an
+        array of shape (total length, nchannels) with the samples of every segment
+        """
+
+        offsets = np.array([offset for offset, chunk in self.segments], dtype=np.int64)
+        lengths = np.array([len(chunk) for offset, chunk in self.segments], dtype=np.int64)
+        if self.segments:
+            values = np.concatenate([chunk for offset, chunk in self.segments])
+        else:
+            values = np.zeros((0, self.nchannels))
+
+        return offsets, lengths, values
+
+    def to_dense(self):
+        """
+        :return: the waveform as an array of shape (nsamples, nchannels)
+        """
+
+        data = np.zeros(self.shape)
+        for offset, chunk in self.segments:
+            data[offset: offset + len(chunk)] = chunk
+
+        return data
+
+    def __array__(self, dtype=None):
+
+        data = self.to_dense()
+        if dtype is not None:
+            data = data.astype(dtype)
+
+        return data
+
+    def __len__(self):
+
+        return self.nsamples
+
+    def slice(self, start, stop=None):
+        """
+        Gets the samples from start to stop, without densifying them. Samples outside of the waveform are zero.
+        :param start: the first sample
+        :param stop: one past the last sample (the end of the waveform)
+        :return: a SparseWaveform with stop - start samples
+        """
+
+        if stop is None:
+            stop = self.nsamples
+
+        segments = list()
+        for offset, chunk in self.segments:
+            first = max(offset, start, 0)
+            last = min(offset + len(chunk), stop, self.nsamples)
+            if last > first:
+                segments.append((first - start, chunk[first - offset: last - offset]))
+
+        return SparseWaveform(max(stop - start, 0), self.nchannels, segments)
+
+    def scale(self, c):
+        """
+        Multiplies the waveform by c
+        :param c: a scale factor, or an array of shape (1, nchannels) with one for each channel
+        :return: a SparseWaveform
+        """
+
+        return SparseWaveform(self.nsamples, self.nchannels, [(offset, chunk * c) for offset, chunk in self.segments])
+
+    def add(self, other):
+        """
+        Adds another waveform of the same shape. Segments that overlap are merged.
+        :param other: a SparseWaveform, or a dense array which densifies the result
+        :return: a SparseWaveform, or an array if other is dense
+        """
+
+        if not isinstance(other, SparseWaveform):
+            return self.to_dense() + other
+
+        if other.shape != self.shape:
+            raise ValueError("Cannot add waveforms of shapes %s and %s" % (self.shape, other.shape))
+
+        spans = sorted([(offset, offset + len(chunk), chunk) for offset, chunk in self.segments + other.segments],
+                       key=lambda span: span[0])
+        merged = list()
+        for start, stop, chunk in spans:
+            if merged and (start <= merged[-1][1]):
+                merged[-1][1] = max(merged[-1][1], stop)
+                merged[-1][2].append((start, chunk))
+            else:
+                merged.append([start, stop, [(start, chunk)]])
+
+        segments = list()
+        for start, stop, chunks in merged:
+            if len(chunks) == 1:
+                segments.append((start, chunks[0][1]))
+                continue
+            summed = np.zeros((stop - start, self.nchannels))
+            for offset, chunk in chunks:
+                summed[offset - start: offset - start + len(chunk)] += chunk
+            segments.append((start, summed))
+
+        return SparseWaveform(self.nsamples, self.nchannels, segments)
+
+    __add__ = add
+    __radd__ = add
+
+    def __mul__(self, c):
+
+        return self.scale(c)
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+
+        return "SparseWaveform(nsamples=%d, nchannels=%d, segments=%d, density=%.3f)" % (self.nsamples,
+                                                                                        self.nchannels,
+                                                                                        len(self.segments),
+                                                                                        self.density)
+
+
+def sparsify(data, max_density=0.5, min_gap=256):
+    """
+    Converts a waveform to a SparseWaveform if that would store less than max_density of its samples
+    :param data: an array of shape (nsamples, nchannels)
+    :param max_density: the largest fraction of samples that a sparse waveform may store (0.5)
+    :param min_gap: see SparseWaveform.from_dense (256)
+    :return: a SparseWaveform, or data if it isn't sparse enough
+    """
+
+    if isinstance(data, SparseWaveform):
+        return data
+
+    # Segments hold every nonzero sample, so a waveform with too many of them is dense whatever the segments are.
+    # Nothing is copied unless the waveform turns out to be sparse.
+    dense = _as_2d(data)
+    nonzero = np.any(dense != 0, axis=1)
+    nsamples = float(max(len(nonzero), 1))
+    if nonzero.sum() / nsamples > max_density:
+        return data
+
+    bounds = _segment_bounds(nonzero, min_gap)
+    if sum(stop - start for start, stop in bounds) / nsamples > max_density:
+        return data
+
+    return SparseWaveform._from_bounds(dense, bounds)
@@ -0,0 +1,436 @@
+from __future__ import division
+import numpy as np
+from brian import Quantity, hertz, second
+from brian.hears import dB_type
+from scipy.signal import fftconvolve
+
+from neosound.dsp import StreamResampler, resample_ratio
+from neosound.sound_transforms import ClipTransform, MultiplyTransform, ResampleTransform, SliceTransform
+
+
+class BlockProcessor(object):
+    """
+    Base class for transforms that process a sound one block of samples at a time. Blocks are pushed through
+    process in order and flush returns whatever output is left once all of the input has been processed.
+    """
+
+    def begin(self, shape):
+        """
+        Prepares to process a sound
+        :param shape: the shape of the whole input sound
+        :return: the shape of the whole output sound
+        """
+
+        self.shape = shape
+
+        return shape
+
+    def process(self, block):
+        """
+        Processes the next block of input samples
+        :param block: an array of shape (nsamples, nchannels)
+        :return: the output samples that are ready
+        """
+
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        :return: the remaining output samples once all of the input has been processed
+        """
+
+        return np.zeros((0,) + self.shape[1:])
+
+
+class PointwiseProcessor(BlockProcessor):
+    """
+    Applies a function to each sample independently.
+    """
+
+    def __init__(self, func):
+        """
+        :param func: a function of a block of samples that returns a block of the same shape
+        """
+
+        self.func = func
+
+    def process(self, block):
+
+        return self.func(block)
+
+
+class WindowProcessor(BlockProcessor):
+    """
+    Selects a window of the input: sample j of the output is sample j + shift of the input, or zero if that is
+    outside of the input. This is how slices (and pads) are computed; see SliceTransform.window.
+    """
+
+    def __init__(self, shift, nsamples):
+        """
+        :param shift: the input sample of the first output sample
+        :param nsamples: the number of output samples
+        """
+
+        self.shift = shift
+        self.nsamples = nsamples
+
+    def begin(self, shape):
+
+        self.shape = shape
+        self._buffer = np.zeros((0,) + shape[1:])
+        self._buffer_start = 0
+        self._noutput = 0
+
+        return (self.nsamples,) + shape[1:]
+
+    def process(self, block):
+
+        self._buffer = np.concatenate([self._buffer, block])
+        ninput = self._buffer_start + len(self._buffer)
+
+        # Drop the input before the window
+        drop = min(max(self._noutput + self.shift - self._buffer_start, 0), len(self._buffer))
+        self._buffer = self._buffer[drop:]
+        self._buffer_start += drop
+
+        return self._output(min(self.nsamples, ninput - self.shift))
+
+    def flush(self):
+
+        return self._output(self.nsamples)
+
+    def _output(self, stop):
+
+        start = self._noutput
+        if stop <= start:
+            return np.zeros((0,) + self.shape[1:])
+
+        output = np.zeros((stop - start,) + self.shape[1:])
+        first = max(start + self.shift, self._buffer_start)
+        last = min(stop + self.shift, self._buffer_start + len(self._buffer))
+        if last > first:
+            output[first - self.shift - start: last - self.shift - start] = \
+                self._buffer[first - self._buffer_start: last - self._buffer_start]
+
+        # Drop the input that no later output needs
+        drop = min(max(stop + self.shift - self._buffer_start, 0), len(self._buffer))
+        self._buffer = self._buffer[drop:]
+        self._buffer_start += drop
+        self._noutput = stop
+
+        return output
+
+
+class ZeroPhaseFIRProcessor(BlockProcessor):
+    """
+    Applies an FIR filter forwards and backwards, as neosound.dsp.fft_filtfilt does, using overlap-save FFT
+    convolution. Only the filter's history and the samples needed for the odd extension at the edges are kept.
+    """
+
+    def __init__(self, b):
+        """
+        :param b: FIR filter coefficients
+        """
+
+        self.kernel = np.convolve(b, b[::-1])
+        self.half = len(b) - 1
+        self.ntaps = len(b)
+
+    def begin(self, shape):
+
+        self.shape = shape
+        self.padlen = min(3 * self.ntaps, shape[0] - 1)
+        # Short sounds are extended by fewer samples than half the kernel, so fft_filtfilt's convolution also sees
+        # zeros beyond the extension
+        self._nzeros = max(self.half - self.padlen, 0)
+        self._head = np.zeros((0,) + shape[1:])
+        self._tail = np.zeros((0,) + shape[1:])
+        self._buffer = None
+        # The index in the sound of the output centered on the first sample in the buffer
+        self._buffer_start = -(self.padlen + self._nzeros) + self.half
+        self._ninput = 0
+
+        return shape
+
+    def process(self, block):
+
+        self._ninput += len(block)
+        # Keep the end of the input for the odd extension at the end
+        self._tail = np.concatenate([self._tail, block])[-(self.padlen + 1):]
+
+        if self._buffer is None:
+            # Wait for enough samples to extend the start
+            self._head = np.concatenate([self._head, block])
+            if (len(self._head) < self.padlen + 1) and (self._ninput < self.shape[0]):
+                return np.zeros((0,) + self.shape[1:])
+            data = self._head
+            self._buffer = np.concatenate([np.zeros((self._nzeros,) + self.shape[1:]),
+                                           2 * data[:1] - data[self.padlen: 0: -1],
+                                           data])
+            self._head = None
+        else:
+            self._buffer = np.concatenate([self._buffer, block])
+
+        return self._output()
+
+    def flush(self):
+
+        if self._buffer is None:
+            return np.zeros((0,) + self.shape[1:])
+
+        data = self._tail
+        self._buffer = np.concatenate([self._buffer,
+                                       2 * data[-1:] - data[-2: -self.padlen - 2: -1],
+                                       np.zeros((self._nzeros,) + self.shape[1:])])
+
+        return self._output()
+
+    def _output(self):
+
+        if len(self._buffer) < len(self.kernel):
+            return np.zeros((0,) + self.shape[1:])
+
+        kernel = self.kernel.reshape((-1,) + (1,) * (len(self.shape) - 1))
+        output = fftconvolve(self._buffer, kernel, mode="valid")
+        first = self._buffer_start
+        self._buffer = self._buffer[len(output):]
+        self._buffer_start += len(output)
+
+        # Drop the outputs centered on the extensions
+        start = min(max(-first, 0), len(output))
+        stop = max(min(self.shape[0] - first, len(output)), start)
+
+        return output[start: stop]
+
+
+class ResampleProcessor(BlockProcessor):
+    """
+    Resamples with neosound.dsp.StreamResampler, returning the same number of samples as resample_signal.
+    """
+
+    def __init__(self, samplerate, new_samplerate):
+        """
+        :param samplerate: the input samplerate in Hz
+        :param new_samplerate: the output samplerate in Hz
+        """
+
+        self.samplerate = samplerate
+        self.new_samplerate = new_samplerate
+
+    def begin(self, shape):
+
+        self.shape = shape
+        self.nsamples = int(self.new_samplerate * (shape[0] / float(self.samplerate)))
+        self._resampler = StreamResampler(*resample_ratio(self.samplerate, self.new_samplerate))
+        self._noutput = 0
+
+        return (self.nsamples,) + shape[1:]
+
+    def process(self, block):
+
+        return self._limit(self._resampler.process(block))
+
+    def flush(self):
+
+        output = self._limit(self._resampler.flush())
+        missing = self.nsamples - self._noutput
+
+        return np.concatenate([output, np.zeros((missing,) + self.shape[1:])])
+
+    def _limit(self, output):
+
+        output = output[:max(self.nsamples - self._noutput, 0)]
+        self._noutput += len(output)
+
+        return output
+
+
+class SoundStream(object):
+    """
+    A chain of transforms applied to a stored sound one block at a time, so that sounds too long to fit in memory
+    can be processed. Each transform method returns a new SoundStream; nothing is computed until compute is called.
+    The transforms are recorded in the database exactly as the corresponding Sound methods would record them, so the
+    result can also be reconstructed in memory.
+
+    Example:
+    stream = manager.stream(id_).filter([500 * hertz, 8000 * hertz], engine="fft").resample(16000 * hertz,
+                                                                                           resample_type="stream")
+    result = stream.compute(block_size=2 ** 20)
+    """
+
+    def __init__(self, manager, id_, steps=None):
+        """
+        :param manager: the SoundManager that stores the sound
+        :param id_: the id of a sound whose waveform is stored
+        :param steps: a list of (metadata, processor, shape, samplerate) tuples, one for each transform
+        """
+
+        self.manager = manager
+        self.id = id_
+        self.steps = steps or list()
+
+        shape = manager.database.get_data_shape(id_)
+        if shape is None:
+            raise ValueError("Sound %s has no stored waveform to stream" % id_)
+        if len(shape) == 1:
+            shape = shape + (1,)
+        self.input_shape = shape
+        self.input_samplerate = manager.database.get_annotations(id_)["samplerate"]
+
+    @property
+    def shape(self):
+        """
+        The shape of the output of the stream
+        """
+
+        return self.steps[-1][2] if self.steps else self.input_shape
+
+    @property
+    def samplerate(self):
+        """
+        The samplerate of the output of the stream in hertz
+        """
+
+        return (self.steps[-1][3] if self.steps else self.input_samplerate) * hertz
+
+    def _then(self, metadata, processor, samplerate=None):
+
+        if samplerate is None:
+            samplerate = float(self.samplerate)
+        shape = processor.begin(self.shape)
+
+        return SoundStream(self.manager, self.id, self.steps + [(metadata, processor, shape, samplerate)])
+
+    def clip(self, max_val, min_val=None):
+        """
+        Clips the peaks of the sound. See Sound.clip.
+        """
+
+        if min_val is None:
+            min_val = -max_val
+        metadata = dict(type=ClipTransform,
+                        min_value=float(min_val),
+                        max_value=float(max_val))
+
+        return self._then(metadata, PointwiseProcessor(lambda block: np.clip(block, min_val, max_val)))
+
+    def scale(self, c):
+        """
+        Scales the sound by a factor of c. See Sound.scale.
+        """
+
+        if isinstance(c, dB_type):
+            c = c.gain()
+        metadata = dict(type=MultiplyTransform,
+                        coefficients=c)
+
+        return self._then(metadata, PointwiseProcessor(lambda block: block * c))
+
+    def slice(self, start, stop=None):
+        """
+        Returns a section of the sound from start to stop. See Sound.slice.
+        """
+
+        samplerate = float(self.samplerate)
+        sampleperiod = 1 / samplerate
+        if stop is None:
+            stop = self.shape[0] / samplerate * second
+
+        # Rounds to the nearest sample as Sound._round_time does
+        def round_time(time):
+            if isinstance(time, Quantity):
+                return int(float(time) * samplerate) * sampleperiod
+            return time * sampleperiod
+
+        metadata = dict(type=SliceTransform,
+                        start_time=float(round_time(start)),
+                        stop_time=float(round_time(stop)))
+        (shift, nsamples), = SliceTransform.window(metadata, samplerate, self.shape[0])
+
+        return self._then(metadata, WindowProcessor(shift, nsamples))
+
+    def filter(self, frequency_range, filter_order=None, engine="fft", **kwargs):
+        """
+        Filters the sound within a particular frequency range. See Sound.filter. The FIR engines are streamed with
+        overlap-save FFT convolution, which agrees with the in-memory filter to within rounding error. The "sos"
+        engine runs backwards over the whole sound, so it can't be streamed.
+        """
+        from neosound.sound import Sound
+
+        if engine == "sos":
+            raise ValueError("The sos filter engine can't be streamed. Use the filtfilt or fft engine.")
+
+        b, metadata = Sound._design_filter(self.shape[0], self.samplerate / 2, frequency_range, filter_order,
+                                           engine=engine, **kwargs)
+
+        return self._then(metadata, ZeroPhaseFIRProcessor(b))
+
+    def resample(self, samplerate, resample_type="stream"):
+        """
+        Resamples the sound. See Sound.resample. Only the polyphase engines can be streamed.
+        """
+
+        if resample_type not in ["polyphase", "stream"]:
+            raise ValueError("Resample type %s can't be streamed. Use polyphase or stream." % resample_type)
+
+        metadata = dict(type=ResampleTransform,
+                        new_samplerate=float(samplerate),
+                        resample_type=resample_type)
+
+        return self._then(metadata, ResampleProcessor(float(self.samplerate), float(samplerate)),
+                          samplerate=float(samplerate))
+
+    def compute(self, block_size=2 ** 16):
+        """
+        Streams the sound through every transform, writing the result to a new waveform in the database. Only
+        block_size input samples, plus the history each transform needs, are held in memory at a time.
+        :param block_size: the number of input samples read per block (65536)
+        :return: a LazySound for the result
+        """
+        from neosound.sound import LazySound
+
+        database = self.manager.database
+        if database.read_only:
+            raise IOError("Cannot stream into a read-only database!")
+        if not self.steps:
+            return LazySound(self.id, manager=self.manager)
+
+        # Record the transforms, as the Sound methods would
+        records = list()
+        parent = self.id
+        for metadata, processor, shape, samplerate in self.steps:
+            id_ = self.manager.get_id()
+            records.append((id_,
+                            dict(metadata, parents=[parent]),
+                            dict(samplerate=samplerate,
+                                 duration=shape[0] / samplerate,
+                                 nchannels=float(shape[1]))))
+            parent = id_
+        self.manager.store_many(records)
+
+        # Restart the processors in case this stream has been computed before
+        shape = self.input_shape
+        for metadata, processor, out_shape, samplerate in self.steps:
+            shape = processor.begin(shape)
+        database.create_data(id_, shape)
+
+        processors = [step[1] for step in self.steps]
+        position = 0
+        for start in xrange(0, self.input_shape[0], block_size):
+            block = database.read_block(self.id, start, start + block_size)
+            block = np.asarray(block, dtype=float).reshape((-1,) + self.input_shape[1:])
+            for processor in processors:
+                block = processor.process(block)
+            if len(block):
+                database.write_block(id_, position, block)
+                position += len(block)
+
+        for ii, processor in enumerate(processors):
+            block = processor.flush()
+            for later in processors[ii + 1:]:
+                block = later.process(block)
+            if len(block):
+                database.write_block(id_, position, block)
+                position += len(block)
+
+        return LazySound(id_, manager=self.manager)
@@ -1,11 +1,15 @@
 from __future__ import print_function
 import os
 import copy
+import gc
+import pickle
 from unittest import TestCase, main
 
 import numpy as np
 
 from neosound.sound import *
+from neosound.metrics import stored_metrics
+from neosound.dsp import spectrum_cache
 
 this_dir, this_filename = os.path.split(__file__)
 wavfile = os.path.join(this_dir, "..", "..", "data", "zbsong.wav")
@@ -40,6 +44,175 @@ class SoundTest(TestCase):
         else:
             print("Passed")
 
+    def test_pickle(self):
+
+        print("Checking that pickled sounds keep their id and store...", end="")
+        manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        s = Sound.whitenoise(duration=1*second, samplerate=44100*hertz, manager=manager).set_level(60*dB)
+        nids = len(manager.database.list_ids())
+        unpickled = pickle.loads(pickle.dumps(s, pickle.HIGHEST_PROTOCOL))
+        shared = s.share()
+        pickled = pickle.dumps(shared, pickle.HIGHEST_PROTOCOL)
+        attached = pickle.loads(pickled)
+        try:
+            assert unpickled.id == s.id
+            assert unpickled.annotations == s.annotations
+            assert unpickled.manager.database is manager.database
+            assert np.all(unpickled.asarray() == s.asarray())
+            assert len(manager.database.list_ids()) == nids
+            assert shared.id == s.id
+            assert len(pickled) < 1000
+            # The waveform is shared, not copied
+            attached[:10] = 0
+            assert np.all(shared.asarray()[:10] == 0)
+            # A store that only existed in memory can't be reattached once it's gone
+            dict_manager = SoundManager(DictStore)
+            pickled = pickle.dumps(Sound.whitenoise(duration=0.1*second, manager=dict_manager))
+            del dict_manager
+            gc.collect()
+            self.assertRaises(IOError, pickle.loads, pickled)
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_views(self):
+
+        print("Checking that slices and channels are read-only views...", end="")
+        manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        s = Sound(np.random.normal(0, 1, (44100, 2)), samplerate=44100*hertz, manager=manager, initialize=True)
+        sliced = s.slice(0.25*second, 0.5*second)
+        channel = s.get_channel(1)
+        padded = s.slice(0.5*second, 1.5*second, read_only=True)
+        try:
+            assert np.shares_memory(sliced, s) and np.shares_memory(channel, s)
+            assert np.all(sliced.asarray() == s.asarray()[11025: 22050])
+            assert np.all(channel.asarray() == s.asarray()[:, 1])
+            assert sliced.annotations == manager.database.get_annotations(sliced.id)
+            assert channel.nchannels == 1
+            assert sliced.id != s.id
+            assert len(padded) == 44100 and not np.shares_memory(padded, s)
+            # Writing to a view must not change the parent
+            self.assertRaises(ValueError, sliced.__setitem__, slice(0, 10), 0)
+            assert np.all((sliced * 2).asarray() == 2 * s.asarray()[11025: 22050])
+            assert np.all(manager.reconstruct(sliced.id).asarray() == sliced.asarray())
+            assert np.all(manager.reconstruct(channel.id).asarray() == channel.asarray())
+            # Writes to the parent show through the view, including its level
+            level = sliced.get_level()
+            s *= 10
+            assert np.allclose(sliced.get_level(), level + 20)
+            assert sliced.data_version() == 1
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_deferred_annotations(self):
+
+        print("Checking that deferred annotations are only written when stored...", end="")
+        manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        s = Sound(np.random.normal(0, 1, (44100, 1)), samplerate=44100*hertz, manager=manager, initialize=True)
+        with manager.deferred_mode():
+            deferred = Sound(np.zeros((100, 1)), samplerate=44100*hertz, manager=manager)
+            deferred.annotate(label="test")
+        nids = len(manager.database.list_ids())
+        unstored = s.scale(2, read_only=True).clip(0.5, read_only=True)
+        nids_unstored = len(manager.database.list_ids())
+        clipped = s.scale(2).clip(0.5)
+        manager.reconstruct(clipped.id)
+        try:
+            assert len(manager.database.list_ids()) == nids + 2
+            assert nids_unstored == nids
+            self.assertRaises(KeyError, manager.database.get_annotations, deferred.id)
+            self.assertRaises(KeyError, manager.database.get_annotations, unstored.id)
+            assert manager.database.get_annotations(clipped.id) == clipped.annotations
+            deferred.flush_annotations()
+            assert manager.database.get_annotations(deferred.id)["label"] == "test"
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_metrics(self):
+
+        print("Checking that level metrics match and are cached...", end="")
+        manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        s = Sound(np.random.normal(0, 1, (44100, 2)), samplerate=44100*hertz, manager=manager, initialize=True)
+        level = BHSound.get_level(s)
+        # Nothing is cached yet, so the stored waveform is read in blocks
+        metrics = stored_metrics(manager, s.id, block_size=1000)
+        leveled = s.set_level(60*dB)
+        louder = s.scale(1)
+        louder.get_level()
+        louder *= 10
+        stored = manager.database.get_annotations(louder.id)
+        try:
+            assert np.allclose(s.get_level(), level)
+            assert np.allclose(leveled.get_level(), 60)
+            assert "metric_rms_1" in manager.database.get_annotations(s.id)
+            assert np.allclose(metrics["level"], level)
+            assert np.allclose(metrics["power_nonsilence"], s.get_power_nonsilence())
+            # A different threshold is recomputed rather than read from the cache, and doesn't replace it
+            assert s.get_power_nonsilence(0.5)[0] > s.get_power_nonsilence()[0]
+            assert manager.database.get_annotations(s.id)["metric_silence_threshold"] == 0.1
+            # Modifying a sound in place discards its cached metrics, but not those of the stored waveform
+            assert np.allclose(louder.get_level(), level + 20)
+            assert manager.database.get_annotations(louder.id) == stored
+            louder[:100] = 100
+            assert np.allclose(louder.get_metrics()["peak"], 100)
+            # Sounds without annotations, e.g. the results of arithmetic, are measured without caching
+            assert np.allclose((s * 10).get_level(), level + 20)
+            assert np.allclose((s * 10).get_power_nonsilence(), 100 * np.array(s.get_power_nonsilence()))
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_spectrum_matched_noise(self):
+
+        print("Checking batched spectrum-matched noise...", end="")
+        manager = SoundManager(DictStore)
+        s = Sound(np.random.normal(0, 1, (22050, 2)), samplerate=44100*hertz, manager=manager,
+                  initialize=True).filter([500*hertz, 4000*hertz])
+        spectrum_cache.clear()
+        noise = s.to_spectrum_matched_noise()
+        batch = s.to_spectrum_matched_noise(duration=0.25*second, ntokens=20)
+        try:
+            assert noise.shape == s.shape
+            assert np.allclose(noise.get_level(), s.get_level())
+            assert batch.data.shape == (20, 11025, 2)
+            assert np.allclose(batch.get_level(), s.get_level())
+            # The spectrum of s is computed once for both calls
+            assert (spectrum_cache.info()["misses"], spectrum_cache.info()["hits"]) == (1, 1)
+            # Tokens descend from s and are reconstructed from it and their seed rather than stored
+            assert manager.database.get_metadata(batch.ids[3])["parents"] == [s.id]
+            assert manager.get_roots(noise.id) == manager.get_roots(s.id)
+            assert manager.database.get_data_shape(batch.ids[3]) is None
+            assert np.allclose(manager.reconstruct(batch.ids[3]).asarray(), batch.data[3])
+            self.assertRaises(ValueError, s.to_spectrum_matched_noise, ntokens=0)
+            # A sound modified in place doesn't reuse the spectrum of its previous waveform
+            white = Sound(np.random.normal(0, 1, (22050, 1)), samplerate=44100*hertz, manager=manager,
+                          initialize=True)
+            white.to_spectrum_matched_noise()
+            white[:] = np.asarray(white.filter([500*hertz, 1000*hertz], read_only=True))
+            power = np.abs(np.fft.rfft(white.to_spectrum_matched_noise().asarray())) ** 2
+            frequencies = np.fft.rfftfreq(22050, 1 / 44100.)
+            assert power[frequencies > 8000].mean() < 0.01 * power[(frequencies > 500) & (frequencies < 1000)].mean()
+            # Tokens are independent and keep the spectrum of s: little power outside of the filter's passband
+            assert not np.allclose(batch.data[0], batch.data[1])
+            power = np.mean(np.abs(np.fft.rfft(batch.data, axis=1)) ** 2, axis=(0, 2))
+            frequencies = np.fft.rfftfreq(11025, 1 / 44100.)
+            assert power[frequencies > 8000].mean() < 0.01 * power[(frequencies > 1000) & (frequencies < 3000)].mean()
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
 
 if __name__ == "__main__":
 
@@ -1,6 +1,9 @@
 from __future__ import print_function
 from unittest import TestCase, main
+from multiprocessing.pool import ThreadPool
+import json
 import logging
+import threading
 
 import numpy as np
 
@@ -93,6 +96,376 @@ class SoundManagerTest(TestCase):
         else:
             print("Passed")
 
+    def test_import_ids_hdf5(self):
+
+        print("Checking that data imports between HDF5 stores...", end="")
+        manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        s = Sound(wavfile, manager=manager).to_mono()
+        w = Sound.whitenoise(duration=s.duration + 1*second,
+                             samplerate=s.samplerate,
+                             nchannels=1,
+                             manager=manager)
+        c = s.slice(1*second, 3*second).embed(w, start=0.5*second, ratio=0*dB)
+
+        # Test reconstruction
+        recon_manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        recon_ids = recon_manager.import_ids(manager, [c.id], foo="bar")
+
+        # Test recursive import
+        recurse_manager = SoundManager(HDF5Store, os.tempnam() + ".h5")
+        ids = [c.id]
+        recurse_ids = recurse_manager.import_ids(manager, ids, recursive=True)
+
+        # Nothing is imported into a read-only store
+        read_only_manager = SoundManager(HDF5Store, recon_manager.database.filename, read_only=True)
+        read_only_ids = read_only_manager.import_ids(manager, [c.id])
+
+        try:
+            assert read_only_ids[0] not in read_only_manager.database.list_ids()
+            assert ids == [c.id]
+            assert recon_manager.database.get_annotations(recon_ids[0])["foo"] == "bar"
+            assert recon_manager.database.get_metadata(recon_ids[0])["parents"] == []
+            assert np.all(c.asarray() == recon_manager.reconstruct(recon_ids[0]).asarray())
+
+            assert len(recurse_manager.database.list_ids()) == 5
+            assert len(recurse_manager.get_roots(recurse_ids[0])) == 2
+            for id_ in recurse_manager.database.list_ids():
+                metadata = recurse_manager.database.get_metadata(id_)
+                for pid in metadata.get("parents", list()) + metadata.get("children", list()):
+                    assert pid in recurse_manager.database.list_ids()
+            assert np.all(c.asarray() == recurse_manager.reconstruct(recurse_ids[0]).asarray())
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_import_components(self):
+
+        print("Checking that imported component indexes are remapped...", end="")
+        try:
+            for store, args in [(DictStore, ()), (HDF5Store, (os.tempnam() + ".h5", ))]:
+                manager = SoundManager(store, *args, id_allocator="counter")
+                s = Sound.whitenoise(duration=0.1*second, samplerate=44100*hertz, manager=manager)
+                w = Sound.whitenoise(duration=0.1*second, samplerate=44100*hertz, manager=manager)
+                c = s.embed(w, start=0*second, ratio=6*dB)
+                components = c.get_components()
+
+                # The new store already holds sounds with the ids that are imported
+                args = (os.tempnam() + ".h5", ) if args else args
+                new_manager = SoundManager(store, *args, id_allocator="counter")
+                for ii in range(10):
+                    Sound(np.zeros((4410, 1)), samplerate=44100*hertz, manager=new_manager, initialize=True)
+                new_ids = new_manager.import_ids(manager, [c.id] + [component.id for component in components],
+                                                 recursive=True)
+                metadata = new_manager.database.get_metadata(new_ids[0])
+                assert sorted(metadata["component_ids"]) == sorted(new_ids[1:])
+                for component in new_manager.reconstruct_components(new_ids[0]):
+                    assert component.id in new_ids[1:]
+                    assert new_manager.database.get_metadata(component.id)["id"] == new_ids[0]
+                assert np.allclose(sum(component.asarray() for component in new_manager.reconstruct_components(
+                    new_ids[0])), c.asarray())
+
+                # Components that aren't imported are dropped from the index
+                alone = new_manager.import_ids(manager, [c.id], recursive=True)
+                assert new_manager.database.get_metadata(alone[0])["component_ids"] == []
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_lazy_reconstruct(self):
+
+        print("Checking that lazy reconstruction defers computation...", end="")
+        s = Sound.whitenoise(duration=2*second)
+        sliced = s.slice(0.5*second, 1.5*second).ramp()
+        lazy = s.manager.reconstruct(sliced.id, lazy=True)
+
+        try:
+            assert lazy.duration == sliced.duration
+            assert lazy.samplerate == sliced.samplerate
+            assert lazy.nchannels == 1
+            assert lazy.roots == [s.id]
+            assert lazy.detail()["type"] == RampTransform
+            assert not lazy.loaded
+            assert len(Sound.query([lazy], lambda x: x.duration > 0.5*second)) == 1
+            assert not lazy.loaded
+            assert np.all(np.asarray(lazy) == np.asarray(sliced))
+            assert lazy.loaded
+            assert np.all(lazy.asarray() == sliced.asarray())
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_fused_reconstruct(self):
+
+        print("Checking that fused reconstruction is identical to unfused...", end="")
+        s = Sound.whitenoise(duration=1*second, nchannels=2)
+        chained = s.slice(0.1*second, 0.6*second).pad(0.8*second, start=0.1*second)
+        chained = chained.scale(0.5).set_level(60*dB).clip(0.01)
+        padded = s.pad(1.5*second, start=0.25*second).slice(0.2*second, 1.4*second).scale(-2)
+
+        try:
+            for sound in [chained, padded]:
+                plan = s.manager._plan(sound.id)
+                assert plan["type"] == FusedTransform
+                assert plan["parents"][0]["id"] == s.id
+                fused = s.manager.reconstruct(sound.id)
+                unfused = s.manager.reconstruct(sound.id, optimize=False)
+                assert fused.shape == unfused.shape == sound.shape
+                assert np.asarray(fused).tobytes() == np.asarray(unfused).tobytes()
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_explain_and_profile(self):
+
+        print("Checking reconstruction plans and profiles...", end="")
+        s = Sound.whitenoise(duration=1*second)
+        w = Sound.whitenoise(duration=1*second, manager=s.manager)
+        c = s.slice(0*second, 0.5*second).scale(2).pad(1*second, start=0*second).combine(w)
+
+        try:
+            plan = s.manager.explain(c.id)
+            assert plan["type"] == "AddTransform"
+            assert plan["recomputed"] and not plan["stored"]
+            assert plan["nsamples"] == c.nsamples
+            fused, root = plan["parents"]
+            assert fused["steps"] == ["SliceTransform", "MultiplyTransform", "PadTransform"]
+            assert fused["parents"][0]["stored"] and fused["parents"][0]["id"] == s.id
+            assert root["stored"] and root["nsamples"] == w.nsamples
+            assert len(s.manager.explain(c.id, optimize=False)["parents"][0]["parents"][0]["parents"]) == 1
+            assert json.loads(json.dumps(plan)) == plan
+
+            sound, profile = s.manager.reconstruct(c.id, profile=True)
+            assert np.all(np.asarray(sound) == np.asarray(c))
+            assert [node["type"] for node in profile.nodes] == ["CreateTransform", "FusedTransform",
+                                                                  "CreateTransform", "AddTransform"]
+            assert profile.bytes_read == s.nbytes + w.nbytes
+            assert profile.peak_bytes == c.nbytes
+            exported = json.loads(profile.to_json())
+            assert exported["id"] == c.id
+            assert len(exported["nodes"]) == 4
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_reconstruct_components(self):
+
+        print("Checking that all components are reconstructed in one pass...", end="")
+        s = Sound(wavfile).to_mono()
+        w = Sound.whitenoise(duration=s.duration + 1*second,
+                             samplerate=s.samplerate,
+                             nchannels=1)
+        t = Sound.tone(500*hertz, duration=s.duration + 1*second, samplerate=s.samplerate)
+        c = s.embed(w, start=0.5*second, ratio=0*dB)
+        c = c.combine(t.clip(0.5).scale(0.1))
+
+        try:
+            roots = c.roots
+            assert len(roots) == 3
+            components = c.get_components()
+            assert len(components) == 3
+            for root_id, component in zip(roots, components):
+                individual = c.manager.reconstruct_individual(c.id, root_id)
+                assert individual.id == component.id
+                assert np.all(np.asarray(individual) == np.asarray(component))
+            assert np.all(components[0].slice(0.5*second, 0.5*second + s.duration).asarray() == s.asarray())
+            assert c.components == [component.id for component in components]
+            assert c.component(1).id == components[1].id
+            assert len(c.manager.database.filter_ids(transform_id=c.id)) == 3
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_threaded_transforms(self):
+
+        print("Checking that transforms can run from many threads...", end="")
+        manager = SoundManager(DictStore)
+        s = Sound.whitenoise(duration=0.5*second, manager=manager)
+
+        def transform(ii):
+            return [s.scale(ii).clip(0.5).id, s.slice(0*second, 0.25*second).id]
+
+        pool = ThreadPool(8)
+        try:
+            ids = sum(pool.map(transform, range(100)), list())
+        finally:
+            pool.close()
+            pool.join()
+
+        try:
+            children = manager.database.get_metadata(s.id)["children"]
+            assert len(children) == 200
+            for id_ in ids:
+                assert manager.get_roots(id_) == [s.id]
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_ephemeral_mode(self):
+
+        print("Checking that ephemeral mode only writes committed sounds...", end="")
+        manager = SoundManager(DictStore)
+        s = Sound.whitenoise(duration=1*second, manager=manager)
+        nids = len(manager.database.list_ids())
+        with manager.ephemeral_mode():
+            noise = Sound.whitenoise(duration=1*second, manager=manager)
+            augmented = s.combine(noise).pad(2*second, start=0.5*second).set_level(60*dB).clip(0.05)
+            augmented.annotate(name="augmented")
+            ephemeral_ids = len(manager.database.list_ids())
+            assert augmented.commit(index=0)
+            # Other threads sharing the manager still write
+            clipped = list()
+            thread = threading.Thread(target=lambda: clipped.append(s.clip(0.5)))
+            thread.start()
+            thread.join()
+
+
+        try:
+            assert not manager.ephemeral
+            assert ephemeral_ids == nids
+            assert len(manager.database.list_ids()) == nids + 2
+            assert manager.database.get_metadata(clipped[0].id)["parents"] == [s.id]
+            assert manager.get_roots(augmented.id) == [augmented.id]
+            assert manager.database.get_annotations(augmented.id)["name"] == "augmented"
+            assert manager.database.get_annotations(augmented.id)["index"] == 0
+            assert np.all(manager.reconstruct(augmented.id).asarray() == augmented.asarray())
+            assert manager.database.get_metadata(s.id)["children"] == [clipped[0].id]
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_write_behind(self):
+
+        print("Checking that write-behind persistence matches direct writes...", end="")
+        filename = os.tempnam() + ".h5"
+        manager = SoundManager(HDF5Store, filename, write_behind=True)
+        s = Sound.whitenoise(duration=1*second, manager=manager)
+        augmented = s.pad(2*second, start=0.5*second).set_level(60*dB).clip(0.05)
+        manager.flush()
+        try:
+            assert np.all(manager.reconstruct(augmented.id).asarray() == augmented.asarray())
+            manager.close()
+            manager = SoundManager(HDF5Store, filename, read_only=True)
+            assert np.all(manager.reconstruct(augmented.id).asarray() == augmented.asarray())
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_memoize(self):
+
+        print("Checking that memoized transforms reuse existing results...", end="")
+        filename = os.tempnam() + ".h5"
+        manager = SoundManager(HDF5Store, filename)
+        s = Sound.whitenoise(duration=1*second, samplerate=44100*hertz, manager=manager)
+        w = Sound.whitenoise(duration=1*second, samplerate=44100*hertz, manager=manager)
+        with manager.memoize_mode():
+            filtered = s.filter([500*hertz, 8000*hertz])
+            nids = len(manager.database.list_ids())
+            again = s.filter(frequency_range=[500*hertz, 8000*hertz])
+            combined = s.combine(w)
+            padded = s.pad(2*second)
+            # Each call gets its own copy of the result
+            scaled = s.scale(2)
+            scaled *= 0
+            scaled_again = s.scale(2)
+            # memoize_mode only applies to this thread
+            unmemoized = list()
+            thread = threading.Thread(target=lambda: unmemoized.append(s.scale(2)))
+            thread.start()
+            thread.join()
+        try:
+            assert scaled_again is not scaled
+            assert np.all(scaled_again.asarray() == 2 * s.asarray())
+            assert unmemoized[0].id != scaled.id
+            assert again.id == filtered.id
+            assert len(manager.database.list_ids()) == nids + 4
+            assert s.combine(w, memoize=True).id == combined.id
+            assert w.combine(s, memoize=True).id != combined.id
+            assert s.pad(2*second, memoize=True).id != padded.id
+            assert s.filter([500*hertz, 8000*hertz]).id != filtered.id
+
+            # A new manager finds the result among the children of the parent sound
+            manager = SoundManager(HDF5Store, filename, memoize=True)
+            s = manager.reconstruct(s.id)
+            again = s.filter([500*hertz, 8000*hertz])
+            assert again.id == filtered.id
+            assert np.all(again.asarray() == filtered.asarray())
+
+            # Modifying the parent in place stops its earlier results from being reused
+            scaled = s.scale(2)
+            s *= 10
+            rescaled = s.scale(2)
+            assert rescaled.id != scaled.id
+            assert np.allclose(rescaled.asarray(), 10 * scaled.asarray())
+            assert w.combine(s, memoize=True).id != w.combine(s, memoize=True).id
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_stream(self):
+
+        print("Checking that streamed transforms match in-memory transforms...", end="")
+        filename = os.tempnam() + ".h5"
+        manager = SoundManager(HDF5Store, filename)
+        s = Sound(np.random.normal(0, 1, (3 * 44100 + 17, 2)), samplerate=44100*hertz, manager=manager,
+                  initialize=True)
+        stream = manager.stream(s.id).filter([500*hertz, 8000*hertz]).resample(16000*hertz)
+        stream = stream.slice(0.5*second, 2.5*second).scale(0.5).clip(0.8)
+        streamed = stream.compute(block_size=10000)
+        expected = s.filter([500*hertz, 8000*hertz], engine="fft").resample(16000*hertz, resample_type="stream")
+        expected = expected.slice(0.5*second, 2.5*second).scale(0.5).clip(0.8)
+        try:
+            assert streamed.samplerate == 16000*hertz
+            assert np.allclose(streamed.asarray(), expected.asarray())
+            assert manager.get_roots(streamed.id) == [s.id]
+            assert manager.database.get_metadata(streamed.id)["max_value"] == 0.8
+            self.assertRaises(ValueError, manager.stream(s.id).filter, [500*hertz, 8000*hertz], engine="sos")
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
+    def test_map(self):
+
+        print("Checking that mapping over a process pool matches serial transforms...", end="")
+        filename = os.tempnam() + ".h5"
+        manager = SoundManager(HDF5Store, filename)
+        sounds = [Sound.whitenoise(duration=0.5*second, samplerate=44100*hertz, manager=manager) for ii in range(4)]
+        func = lambda sound: sound.filter([500*hertz, 4000*hertz]).set_level(60*dB).ramp()
+        new_ids = manager.map(func, [sound.id for sound in sounds], workers=2)
+        try:
+            assert len(new_ids) == len(sounds)
+            for sound, new_id in zip(sounds, new_ids):
+                assert np.allclose(manager.reconstruct(new_id).asarray(), func(sound).asarray())
+                assert manager.get_roots(new_id) == [sound.id]
+                assert manager.database.get_metadata(new_id)["type"] == RampTransform
+            assert manager.map(lambda sound: None, [sounds[0].id], workers=1) == [None]
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
 if __name__ == "__main__":
 
     main()
\ No newline at end of file
@@ -1,10 +1,14 @@
 from __future__ import print_function
 from unittest import TestCase, main
+from multiprocessing.pool import ThreadPool
 import os
+import sys
+import threading
 
 import numpy as np
 
 from neosound.sound_store import *
+from neosound.sparse import SparseWaveform, sparsify
 from neosound.sound_transforms import SoundTransform
 
 
@@ -90,6 +94,145 @@ class SoundStoreTest(TestCase):
         assert store._get_group(store.filename, store.get_id()) == False
 
 
+    def check_concurrent_writes(self, store, nthreads=8, nwrites=50):
+
+        root = store.get_id()
+        store.store_metadata(root, type=SoundTransform, parents=list())
+
+        def hammer(ii):
+            ids = list()
+            for jj in range(nwrites):
+                id_ = store.get_id()
+                store.store_annotations(id_, thread=ii, write=jj)
+                store.store_metadata(id_, type=SoundTransform, parents=[root])
+                store.add_child(root, id_)
+                store.filter_ids(thread=ii)
+                ids.append(id_)
+            return ids
+
+        pool = ThreadPool(nthreads)
+        try:
+            ids = sum(pool.map(hammer, range(nthreads)), list())
+        finally:
+            pool.close()
+            pool.join()
+
+        children = store.get_metadata(root)["children"]
+        assert len(ids) == nthreads * nwrites
+        assert sorted(children) == sorted(ids)
+        for ii in range(nthreads):
+            assert len(store.filter_ids(thread=ii)) == nwrites
+
+    @check_storage
+    def test_dictionary_threaded_store(self):
+
+        self.check_concurrent_writes(DictStore())
+
+    @check_storage
+    def test_hdf5_threaded_store(self):
+
+        filename = os.tempnam() + ".h5"
+        self.check_concurrent_writes(HDF5Store(filename), nwrites=10)
+
+    @check_storage
+    def test_hdf5_crossed_copy_store(self):
+
+        stores = [HDF5Store(os.tempnam() + ".h5"), HDF5Store(os.tempnam() + ".h5")]
+        for store in stores:
+            id_ = store.get_id()
+            store.store_metadata(id_, type=SoundTransform, parents=list())
+            store.store_data(id_, np.zeros((100, 1)))
+
+        # Copying in both directions at once takes the two file locks in the same order
+        def copy(store, source):
+            for ii in range(200):
+                store.copy_ids(source, dict((id_, store.get_id()) for id_ in source.list_ids()[:1]))
+
+        # Switch threads as often as possible, so that they interleave while taking the locks
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        threads = [threading.Thread(target=copy, args=(stores[0], stores[1])),
+                   threading.Thread(target=copy, args=(stores[1], stores[0]))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        sys.setcheckinterval(interval)
+        assert not any(thread.is_alive() for thread in threads)
+        assert all(len(store.list_ids()) == 201 for store in stores)
+
+    @check_storage
+    def test_hdf5_counter_id_store(self):
+
+        filename = os.tempnam() + ".h5"
+        store = HDF5Store(filename, id_allocator=CounterAllocator(block_size=4))
+        ids = [store.get_id() for ii in range(6)]
+        assert ids == range(1, 7)
+        store.store_metadata(ids[0], type=SoundTransform, parents=list(), children=ids[1:])
+        for id_ in ids[1:]:
+            store.store_metadata(id_, type=SoundTransform, parents=[ids[0]])
+        assert store.get_metadata(ids[0])["children"] == ids[1:]
+        assert sorted(store.list_ids()) == ids
+        assert store.filter_ids(ids=ids[1:3]) == ids[1:3]
+        assert len(set(store.to_uuid(id_) for id_ in ids)) == len(ids)
+
+        # Reopening the file keeps the allocator and never reuses an id
+        store = HDF5Store(filename)
+        assert store.get_id() == 9
+        self.assertRaises(ValueError, HDF5Store, filename, id_allocator="uuid")
+
+    @check_storage
+    def test_hdf5_write_behind_store(self):
+
+        filename = os.tempnam() + ".h5"
+        store = WriteBehindStore(HDF5Store(filename), max_pending=5, batch_size=3)
+        self.check_concurrent_writes(store, nwrites=10)
+
+        data = np.random.normal(0, 1, (100, 1))
+        id_ = store.get_id()
+        store.store_data(id_, data)
+        assert np.all(store.get_data(id_) == data)
+
+        # Errors in the background thread are raised by the next flush
+        store.store_data(store.get_id(), np.array([None, "a"], dtype=object))
+        self.assertRaises(TypeError, store.flush)
+        store.flush()
+
+        store.close()
+        self.assertRaises(IOError, store.store_annotations, id_, closed=True)
+        assert np.all(HDF5Store(filename, read_only=True).get_data(id_) == data)
+
+    @check_storage
+    def test_hdf5_sparse_store(self):
+
+        filename = os.tempnam() + ".h5"
+        store = HDF5Store(filename)
+        data = np.zeros((100000, 2))
+        data[20000: 21000] = np.random.normal(0, 1, (1000, 2))
+        data[60000: 60500, 1] = 1
+        sparse = SparseWaveform.from_dense(data)
+        assert len(sparse.segments) == 2
+        assert np.all(sparse.add(sparse.scale(2)).slice(19000, 61000).to_dense() == 3 * data[19000: 61000])
+        assert len(sparsify(data).segments) == 2
+        # Dense data is returned as is, including data whose zeros are too short to split it into segments
+        spiky = np.zeros((10000, 1))
+        spiky[::3] = 1
+        assert sparsify(spiky) is spiky
+        assert sparsify(data, max_density=0.01) is data
+
+        id_ = store.get_id()
+        store.store_data(id_, sparse)
+        assert os.path.getsize(filename) < data.nbytes / 10
+        assert np.all(store.get_data(id_) == data)
+        assert store.get_data_shape(id_) == data.shape
+        assert np.all(store.read_block(id_, 20500, 60200) == data[20500: 60200])
+        assert len(store.get_sparse_data(id_).segments) == 2
+
+        # Dense data replaces sparse data
+        store.store_data(id_, data[:10])
+        assert np.all(store.get_data(id_) == data[:10])
+
 if __name__ == "__main__":
 
     main()
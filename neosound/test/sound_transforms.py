@@ -12,9 +12,7 @@ wavfile = os.path.join(this_dir, "..", "..", "data", "zbsong.wav")
 h5out = "/tmp/test.h5"
 
 # TODO: Check that attributes are preserved in new objects (e.g. samplerate)
-# TODO: Resample test
 # TODO: Ramp test
-# TODO: Filter test
 
 def check_transform_data(func):
     
@@ -186,6 +184,89 @@ class SoundTransformTest(TestCase):
 
         return ramped, sound
 
+    @check_transform_data
+    def test_filter_transform(self):
+
+        from neosound.dsp import filter_design_cache
+
+        sound = Sound.whitenoise(duration=1*second, nchannels=2)
+        filter_design_cache.clear()
+        lowpassed = sound.filter([0*hertz, 4000*hertz])
+        highpassed = sound.filter([4000*hertz, sound.nyquist_frequency])
+        filtered = sound.filter([500*hertz, 4000*hertz])
+        assert filter_design_cache.info()["misses"] == 3
+        metadata = sound.manager.database.get_metadata(highpassed.id)
+        assert (metadata["min_frequency"], metadata["max_frequency"]) == (4000, float(sound.nyquist_frequency))
+
+        # Filtering many sounds at once reuses the design and gives the same results
+        others = [Sound.whitenoise(duration=1*second, manager=sound.manager) for ii in range(3)]
+        batch = Sound.filter_many([sound] + others, [500*hertz, 4000*hertz])
+        assert filter_design_cache.info()["hits"] == 1
+        assert np.all(np.asarray(batch[0]) == np.asarray(filtered))
+        for other, result in zip(others, batch[1:]):
+            assert np.all(np.asarray(result) == np.asarray(other.filter([500*hertz, 4000*hertz])))
+            assert np.all(np.asarray(sound.manager.reconstruct(result.id)) == np.asarray(result))
+        assert np.all(np.asarray(sound.manager.reconstruct(lowpassed.id)) == np.asarray(lowpassed))
+
+        return highpassed, sound
+
+    @check_transform_data
+    def test_filter_engine_transform(self):
+
+        sound = Sound.whitenoise(duration=1*second)
+        filtered = sound.filter([500*hertz, 4000*hertz])
+        fft_filtered = sound.filter([500*hertz, 4000*hertz], engine="fft")
+        assert np.allclose(np.asarray(fft_filtered), np.asarray(filtered))
+        butter_filtered = sound.filter([500*hertz, 4000*hertz], engine="sos")
+        assert np.all(np.asarray(sound.manager.reconstruct(butter_filtered.id)) == np.asarray(butter_filtered))
+        ellip_filtered = sound.filter([0*hertz, 4000*hertz], engine="sos", design="ellip", attenuation=80)
+        assert sound.manager.database.get_metadata(ellip_filtered.id)["attenuation"] == 80
+
+        return ellip_filtered, sound
+
+    @check_transform_data
+    def test_resample_transform(self):
+
+        from scipy.signal import resample_poly
+
+        sound = Sound.whitenoise(duration=1*second, samplerate=44100*hertz, nchannels=2)
+        resampled = sound.resample(48000*hertz, resample_type="polyphase")
+        assert resampled.nsamples == 48000
+        assert np.all(np.asarray(resampled) == resample_poly(np.asarray(sound), 160, 147, axis=0))
+        streamed = sound.resample(48000*hertz, resample_type="stream")
+        assert np.all(np.asarray(streamed) == np.asarray(resampled))
+        fft_resampled = sound.resample(16000*hertz, resample_type="sinc_best")
+        assert fft_resampled.nsamples == 16000
+        assert np.all(np.asarray(sound.manager.reconstruct(fft_resampled.id)) == np.asarray(fft_resampled))
+
+        return streamed, sound
+
+    def test_batch_transform(self):
+
+        from neosound.sound_batch import SoundBatch
+
+        print("Checking batch transforms...", end="")
+        manager = SoundManager(DictStore)
+        sounds = [Sound.whitenoise(duration=0.5*second, nchannels=2, manager=manager) for ii in range(4)]
+        sounds.append(Sound(np.zeros(sounds[0].shape), samplerate=sounds[0].samplerate, manager=manager))
+        batch = SoundBatch.from_sounds(sounds)
+        transformed = batch.ramp(duration=20*msecond).scale(0.5).set_level(60*dB).clip(0.05)
+        try:
+            assert transformed.data.shape == (5,) + sounds[0].shape
+            assert len(manager.database.get_metadata(sounds[0].id)["children"]) == 1
+            # Silent sounds keep their id through set_level
+            assert batch.set_level(60*dB).ids[-1] == sounds[-1].id
+            for sound, result in zip(sounds[:-1], transformed):
+                expected = sound.ramp(duration=20*msecond).scale(0.5).set_level(60*dB).clip(0.05)
+                assert np.allclose(np.asarray(result), np.asarray(expected))
+                assert np.all(np.asarray(manager.reconstruct(result.id)) == np.asarray(result))
+                assert manager.get_roots(result.id) == [sound.id]
+        except AssertionError:
+            print("Failed")
+            raise
+        else:
+            print("Passed")
+
     @check_transform_data
     def test_add_transform(self):
 
@@ -209,6 +290,69 @@ class SoundTransformTest(TestCase):
 
         return replaced, (sound1, sound2)
 
+    @check_transform_data
+    def test_mix_transform(self):
+
+        manager = SoundManager(HDF5Store, h5out)
+        sounds = [Sound.whitenoise(duration=(1 + 0.1 * ii)*second, samplerate=44100*hertz, nchannels=2,
+                                   manager=manager) for ii in range(4)]
+        offsets = [0.05 * ii*second for ii in range(4)]
+        gains = [1, 0.5, -6*dB, (0.5, 2)]
+        mixed = Sound.mix(sounds, offsets, gains)
+        expected = None
+        for sound, offset, gain in zip(sounds, offsets, gains):
+            padded = sound.pad(mixed.duration, start=offset).scale(np.reshape(gain, (1, -1)) if isinstance(gain, tuple)
+                                                                   else gain)
+            expected = padded if expected is None else expected.combine(padded)
+        assert np.all(mixed.asarray() == expected.asarray())
+        assert manager.get_roots(mixed.id) == [sound.id for sound in sounds]
+        assert Sound.mix(sounds, duration=0.5*second).nsamples == int(0.5*second * sounds[0].samplerate)
+        # Mixing a sound with itself gives a single component that sums to the mix
+        doubled = Sound.mix([sounds[0], sounds[0]], [0*second, 0.05*second])
+        components = doubled.get_components(store=False)
+        assert len(components) == 1
+        assert np.allclose(components[0].asarray(), doubled.asarray())
+        assert manager.database.get_metadata(sounds[0].id)["children"].count(doubled.id) == 1
+
+        return mixed, sounds[0]
+
+    @check_transform_data
+    def test_concatenate_transform(self):
+
+        sounds = [Sound.whitenoise(duration=(0.2 + 0.05 * ii)*second, samplerate=44100*hertz) for ii in range(3)]
+        manager = sounds[0].manager
+        session = Sound.concatenate([sounds[0], sounds[1], sounds[0], sounds[2]], gaps=0.5*second)
+        assert session.nsamples == sum(sound.nsamples for sound in sounds) + sounds[0].nsamples + 3 * 22050
+        assert np.all(session.slice(0*second, sounds[0].duration).asarray() == sounds[0].asarray())
+        # A repeated source is a single root and a single component, and the session is only listed once as its child
+        assert manager.get_roots(session.id) == [sounds[0].id, sounds[1].id, sounds[2].id]
+        assert manager.database.get_metadata(sounds[0].id)["children"].count(session.id) == 1
+        components = session.get_components(store=False)
+        assert len(components) == 3
+        assert np.allclose(sum(component.asarray() for component in components), session.asarray())
+        segment = manager.reconstruct_segment(session.id, 0.6*second, 1.5*second)
+        assert np.all(segment.asarray() == session.slice(0.6*second, 1.5*second, read_only=True).asarray())
+        assert np.all(manager.reconstruct(segment.id).asarray() == segment.asarray())
+
+        return session, sounds[0]
+
+    @check_transform_data
+    def test_embed_transform(self):
+
+        s = Sound.whitenoise(duration=0.5*second, samplerate=44100*hertz, nchannels=2)
+        w = Sound.whitenoise(duration=1*second, samplerate=44100*hertz, nchannels=2, manager=s.manager).scale(0.1)
+        c = s.embed(w, start=0.25*second, ratio=6*dB)
+        padded = s.pad(1*second, start=0.25*second)
+        expected = padded.combine(w.pad(1*second, start=0*second).set_level(padded.level - 6*dB))
+        assert np.allclose(c.asarray(), expected.asarray())
+        metadata = s.manager.database.get_metadata(c.id)
+        assert metadata["type"] == EmbedTransform
+        assert metadata["parents"] == [s.id, w.id]
+        components = c.get_components(store=False)
+        assert np.allclose(components[0].asarray() + components[1].asarray(), c.asarray())
+
+        return c, s
+
     @check_transform_data
     def test_component_transform(self):
 